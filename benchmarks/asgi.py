@@ -0,0 +1,44 @@
+from urllib.parse import urlencode
+
+
+async def call_asgi(app, method, path, query=None, body=b'', headers=()):
+    """
+    Send a single HTTP request to an ASGI app in-process, without a server or a client library.
+
+    :param query: list of (name, value) query parameters
+    :return: (status, headers, body)
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('utf8'),
+        'query_string': urlencode(query or []).encode('latin-1'),
+        'root_path': '',
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers
+        ],
+        'client': ('127.0.0.1', 50000),
+        'server': ('127.0.0.1', 8000),
+    }
+    request_messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = {'status': None, 'headers': [], 'body': []}
+
+    async def receive():
+        if request_messages:
+            return request_messages.pop(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = message.get('headers', [])
+        elif message['type'] == 'http.response.body':
+            response['body'].append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return response['status'], response['headers'], b''.join(response['body'])
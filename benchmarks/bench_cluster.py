@@ -0,0 +1,74 @@
+"""
+Benchmark decoding and sorting large clusters with `sorted_cluster`.
+"""
+import argparse
+import json
+import random
+import timeit
+
+from benchmarks.synthetic import encode_base58, make_local_iri
+from same_thing.db import (
+    SEPARATOR,
+    SINGLETON_LOCAL_SEPARATOR,
+    finalise_members,
+    sorted_cluster,
+)
+
+CLUSTER_SIZES = (100, 1000, 10000, 100000)
+
+
+def make_members(size, seed=0, duplicate_share=0.1):
+    """
+    :return: member values (singleton ID || local IRI), including duplicates
+    """
+    rng = random.Random(seed)
+    members = [
+        encode_base58(rng.getrandbits(36)).encode('utf8')
+        + SINGLETON_LOCAL_SEPARATOR
+        + make_local_iri(rng, size, index).encode('utf8')
+        for index in range(size)
+    ]
+    members.extend(rng.sample(members, int(size * duplicate_share)))
+    rng.shuffle(members)
+    return members
+
+
+def time_call(func, repeat):
+    number = 1
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    return {
+        'best_ms': 1000 * min(timings) / number,
+        'mean_ms': 1000 * sum(timings) / (number * len(timings)),
+    }
+
+
+def run_benchmark(cluster_sizes, repeat, seed):
+    results = {}
+    for size in cluster_sizes:
+        members = make_members(size, seed)
+        # as written by the merge operator, and after finalising
+        legacy_value = SEPARATOR.join(members)
+        finalised_value = finalise_members(members)
+        results[str(size)] = {
+            'legacy': time_call(lambda: sorted_cluster(legacy_value), repeat),
+            'finalised': time_call(lambda: sorted_cluster(finalised_value), repeat),
+            'legacy_bytes': len(legacy_value),
+            'finalised_bytes': len(finalised_value),
+        }
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help='JSON file to write the results to')
+    parser.add_argument('--sizes', type=int, nargs='+', default=CLUSTER_SIZES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.output, 'w') as output_file:
+        json.dump(run_benchmark(args.sizes, args.repeat, args.seed), output_file, indent=2)
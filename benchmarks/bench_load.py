@@ -0,0 +1,63 @@
+"""
+Benchmark downloading a snapshot from the (stand-in) Databus, and loading it.
+
+Paths are taken from the `SAME_THING_*` environment variables, so this should
+run in its own process, with a fresh DB root per load mode.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from same_thing.db import DB_ROOT_PATH, get_data_db_name, get_db_path
+from same_thing.sink import load_snapshot, LOAD_MODES, BATCH_SIZE, QUEUE_SIZE
+from same_thing.source import fetch_latest_snapshot
+
+
+def get_dir_size(dir_path):
+    return sum(
+        os.path.getsize(os.path.join(root, file_name))
+        for root, _, file_names in os.walk(dir_path)
+        for file_name in file_names
+    )
+
+
+async def run_benchmark(mode, line_count, batch_size, queue_size):
+    started_at = time.perf_counter()
+    snapshot_name = await fetch_latest_snapshot()
+    download_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    await load_snapshot(snapshot_name, mode=mode, batch_size=batch_size, queue_size=queue_size)
+    load_seconds = time.perf_counter() - started_at
+
+    return {
+        'mode': mode,
+        'batch_size': batch_size,
+        'queue_size': queue_size,
+        'download_seconds': download_seconds,
+        'load_seconds': load_seconds,
+        'lines_per_second': line_count / load_seconds,
+        'db_bytes': get_dir_size(get_db_path(get_data_db_name(snapshot_name))),
+        'db_root_path': DB_ROOT_PATH,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help='JSON file to write the results to')
+    parser.add_argument('--mode', choices=LOAD_MODES, default='online')
+    parser.add_argument('--lines', type=int, required=True, help='number of lines in the snapshot')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.get_event_loop().run_until_complete(
+        run_benchmark(args.mode, args.lines, args.batch_size, args.queue_size)
+    )
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
@@ -0,0 +1,139 @@
+"""
+Benchmark single-URI and multi-URI lookups, by calling the ASGI app in-process.
+
+The DB root is taken from `SAME_THING_DB_ROOT_PATH`, and should contain a loaded snapshot.
+"""
+import argparse
+import asyncio
+import bz2
+import json
+import random
+import time
+
+from benchmarks.asgi import call_asgi
+
+GLOBAL_IRI_PREFIX = 'https://global.dbpedia.org/id/'
+# found and not found; anything else (e.g. 503 while no snapshot is served) invalidates the results
+EXPECTED_STATUSES = {'200', '404'}
+
+
+def sample_uris(snapshot_path, sample_size, seed=0, global_share=0.1, missing_share=0.05):
+    """
+    Sample local and global IRIs from the snapshot (with a reservoir), and add IRIs that are not in it.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    with bz2.open(snapshot_path, 'rt', encoding='utf8') as snapshot_file:
+        next(snapshot_file)
+        for line_number, line in enumerate(snapshot_file):
+            local_iri, _, cluster_id = line.rstrip('\n').split('\t')
+            uri = GLOBAL_IRI_PREFIX + cluster_id if rng.random() < global_share else local_iri
+            if len(reservoir) < sample_size:
+                reservoir.append(uri)
+            else:
+                index = rng.randint(0, line_number)
+                if index < sample_size:
+                    reservoir[index] = uri
+
+    missing_count = int(sample_size * missing_share)
+    for index in range(missing_count):
+        reservoir[rng.randrange(len(reservoir))] = f'http://example.org/missing/{index}'
+
+    rng.shuffle(reservoir)
+    return reservoir
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(fraction):
+        return 1000 * latencies[min(count - 1, int(count * fraction))]
+
+    return {
+        'requests': count,
+        'requests_per_second': count / elapsed,
+        'mean_ms': 1000 * sum(latencies) / count,
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'max_ms': 1000 * latencies[-1],
+    }
+
+
+async def measure(requests):
+    """
+    :param requests: list of coroutine functions that each send one request
+    """
+    latencies = []
+    statuses = {}
+    started_at = time.perf_counter()
+    for send_request in requests:
+        request_started_at = time.perf_counter()
+        status, _, _ = await send_request()
+        latencies.append(time.perf_counter() - request_started_at)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    unexpected_statuses = set(statuses) - EXPECTED_STATUSES
+    if unexpected_statuses:
+        raise RuntimeError(f'Unexpected response statuses: {statuses}')
+
+    results = summarize(latencies, time.perf_counter() - started_at)
+    results['statuses'] = statuses
+    return results
+
+
+def get_single(app, uri):
+    return lambda: call_asgi(app, 'GET', '/lookup/', [('uri', uri), ('meta', 'off')])
+
+
+def get_multiple(app, uris):
+    return lambda: call_asgi(app, 'GET', '/lookup/', [('uris', uri) for uri in uris] + [('meta', 'off')])
+
+
+def post_bulk(app, uris):
+    body = '\n'.join(uris).encode('utf8')
+    return lambda: call_asgi(app, 'POST', '/lookup/', [('meta', 'off')], body, [('content-type', 'text/plain')])
+
+
+def batched(uris, batch_size):
+    return [uris[i:i + batch_size] for i in range(0, len(uris), batch_size)]
+
+
+async def run_benchmark(snapshot_path, sample_size, seed):
+    uris = sample_uris(snapshot_path, sample_size, seed)
+    from same_thing.app import app
+    from same_thing.query import snapshots
+
+    # the app opens the latest snapshot in its startup handlers, which `call_asgi` does not run;
+    # open it without the warm-up, so that the first pass is measured cold
+    snapshots.warm_up = None
+    snapshots.refresh()
+    if not snapshots.ready:
+        raise RuntimeError('No snapshot can be opened in SAME_THING_DB_ROOT_PATH')
+
+    results = {'sample_size': len(uris)}
+    # the first pass misses the cluster cache, the second pass hits it
+    results['single_cold'] = await measure([get_single(app, uri) for uri in uris])
+    results['single_warm'] = await measure([get_single(app, uri) for uri in uris])
+    results['multiple_10'] = await measure([get_multiple(app, batch) for batch in batched(uris, 10)])
+    results['bulk_1000'] = await measure([post_bulk(app, batch) for batch in batched(uris, 1000)])
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help='JSON file to write the results to')
+    parser.add_argument('--snapshot-path', required=True, help='snapshot file to sample URIs from')
+    parser.add_argument('--sample-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.get_event_loop().run_until_complete(
+        run_benchmark(args.snapshot_path, args.sample_size, args.seed)
+    )
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
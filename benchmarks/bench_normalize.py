@@ -0,0 +1,75 @@
+"""
+Benchmark normalizing looked up URIs with `normalize_uri`, with and without memoisation.
+"""
+import argparse
+import json
+import random
+import timeit
+from urllib.parse import quote
+
+from benchmarks.synthetic import encode_base58, make_local_iri
+from same_thing.uris import normalize_uri
+
+URI_FORMS = ('local', 'global', 'page', 'wikipedia')
+
+
+def make_uri(rng, form, index):
+    if form == 'global':
+        return f'https://global.dbpedia.org/id/{encode_base58(rng.getrandbits(36))}'
+
+    local_iri = make_local_iri(rng, index, 0)
+    while form != 'local' and not local_iri.startswith('http://dbpedia.org/resource/'):
+        local_iri = make_local_iri(rng, index, 0)
+    if form == 'page':
+        return local_iri.replace('/resource/', '/page/')
+    elif form == 'wikipedia':
+        return 'https://en.wikipedia.org/wiki/' + quote(local_iri.rsplit('/', 1)[-1])
+    return local_iri
+
+
+def make_lookups(rng, uris, count, skew=1.1):
+    """
+    :return: `count` URIs drawn from `uris`, in which a few URIs are looked up often
+    """
+    weights = [1 / (rank + 1) ** skew for rank in range(len(uris))]
+    return rng.choices(uris, weights=weights, k=count)
+
+
+def time_per_uri(func, uris, repeat):
+    timings = timeit.repeat(lambda: [func(uri) for uri in uris], number=1, repeat=repeat)
+    return 1e9 * min(timings) / len(uris)
+
+
+def run_benchmark(distinct, lookups, repeat, seed):
+    rng = random.Random(seed)
+    uncached = normalize_uri.__wrapped__
+    results = {'uncached_ns': {}}
+    for form in URI_FORMS:
+        uris = [make_uri(rng, form, index) for index in range(1000)]
+        results['uncached_ns'][form] = time_per_uri(uncached, uris, repeat)
+
+    uris = [make_uri(rng, rng.choice(URI_FORMS), index) for index in range(distinct)]
+    stream = make_lookups(rng, uris, lookups)
+    normalize_uri.cache_clear()
+    results['stream'] = {
+        'uncached_ns': time_per_uri(uncached, stream, repeat),
+        'memoised_ns': time_per_uri(normalize_uri, stream, repeat),
+        'hit_share': normalize_uri.cache_info().hits / (repeat * len(stream)),
+    }
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help='JSON file to write the results to')
+    parser.add_argument('--distinct', type=int, default=100000, help='number of distinct URIs')
+    parser.add_argument('--lookups', type=int, default=200000, help='number of looked up URIs')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.output, 'w') as output_file:
+        json.dump(run_benchmark(args.distinct, args.lookups, args.repeat, args.seed), output_file, indent=2)
@@ -0,0 +1,59 @@
+"""
+Compare the results of two benchmark runs.
+"""
+import argparse
+import json
+
+from tabulate import tabulate
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+
+    return flat
+
+
+def compare(baseline, candidate):
+    baseline_values = flatten(baseline['results'])
+    candidate_values = flatten(candidate['results'])
+    rows = []
+    for name, baseline_value in baseline_values.items():
+        candidate_value = candidate_values.get(name)
+        if candidate_value is None:
+            continue
+
+        change = (candidate_value - baseline_value) / baseline_value if baseline_value else None
+        rows.append((
+            name,
+            baseline_value,
+            candidate_value,
+            f'{change:+.1%}' if change is not None else '',
+        ))
+
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('baseline', help='results of `benchmarks.run`')
+    parser.add_argument('candidate', help='results of `benchmarks.run`')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline_results, candidate_results = json.load(baseline_file), json.load(candidate_file)
+
+    print(f"{baseline_results['revision']} -> {candidate_results['revision']}")
+    print(tabulate(
+        compare(baseline_results, candidate_results),
+        headers=['metric', 'baseline', 'candidate', 'change'],
+        floatfmt='.4g',
+    ))
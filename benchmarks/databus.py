@@ -0,0 +1,115 @@
+"""
+Local stand-in for the Databus: answers the latest snapshot query, and serves the snapshot files.
+
+Point the loader to it with `SAME_THING_DATABUS_SPARQL_URL=http://<host>:<port>/repo/sparql`.
+Files are served with support for HTTP Range requests, and a flaky link can be
+simulated by dropping each response after a number of bytes (`--drop-after`).
+"""
+import argparse
+import os
+
+from aiohttp import web
+
+from same_thing.source import SNAPSHOT_FILENAME, DOWNLOAD_CHUNK_SIZE, get_sha256sum
+
+SPARQL_JSON_MIME = 'application/sparql-results+json'
+
+
+async def sparql(request):
+    snapshot_root = request.app['snapshot_root']
+    snapshot_names = sorted(
+        name for name in os.listdir(snapshot_root)
+        if os.path.isfile(os.path.join(snapshot_root, name, SNAPSHOT_FILENAME))
+    )
+    bindings = []
+    if snapshot_names:
+        latest = snapshot_names[-1]
+        file_url = f'{request.scheme}://{request.host}/files/{latest}/{SNAPSHOT_FILENAME}'
+        bindings.append({
+            'file': {'type': 'uri', 'value': file_url},
+            'latest': {'type': 'literal', 'value': latest},
+        })
+        if request.app['checksums']:
+            sha256sum = get_sha256sum(os.path.join(snapshot_root, latest, SNAPSHOT_FILENAME))
+            bindings[0]['sha256sum'] = {'type': 'literal', 'value': sha256sum}
+
+    return web.json_response(
+        {'head': {'vars': ['file', 'latest', 'sha256sum']}, 'results': {'bindings': bindings}},
+        content_type=SPARQL_JSON_MIME,
+    )
+
+
+async def serve_file(request):
+    snapshot_root = os.path.realpath(request.app['snapshot_root'])
+    file_path = os.path.realpath(os.path.join(snapshot_root, request.match_info['path']))
+    if not file_path.startswith(snapshot_root + os.sep) or not os.path.isfile(file_path):
+        raise web.HTTPNotFound()
+
+    size = os.path.getsize(file_path)
+    byte_range = request.http_range
+    start, stop = byte_range.start or 0, size if byte_range.stop is None else min(byte_range.stop, size)
+    if start < 0:
+        # a suffix range, e.g. the last 500 bytes
+        start = max(0, size + start)
+    if start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(stop - start),
+        'ETag': f'"{os.stat(file_path).st_mtime_ns:x}-{size:x}"',
+    }
+    status = 200
+    if 'Range' in request.headers:
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+
+    response = web.StreamResponse(status=status, headers=headers)
+    await response.prepare(request)
+    if request.method == 'HEAD':
+        return response
+
+    drop_after = request.app['drop_after']
+    sent = 0
+    with open(file_path, 'rb') as served_file:
+        served_file.seek(start)
+        while start + sent < stop:
+            chunk = served_file.read(min(DOWNLOAD_CHUNK_SIZE, stop - start - sent))
+            if drop_after and sent + len(chunk) > drop_after:
+                await response.write(chunk[:drop_after - sent])
+                # end the response prematurely, as on a flaky link
+                request.transport.close()
+                return response
+            await response.write(chunk)
+            sent += len(chunk)
+
+    await response.write_eof()
+    return response
+
+
+def create_app(snapshot_root, checksums=True, drop_after=None):
+    app = web.Application()
+    app['snapshot_root'] = snapshot_root
+    app['checksums'] = checksums
+    app['drop_after'] = drop_after
+    app.router.add_get('/repo/sparql', sparql)
+    app.router.add_get('/files/{path:.+}', serve_file)
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('snapshot_root', help='directory with a subdirectory per snapshot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8028)
+    parser.add_argument('--no-checksums', action='store_true', help='leave out the SHA-256 checksum of the snapshot')
+    parser.add_argument('--drop-after', type=int, help='drop each file response after this number of bytes')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    web.run_app(
+        create_app(args.snapshot_root, checksums=not args.no_checksums, drop_after=args.drop_after),
+        host=args.host, port=args.port, print=None,
+    )
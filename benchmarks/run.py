@@ -0,0 +1,146 @@
+"""
+Run the benchmark suite offline, and write the results to a JSON file.
+
+A synthetic snapshot is generated and served by a local Databus stand-in.
+Every benchmark runs in its own process, with its own DB root.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.synthetic import write_snapshot
+from same_thing.sink import LOAD_MODES
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+
+    raise TimeoutError(f'The Databus stand-in did not start on port {port}')
+
+
+def get_git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=REPO_ROOT, capture_output=True, check=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_module(module, args, env, work_dir):
+    """
+    Run a benchmark module in a fresh interpreter, and read the results it wrote.
+    """
+    output_path = os.path.join(work_dir, f'{module.rsplit(".", 1)[-1]}_{time.monotonic_ns()}.json')
+    subprocess.run(
+        [sys.executable, '-m', module, output_path] + [str(arg) for arg in args],
+        cwd=REPO_ROOT, env=env, check=True,
+    )
+    with open(output_path) as output_file:
+        return json.load(output_file)
+
+
+def run_suite(work_dir, clusters, seed, modes, sample_size):
+    snapshot_root = os.path.join(work_dir, 'databus')
+    snapshot = write_snapshot(snapshot_root, '2020.01.01', clusters, seed)
+    print(f"Generated {snapshot['lines']} lines in {snapshot['clusters']} clusters", flush=True)
+
+    port = get_free_port()
+    databus = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.databus', snapshot_root, '--port', str(port)],
+        cwd=REPO_ROOT,
+    )
+    results = {'snapshot': snapshot, 'load': {}}
+    try:
+        wait_for_port(port)
+        for mode in modes:
+            db_root_path = os.path.join(work_dir, f'dbdata_{mode}')
+            download_path = os.path.join(work_dir, f'downloads_{mode}')
+            os.makedirs(db_root_path)
+            os.makedirs(download_path)
+            env = dict(
+                os.environ,
+                SAME_THING_DB_ROOT_PATH=db_root_path,
+                SAME_THING_DOWNLOAD_PATH=download_path,
+                SAME_THING_DATABUS_SPARQL_URL=f'http://127.0.0.1:{port}/repo/sparql',
+                SAME_THING_METRICS_DIR=os.path.join(work_dir, 'metrics'),
+            )
+            results['load'][mode] = run_module(
+                'benchmarks.bench_load', ['--mode', mode, '--lines', snapshot['lines']], env, work_dir
+            )
+    finally:
+        databus.terminate()
+        databus.wait()
+
+    results['lookup'] = run_module(
+        'benchmarks.bench_lookup',
+        ['--snapshot-path', snapshot['path'], '--sample-size', sample_size, '--seed', seed],
+        env, work_dir,
+    )
+    results['sorted_cluster'] = run_module('benchmarks.bench_cluster', ['--seed', seed], env, work_dir)
+    results['normalize_uri'] = run_module('benchmarks.bench_normalize', ['--seed', seed], env, work_dir)
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='JSON file to write the results to (default: stdout)')
+    parser.add_argument('--clusters', type=int, default=50000, help='number of clusters in the synthetic snapshot')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', choices=LOAD_MODES, nargs='+', default=list(LOAD_MODES))
+    parser.add_argument('--sample-size', type=int, default=5000, help='number of URIs to look up')
+    parser.add_argument('--work-dir', help='keep the generated files in this directory')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='same_thing_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        suite_results = {
+            'revision': get_git_revision(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'parameters': {
+                'clusters': args.clusters,
+                'seed': args.seed,
+                'modes': args.modes,
+                'sample_size': args.sample_size,
+            },
+            'results': run_suite(work_dir, args.clusters, args.seed, args.modes, args.sample_size),
+        }
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(suite_results, output_file, indent=2)
+    else:
+        print(json.dumps(suite_results, indent=2))
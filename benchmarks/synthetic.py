@@ -0,0 +1,139 @@
+"""
+Generate a synthetic `global-ids_base58.tsv.bz2` snapshot.
+
+Cluster sizes follow a capped Pareto distribution: most clusters have a
+single member, and a few clusters have thousands. Local IRIs mimic the
+sources of the real snapshot, including percent-encoded and non-ASCII slugs,
+and each belongs to a single cluster, as in the real snapshot.
+"""
+import argparse
+import bz2
+import json
+import os
+import random
+
+from same_thing.source import SNAPSHOT_FILENAME
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+TSV_HEADER = 'original_iri\tsingleton_id_base58\tcluster_id_base58'
+DBPEDIA_LOCALES = ('', 'de.', 'fr.', 'nl.', 'ja.', 'es.', 'it.', 'pl.', 'ru.', 'commons.')
+SLUG_WORDS = (
+    'River', 'Saint', 'Battle_of', 'List_of', 'John', 'Amsterdam', 'Station',
+    'Église', 'Straße', 'Москва', '東京', 'São_Paulo', 'Wilhelm', 'Football_Club',
+    '(disambiguation)', '%22Quoted%22', 'Café', 'A.C.', 'Q&A', "Rock'n'Roll",
+)
+PARETO_ALPHA = 1.3
+MAX_CLUSTER_SIZE = 20000
+
+
+def encode_base58(number):
+    encoded = ''
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+
+    return encoded or BASE58_ALPHABET[0]
+
+
+def make_slug(rng, cluster_index):
+    words = rng.sample(SLUG_WORDS, rng.randint(1, 3))
+    return '_'.join(words) + f'_{cluster_index}'
+
+
+def get_member_number(cluster_index, member_index):
+    """
+    :return: a number that is unique to the member of a cluster (the Cantor pairing of both indices)
+    """
+    diagonal = cluster_index + member_index
+    return diagonal * (diagonal + 1) // 2 + member_index
+
+
+def make_local_iri(rng, cluster_index, member_index):
+    source = rng.random()
+    member_number = get_member_number(cluster_index, member_index)
+    if source < 0.25:
+        return f'http://www.wikidata.org/entity/Q{member_number + 1}'
+    elif source < 0.85:
+        locale = rng.choice(DBPEDIA_LOCALES)
+        slug = make_slug(rng, cluster_index)
+        return f'http://{locale}dbpedia.org/resource/{slug}_{member_index}'
+    elif source < 0.95:
+        return f'http://sws.geonames.org/{member_number}/'
+    else:
+        return f'http://rdf.freebase.com/ns/m.0{member_number:x}'
+
+
+def generate_lines(n_clusters, seed=0, max_cluster_size=MAX_CLUSTER_SIZE):
+    """
+    :return: list of TSV lines (without header), and the size of each cluster
+    """
+    rng = random.Random(seed)
+    used_ids = set()
+
+    def new_id():
+        while True:
+            singleton_id = encode_base58(rng.getrandbits(rng.choice((24, 30, 36))))
+            if singleton_id not in used_ids:
+                used_ids.add(singleton_id)
+                return singleton_id
+
+    lines = []
+    cluster_sizes = []
+    for cluster_index in range(n_clusters):
+        size = min(max_cluster_size, int(rng.paretovariate(PARETO_ALPHA)))
+        cluster_sizes.append(size)
+        singleton_ids = [new_id() for _ in range(size)]
+        # the cluster is identified by one of its members
+        cluster_id = rng.choice(singleton_ids)
+        for member_index, singleton_id in enumerate(singleton_ids):
+            local_iri = make_local_iri(rng, cluster_index, member_index)
+            lines.append(f'{local_iri}\t{singleton_id}\t{cluster_id}')
+
+    rng.shuffle(lines)
+    return lines, cluster_sizes
+
+
+def write_snapshot(download_path, snapshot_name, n_clusters, seed=0, max_cluster_size=MAX_CLUSTER_SIZE):
+    """
+    Write a synthetic snapshot where the loader expects a downloaded snapshot.
+
+    :return: dict that describes the generated snapshot
+    """
+    lines, cluster_sizes = generate_lines(n_clusters, seed, max_cluster_size)
+    snapshot_dir = os.path.join(download_path, snapshot_name)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_path = os.path.join(snapshot_dir, SNAPSHOT_FILENAME)
+    with bz2.open(snapshot_path, 'wt', encoding='utf8', compresslevel=9) as snapshot_file:
+        snapshot_file.write(TSV_HEADER + '\n')
+        for line in lines:
+            snapshot_file.write(line + '\n')
+
+    cluster_sizes.sort()
+    return {
+        'snapshot_name': snapshot_name,
+        'path': snapshot_path,
+        'seed': seed,
+        'lines': len(lines),
+        'clusters': n_clusters,
+        'compressed_bytes': os.path.getsize(snapshot_path),
+        'cluster_size_p50': cluster_sizes[len(cluster_sizes) // 2],
+        'cluster_size_p99': cluster_sizes[int(len(cluster_sizes) * 0.99)],
+        'cluster_size_max': cluster_sizes[-1],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('download_path', help='directory in which the snapshot directory is created')
+    parser.add_argument('--name', default='2020.01.01', help='snapshot (version) name')
+    parser.add_argument('--clusters', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-cluster-size', type=int, default=MAX_CLUSTER_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(json.dumps(write_snapshot(
+        args.download_path, args.name, args.clusters, args.seed, args.max_cluster_size
+    ), indent=2))
@@ -1,10 +1,13 @@
-import multiprocessing
-
+from same_thing.config import HTTP_WORKERS
 from same_thing.db import purge_data_dbs
+from same_thing.metrics import clear_snapshots, mark_process_dead
+from same_thing.warmup import archive_hot_keys
 
 bind = "0.0.0.0:8000"
-workers = min(4, multiprocessing.cpu_count())
+# the RocksDB block cache budget is divided among the workers
+workers = HTTP_WORKERS
 worker_class = 'uvicorn.workers.UvicornWorker'
+# the app is imported before forking, but each worker opens the DB itself (see `/ready`)
 preload_app = True
 proc_name = 'same-thing'
 loglevel = 'warning'
@@ -12,3 +15,19 @@ loglevel = 'warning'
 
 def on_starting(server):
     purge_data_dbs()
+    clear_snapshots()
+    # the hot keys of workers that did not exit cleanly
+    merge_hot_keys()
+
+
+def child_exit(server, worker):
+    # keep the counters of the worker, so that the totals do not decrease
+    mark_process_dead(worker.pid)
+    merge_hot_keys(worker.pid)
+
+
+def merge_hot_keys(pid=None):
+    try:
+        archive_hot_keys(pid)
+    except Exception as e:
+        print(f'Could not archive the hot keys: {e!r}', flush=True)
@@ -1,16 +1,51 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import logging
+import os
 import sys
-from typing import Dict, Optional, Any, List
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Optional, List, Union
 
 from starlette.applications import Starlette
+from starlette.datastructures import QueryParams
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 
+from same_thing.config import env_int
 from same_thing.db import purge_data_dbs
-from same_thing.exceptions import UriNotFound
-from same_thing.query import get_cluster, UriCluster
+from same_thing.exceptions import NotReady, Overloaded
+from same_thing.executor import LookupExecutor
+from same_thing.export import (
+    FORMATS as EXPORT_FORMATS,
+    MEDIA_TYPES as EXPORT_MEDIA_TYPES,
+    gzip_chunks,
+    iter_export,
+)
+from same_thing.metrics import (
+    MetricsMiddleware,
+    LOOKUP_STAGE_SECONDS,
+    read_merged_snapshots,
+    render_text,
+    write_periodically,
+    write_snapshot,
+)
+from same_thing.query import (
+    lookup_clusters,
+    get_locale_host,
+    CachedCluster,
+    MemberFilter,
+    hot_keys,
+    snapshots,
+    SNAPSHOT_POLL_SECONDS,
+)
+from same_thing.serialize import dumps, join_object, extend_object
+from same_thing.streaming import iter_lines, iter_batches, is_gzipped, LineTooLong
+from same_thing.warmup import HOT_KEY_SAVE_SECONDS
 
 debug = '--debug' in sys.argv
 if debug:
@@ -18,16 +53,131 @@ if debug:
     purge_data_dbs()
 
 app = Starlette(debug=debug)
+MAX_BULK_URIS = 50000
+# the body of a bulk lookup is read into memory, so it is refused beyond this size
+MAX_BULK_BYTES = env_int('SAME_THING_MAX_BULK_MB', 32) * 1024**2
+LOOKUP_THREADS = env_int('SAME_THING_LOOKUP_THREADS', 8)
+MAX_PENDING_LOOKUPS = env_int('SAME_THING_MAX_PENDING_LOOKUPS', 64)
+RETRY_AFTER_SECONDS = 1
+STREAM_BATCH_SIZE = env_int('SAME_THING_STREAM_BATCH_SIZE', 1000)
+METRICS_WRITE_SECONDS = env_int('SAME_THING_METRICS_WRITE_SECONDS', 5)
+# full exports per worker that can run at once
+MAX_EXPORTS = env_int('SAME_THING_MAX_EXPORTS', 1)
+
+META = {
+    'documentation': 'http://dev.dbpedia.org/Global%20IRI%20Resolution%20Service',
+    'github': 'https://github.com/dbpedia/dbp-same-thing-service',
+    'license': 'http://purl.org/NET/rdflicense/cc-by3.0',
+    'license_comment': 'Free service provided by DBpedia. Usage and republication of data implies that you '
+                       'attribute either http://dbpedia.org as the source or reference the latest general '
+                       'DBpedia paper or the specific paper mentioned in the GitHub Readme.',
+    'comment': """
+                The service resolves any IRI to its cluster and displays the global IRI and its cluster members.
+                Cluster members can change over time as the DBpedia community, 
+                data providers and professional services curate the linking space. 
+    
+                Usage note: 
+                1. Save the global ID AND the local IRI that seems most appropriate. 
+                   It is recommended that you become a data provider, in which case the local IRI would be your IRI.  
+                2. Use the global ID to access anything DBpedia.
+                3. Use the stored local ID to update and re-validate linking and clusters.
+            """,
+}
+# serialized once, to be included in every response
+META_JSON = dumps(META)
+
+lookup_executor = LookupExecutor(LOOKUP_THREADS, MAX_PENDING_LOOKUPS)
+export_slots = threading.BoundedSemaphore(MAX_EXPORTS)
+export_executor = ThreadPoolExecutor(max_workers=MAX_EXPORTS, thread_name_prefix='export')
+background_tasks: List[asyncio.Task] = []
+app.add_middleware(MetricsMiddleware, routes=['/lookup/', '/lookup/stream', '/export', '/metrics', '/health', '/ready'])
 
 
 @app.on_event('startup')
 def log_ready_message() -> None:
     logger = logging.getLogger('uvicorn')
-    logger.info('Same Thing Service is ready for lookups.')
+    logger.info('Same Thing Service has started, and is ready for lookups once `/ready` responds with 200.')
+
+
+@app.on_event('startup')
+def watch_snapshots() -> None:
+    # each worker opens (and warms up) the latest snapshot itself, after it was forked
+    background_tasks.append(
+        asyncio.ensure_future(snapshots.watch(SNAPSHOT_POLL_SECONDS))
+    )
+
+
+@app.on_event('startup')
+def save_hot_keys() -> None:
+    if HOT_KEY_SAVE_SECONDS > 0:
+        background_tasks.append(
+            asyncio.ensure_future(hot_keys.save_periodically(HOT_KEY_SAVE_SECONDS))
+        )
+
+
+@app.on_event('startup')
+def write_metrics() -> None:
+    background_tasks.append(
+        asyncio.ensure_future(write_periodically(METRICS_WRITE_SECONDS))
+    )
+
+
+@app.on_event('shutdown')
+def stop_lookup_executor() -> None:
+    for task in background_tasks:
+        task.cancel()
+    lookup_executor.shutdown()
+    export_executor.shutdown(wait=False)
+    write_snapshot()
+    try:
+        hot_keys.save()
+    except Exception as e:
+        print(f'Could not save the hot keys: {e!r}', flush=True)
+
+
+@app.route('/health', methods=['GET'])
+async def health(request: Request) -> Response:
+    """
+    Liveness: the worker is running, whether or not it serves lookups yet.
+    """
+    return JSONResponse({'status': 'ok'})
+
+
+@app.route('/ready', methods=['GET'])
+async def ready(request: Request) -> Response:
+    """
+    Readiness: the worker has opened and warmed up a snapshot, and serves lookups from it.
+    """
+    snapshot = snapshots.current
+    if snapshot is None:
+        return not_ready()
+
+    return JSONResponse({
+        'ready': True,
+        'snapshot': os.path.basename(snapshot.db_path),
+        'completed_at': snapshot.completed_at,
+        'static_index': bool(snapshot.index_path),
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics(request: Request) -> Response:
+    """
+    Export the metrics of all workers in the Prometheus text format.
+
+    Other workers write their metrics every few seconds, so their part may lag behind.
+    """
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, write_snapshot)
+    merged = await loop.run_in_executor(None, read_merged_snapshots)
+    return PlainTextResponse(
+        render_text(merged),
+        media_type='text/plain; version=0.0.4',
+    )
 
 
 @app.route('/lookup/', methods=['GET'])
-def lookup(request: Request) -> JSONResponse:
+async def lookup(request: Request) -> Response:
     single_uri = request.query_params.get('uri')
     uris = request.query_params.getlist('uris') or [single_uri]
     if not any(uris):
@@ -35,47 +185,315 @@ def lookup(request: Request) -> JSONResponse:
             'uri': 'The `uri` parameter must be provided.'
         }, status_code=400)
 
-    fields_by_uri: Dict[str, Optional[UriCluster]] = {}
-    for uri in uris:
+    try:
+        member_filter = parse_member_filter(request.query_params)
+    except ValueError as e:
+        return JSONResponse({
+            'filter': str(e)
+        }, status_code=400)
+
+    try:
+        clusters_by_uri = await lookup_executor.run(lookup_clusters, uris, member_filter)
+    except Overloaded:
+        return service_unavailable()
+    except NotReady:
+        return not_ready()
+
+    return lookup_response(request, clusters_by_uri, single_uri)
+
+
+@app.route('/lookup/', methods=['POST'])
+async def bulk_lookup(request: Request) -> Response:
+    """
+    Look up many URIs, provided as a JSON list (optionally under the `uris` key),
+    or as newline-delimited text.
+    """
+    body = await read_limited_body(request, MAX_BULK_BYTES)
+    if body is None:
+        return JSONResponse({
+            'uris': f'The request body can be at most {MAX_BULK_BYTES // 1024**2} MB.'
+        }, status_code=413)
+
+    try:
+        uris = parse_uris(body, request.headers.get('content-type', ''))
+    except ValueError as e:
+        return JSONResponse({
+            'uris': f'Could not parse the request body: {e}'
+        }, status_code=400)
+
+    if not uris:
+        return JSONResponse({
+            'uris': 'The request body must contain at least one URI.'
+        }, status_code=400)
+    elif len(uris) > MAX_BULK_URIS:
+        return JSONResponse({
+            'uris': f'At most {MAX_BULK_URIS} URIs can be looked up per request.'
+        }, status_code=413)
+
+    try:
+        member_filter = parse_member_filter(request.query_params)
+    except ValueError as e:
+        return JSONResponse({
+            'filter': str(e)
+        }, status_code=400)
+
+    try:
+        clusters_by_uri = await lookup_executor.run(lookup_clusters, uris, member_filter)
+    except Overloaded:
+        return service_unavailable()
+    except NotReady:
+        return not_ready()
+
+    return lookup_response(request, clusters_by_uri)
+
+
+async def read_limited_body(request: Request, max_bytes: int) -> Optional[bytes]:
+    """
+    Read the request body, unless it is larger than `max_bytes`.
+
+    :return: the body, or None if it is too large
+    """
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        return None
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+
+    return b''.join(chunks)
+
+
+@app.route('/lookup/stream', methods=['POST'])
+async def stream_lookup(request: Request) -> Response:
+    """
+    Look up an unlimited number of URIs, uploaded as newline-delimited text
+    (optionally gzip compressed), and stream back one JSON object per line.
+
+    The input is read and looked up in batches, so memory use per request
+    does not depend on the size of the input.
+    """
+    lines = iter_lines(
+        request.stream(),
+        gzipped=is_gzipped(
+            request.headers.get('content-encoding'),
+            request.headers.get('content-type'),
+        ),
+    )
+    batches = iter_batches(lines, STREAM_BATCH_SIZE)
+    # look up the first batch before responding, so that an overloaded
+    # worker can still refuse the request
+    try:
+        first_batch = await batches.__anext__()
+    except StopAsyncIteration:
+        first_batch = []
+    except zlib.error as e:
+        return JSONResponse({
+            'uris': f'Could not decompress the request body: {e}'
+        }, status_code=400)
+
+    try:
+        first_results = await lookup_batch(first_batch, retry=False)
+    except Overloaded:
+        return service_unavailable()
+    except NotReady:
+        return not_ready()
+
+    async def stream_results() -> AsyncIterator[bytes]:
+        yield first_results
+        try:
+            async for batch in batches:
+                yield await lookup_batch(batch, retry=True)
+        except zlib.error as e:
+            # the response has already started, so the error ends the stream as its last line
+            yield join_object([('error', dumps(f'Could not decompress the request body: {e}'))]) + b'\n'
+
+    return StreamingResponse(stream_results(), media_type='application/x-ndjson')
+
+
+@app.route('/export', methods=['GET'])
+async def export(request: Request) -> Response:
+    """
+    Stream all clusters of the current snapshot as NDJSON or TSV (see same_thing.export),
+    gzip compressed if the client accepts it.
+
+    The clusters are read in a thread of their own, so lookups are not held up,
+    and the export stops when the client disconnects.
+    """
+    output_format = request.query_params.get('format', 'ndjson')
+    if output_format not in EXPORT_FORMATS:
+        return JSONResponse({
+            'format': f"`format` must be one of {', '.join(EXPORT_FORMATS)}."
+        }, status_code=400)
+
+    if not snapshots.ready:
+        return not_ready()
+
+    if not export_slots.acquire(blocking=False):
+        return JSONResponse({
+            'error': 'Too many exports are running, please retry later.'
+        }, status_code=503)
+
+    gzipped = 'gzip' in request.headers.get('accept-encoding', '')
+    return StreamingResponse(
+        stream_export(request, output_format, gzipped),
+        media_type=EXPORT_MEDIA_TYPES[output_format],
+        headers={'Content-Encoding': 'gzip'} if gzipped else {},
+    )
+
+
+async def stream_export(request: Request, output_format: str, gzipped: bool) -> AsyncIterator[bytes]:
+    """
+    Read the chunks of the export in a thread, and stop early when the client disconnects.
+
+    :return: async generator of chunks of the export, which releases its snapshot
+        and its export slot when it is done
+    """
+    try:
+        with snapshots.connection() as snapshot:
+            chunks = iter_export(snapshot.layout, output_format)
+            if gzipped:
+                chunks = gzip_chunks(chunks)
+            reading = None
+            try:
+                while not await request.is_disconnected():
+                    reading = export_executor.submit(next, chunks, None)
+                    chunk = await asyncio.wrap_future(reading)
+                    if chunk is None:
+                        break
+                    yield chunk
+            finally:
+                if reading is not None and not reading.done():
+                    # the snapshot cannot be released while its thread still reads from it
+                    await asyncio.wait([asyncio.wrap_future(reading)])
+    finally:
+        export_slots.release()
+
+
+async def lookup_batch(batch: List[Union[str, LineTooLong]], retry: bool) -> bytes:
+    """
+    Look up a batch of streamed URIs, and serialize each result in input order.
+
+    :param batch: URIs, or errors for lines that could not be read
+    :param retry: wait for the lookup executor instead of raising Overloaded
+    :return: newline-delimited JSON, one line per item in the batch
+    """
+    uris = [item for item in batch if isinstance(item, str)]
+    clusters_by_uri: Dict[str, Optional[CachedCluster]] = {}
+    while uris:
         try:
-            fields_by_uri[uri] = get_cluster(uri)
-        except UriNotFound:
-            fields_by_uri[uri] = None
+            clusters_by_uri = await lookup_executor.run(lookup_clusters, uris)
+            break
+        except Overloaded:
+            if not retry:
+                raise
+            # the response has already started, so it can only be delayed
+            await asyncio.sleep(RETRY_AFTER_SECONDS)
+
+    result_lines = []
+    for item in batch:
+        if isinstance(item, LineTooLong):
+            result_lines.append(join_object([('error', dumps(str(item)))]))
+            continue
+
+        # each line is an entry of the `uris` object of a lookup response
+        cluster = clusters_by_uri.get(item)
+        result_lines.append(join_object([(item, cluster.json if cluster else None)]))
+
+    return b''.join(line + b'\n' for line in result_lines)
+
+
+def parse_uris(body: bytes, content_type: str) -> List[str]:
+    if content_type.startswith('application/json'):
+        parsed = json.loads(body)
+        if isinstance(parsed, dict):
+            parsed = parsed.get('uris')
+        if not isinstance(parsed, list) or not all(isinstance(uri, str) for uri in parsed):
+            raise ValueError('expected a list of URI strings')
+        uris = parsed
+    else:
+        uris = body.decode('utf8').splitlines()
+
+    # keep the input order, but look up each URI once
+    return list(dict.fromkeys(uri.strip() for uri in uris if uri.strip()))
+
+
+def parse_member_filter(query_params: QueryParams) -> MemberFilter:
+    """
+    Read which members of each cluster to return from the query parameters:
+    - `members=off`: only the global ID
+    - `host` and `locale` (repeatable): members of which the local IRI has one of these hosts,
+      or is in the DBpedia chapter of one of these locales
+    - `limit` and `cursor`: at most `limit` members, after the `next_cursor` of the previous page
+    - `count=on`: the number of (matching) members
+
+    :raise ValueError: if an option has an invalid value
+    """
+    hosts = set(query_params.getlist('host'))
+    hosts.update(get_locale_host(locale) for locale in query_params.getlist('locale'))
+    limit = parse_int_param(query_params, 'limit', minimum=1)
+    cursor = parse_int_param(query_params, 'cursor', minimum=0)
+    return MemberFilter(
+        members=query_params.get('members') != 'off',
+        hosts=frozenset(host.encode('utf8') for host in hosts if host),
+        limit=limit,
+        cursor=cursor or 0,
+        count_members=query_params.get('count') == 'on',
+    )
+
+
+def parse_int_param(query_params: QueryParams, name: str, minimum: int) -> Optional[int]:
+    value = query_params.get(name)
+    if value is None:
+        return None
 
-    response_fields: Dict[str, Any] = {}
-    if not any(fields_by_uri.values()):
+    if not value.isdigit() or int(value) < minimum:
+        raise ValueError(f'`{name}` must be an integer of at least {minimum}.')
+    return int(value)
+
+
+def lookup_response(
+        request: Request,
+        clusters_by_uri: Dict[str, Optional[CachedCluster]],
+        single_uri: Optional[str] = None,
+) -> Response:
+    """
+    Assemble the response body from serialized clusters and the serialized meta block.
+
+    The time this takes is reported in the `Server-Timing` header; clusters are
+    serialized before (and cached as such), which is measured as `serialize_cluster`.
+    """
+    if not any(clusters_by_uri.values()):
         if single_uri:
             return single_uri_not_found(single_uri)
         else:
-            return multiple_uris_not_found(uris)
-    elif single_uri:
-        response_fields = fields_by_uri[single_uri]
-    else:
-        response_fields['uris'] = fields_by_uri
+            return multiple_uris_not_found(list(clusters_by_uri))
 
+    started_at = time.perf_counter()
     meta = request.query_params.get('meta')
-    if not (meta and meta == 'off'):
-        response_fields['meta'] = {
-            'documentation': 'http://dev.dbpedia.org/Global%20IRI%20Resolution%20Service',
-            'github': 'https://github.com/dbpedia/dbp-same-thing-service',
-            'license': 'http://purl.org/NET/rdflicense/cc-by3.0',
-            'license_comment': 'Free service provided by DBpedia. Usage and republication of data implies that you '
-                               'attribute either http://dbpedia.org as the source or reference the latest general '
-                               'DBpedia paper or the specific paper mentioned in the GitHub Readme.',
-            'comment': """
-                The service resolves any IRI to its cluster and displays the global IRI and its cluster members.
-                Cluster members can change over time as the DBpedia community, 
-                data providers and professional services curate the linking space. 
-    
-                Usage note: 
-                1. Save the global ID AND the local IRI that seems most appropriate. 
-                   It is recommended that you become a data provider, in which case the local IRI would be your IRI.  
-                2. Use the global ID to access anything DBpedia.
-                3. Use the stored local ID to update and re-validate linking and clusters.
-            """,
-        }
+    meta_fields = [] if (meta and meta == 'off') else [('meta', META_JSON)]
+    single_cluster = clusters_by_uri.get(single_uri) if single_uri else None
+    if single_cluster:
+        body = extend_object(single_cluster.json, meta_fields)
+    else:
+        uris_json = join_object(
+            (uri, cluster.json if cluster else None)
+            for uri, cluster in clusters_by_uri.items()
+        )
+        body = join_object([('uris', uris_json)] + meta_fields)
 
-    return JSONResponse(response_fields)
+    assemble_seconds = time.perf_counter() - started_at
+    LOOKUP_STAGE_SECONDS.observe(assemble_seconds, stage='assemble_response')
+    assemble_ms = 1000 * assemble_seconds
+    return Response(
+        body,
+        media_type='application/json',
+        headers={'Server-Timing': f'assemble;dur={assemble_ms:.3f}'},
+    )
 
 
 def single_uri_not_found(uri: str) -> JSONResponse:
@@ -88,3 +506,16 @@ def multiple_uris_not_found(uris: List[str]) -> JSONResponse:
     return JSONResponse({
         'uris': uris
     }, status_code=404)
+
+
+def service_unavailable() -> JSONResponse:
+    return JSONResponse({
+        'error': 'Too many lookups are pending, please retry later.'
+    }, status_code=503, headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+
+
+def not_ready() -> JSONResponse:
+    return JSONResponse({
+        'ready': False,
+        'error': 'No snapshot has been opened yet, please retry later.'
+    }, status_code=503, headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
@@ -0,0 +1,133 @@
+import heapq
+import os
+from itertools import groupby
+
+from same_thing.uris import get_aliases
+
+# sort records as `key \t tag \t value` lines, in which the tag tells
+# cluster members apart from pointers to a cluster (from a local IRI, a singleton ID or an alias)
+ALIAS_TAG = b'a'
+MEMBER_TAG = b'm'
+POINTER_TAG = b'p'
+SINGLETON_TAG = b's'
+RUN_SIZE = 500000
+MAX_MERGE_FANIN = 256
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+UNCHANGED = 'unchanged'
+CHANGES = (ADDED, CHANGED, REMOVED, UNCHANGED)
+
+
+def get_run_path(sort_dir, run_index, merge_pass=0):
+    return os.path.join(sort_dir, f'run_{merge_pass:02d}_{run_index:06d}.tsv')
+
+
+def write_sorted_run(split_lines, run_path, member_separator, aliases=False):
+    """
+    Turn split snapshot lines into records, and write them to a sorted run file.
+
+    Sorting is done on whole record lines, which keeps the records of
+    each key together, even though it is not strictly the key order.
+
+    :param split_lines: list of (local_iri, singleton_id, cluster_id) tuples
+    :param run_path: file to write the sorted records to
+    :param member_separator: separates the singleton ID from the local IRI
+    :param aliases: whether to add pointers from the aliases of each line (see same_thing.uris)
+    :return: run_path
+    """
+    records = []
+    for local_iri, singleton_id, cluster_id in split_lines:
+        records.append(b'\t'.join(
+            (cluster_id, MEMBER_TAG, singleton_id + member_separator + local_iri)
+        ))
+        records.append(b'\t'.join((local_iri, POINTER_TAG, cluster_id)))
+        if not singleton_id == cluster_id:
+            records.append(b'\t'.join((singleton_id, SINGLETON_TAG, cluster_id)))
+        if aliases:
+            records.extend(
+                b'\t'.join((alias, ALIAS_TAG, cluster_id))
+                for alias in get_aliases(local_iri, singleton_id, cluster_id)
+            )
+
+    records.sort()
+    with open(run_path, 'wb') as run_file:
+        run_file.write(b'\n'.join(records))
+        run_file.write(b'\n')
+
+    return run_path
+
+
+def merge_runs(run_paths, merged_path):
+    """
+    Merge sorted run files into a single sorted run, and remove the inputs.
+    """
+    run_files = [open(run_path, 'rb') for run_path in run_paths]
+    try:
+        with open(merged_path, 'wb') as merged_file:
+            merged_file.writelines(heapq.merge(*run_files))
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+    for run_path in run_paths:
+        os.remove(run_path)
+
+    return merged_path
+
+
+def iter_grouped_records(run_paths):
+    """
+    Merge sorted runs and group their records by key.
+
+    At most MAX_MERGE_FANIN runs should be passed, to stay well within
+    the limit of open files.
+
+    :param run_paths: paths of sorted run files
+    :return: generator of (key, tag, values) with unique values in sorted order
+    """
+    run_files = [open(run_path, 'rb') for run_path in run_paths]
+    try:
+        records = (
+            line.rstrip(b'\n').split(b'\t', 2)
+            for line in heapq.merge(*run_files)
+        )
+        for (key, tag), group in groupby(records, key=lambda r: (r[0], r[1])):
+            values = []
+            for _, _, value in group:
+                if not values or values[-1] != value:
+                    values.append(value)
+            yield key, tag, values
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def iter_delta(old_items, new_items):
+    """
+    Compare two streams of (key, value) items, which are both sorted by key.
+
+    Keys that repeat or are out of order in `new_items` are reported as added,
+    so that applying the changes in order still yields the new items.
+
+    :param old_items: iterable of (key, value) items
+    :param new_items: iterable of (key, value) items
+    :return: generator of (change, key, value), in which change is one of
+        CHANGES, and value is None for removed keys
+    """
+    old_items = iter(old_items)
+    old = next(old_items, None)
+    for key, value in new_items:
+        while old is not None and old[0] < key:
+            yield REMOVED, old[0], None
+            old = next(old_items, None)
+
+        if old is not None and old[0] == key:
+            yield (UNCHANGED if old[1] == value else CHANGED), key, value
+            old = next(old_items, None)
+        else:
+            yield ADDED, key, value
+
+    while old is not None:
+        yield REMOVED, old[0], None
+        old = next(old_items, None)
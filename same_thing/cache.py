@@ -0,0 +1,108 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(obj):
+    """
+    Estimate the memory footprint of (nested) strings, bytes and containers.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    elif isinstance(obj, (tuple, list)):
+        size += sum(estimate_size(item) for item in obj)
+
+    return size
+
+
+class LRUCache:
+    """
+    Thread-safe LRU mapping that is bounded by the estimated size of its entries.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, _ = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        entry_size = estimate_size(key) + estimate_size(value)
+        if entry_size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, entry_size)
+            self.current_bytes += entry_size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class ClusterCache:
+    """
+    Caches lookup results of a single snapshot.
+
+    Normalized URI keys map to cluster IDs, which map to decoded clusters,
+    so that a cluster is cached once for all URIs that belong to it.
+    URI keys that were not found are kept in a separate negative cache.
+    """
+
+    def __init__(self, max_bytes, not_found_max_bytes):
+        uri_max_bytes = max_bytes // 4
+        self.cluster_ids = LRUCache(uri_max_bytes)
+        self.clusters = LRUCache(max_bytes - uri_max_bytes)
+        self.not_found = LRUCache(not_found_max_bytes)
+
+    def invalidate(self):
+        """
+        Clear all entries; this must be called when the snapshot changes.
+        """
+        self.cluster_ids.clear()
+        self.clusters.clear()
+        self.not_found.clear()
+
+    def stats(self):
+        return {
+            'cluster_ids': self.cluster_ids.stats(),
+            'clusters': self.clusters.stats(),
+            'not_found': self.not_found.stats(),
+        }
@@ -0,0 +1,18 @@
+import multiprocessing
+import os
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+
+    return value.lower() not in ('0', 'false', 'no', 'off')
+
+
+HTTP_WORKERS = env_int('SAME_THING_HTTP_WORKERS', min(4, multiprocessing.cpu_count()))
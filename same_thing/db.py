@@ -1,19 +1,39 @@
 import os
 import shutil
 import time
+from typing import Tuple
 
 import rocksdb
 from rocksdb import CompressionType, BackupEngine
 from rocksdb.interfaces import AssociativeMergeOperator
 
-DB_ROOT_PATH = '/dbdata'
+from same_thing.config import env_int, env_bool, HTTP_WORKERS
+
+DB_ROOT_PATH = os.environ.get('SAME_THING_DB_ROOT_PATH', '/dbdata')
 BACKUP_PATH = os.path.join(DB_ROOT_PATH, 'backups')
 DATA_DB_PREFIX = 'snapshot_'
+# a static index of a data DB (see same_thing.static) is a file next to it
+STATIC_INDEX_SUFFIX = '.static'
 SEPARATOR = b'<>'
 SINGLETON_LOCAL_SEPARATOR = b'||'
-
+# base58 IDs and IRIs never start with a NUL byte
+FINALISED_MARKER = b'\x00'
+# column families of the compact layout (see same_thing.layout)
+LOCALS_CF = b'locals'
+SINGLETONS_CF = b'singletons'
+CLUSTERS_CF = b'clusters'
+COMPACT_COLUMN_FAMILIES = (LOCALS_CF, SINGLETONS_CF, CLUSTERS_CF)
+
+
+BLOCK_SIZE_KB = env_int('SAME_THING_BLOCK_SIZE_KB', 16)
+BLOOM_BITS_PER_KEY = env_int('SAME_THING_BLOOM_BITS_PER_KEY', 10)
+# the block cache of all http workers together
+SERVING_BLOCK_CACHE_MB = env_int('SAME_THING_BLOCK_CACHE_MB', 1024)
+SERVING_MMAP_READS = env_bool('SAME_THING_MMAP_READS', True)
+SERVING_MAX_OPEN_FILES = env_int('SAME_THING_MAX_OPEN_FILES', -1)
 
 backupper = BackupEngine(BACKUP_PATH)
+serving_block_cache = None
 
 
 def get_db_path(db_name):
@@ -29,13 +49,62 @@ def get_data_db_name(snapshot_name):
     return DATA_DB_PREFIX + snapshot_name
 
 
-def get_connection(db_name, db_options=None, read_only=True):
+def get_static_index_path(db_name):
+    return get_db_path(db_name) + STATIC_INDEX_SUFFIX
+
+
+def remove_static_index(db_name):
+    index_path = get_static_index_path(db_name)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+
+def get_connection(db_name, db_options=None, read_only=True, column_family_names=None):
+    """
+    :param column_family_names: column families to open (and create) besides
+        the default one; by default those that exist in the DB are opened
+    """
     db_path = get_db_path(db_name)
 
     if db_options is None:
         db_options = get_rocksdb_options()
 
-    return rocksdb.DB(db_path, db_options, read_only=read_only)
+    if column_family_names is None:
+        column_family_names = list_column_families(db_path, db_options)
+
+    if not column_family_names:
+        # without the column family API, which python-rocksdb 0.7.0 does not have
+        return rocksdb.DB(db_path, db_options, read_only=read_only)
+
+    if not supports_column_families():
+        raise RuntimeError(
+            f'{db_path} has (or needs) column families, which this python-rocksdb release does not support'
+        )
+
+    db_options.create_missing_column_families = True
+    column_families = {
+        name: get_column_family_options(name, db_options)
+        for name in column_family_names
+    }
+    return rocksdb.DB(db_path, db_options, column_families=column_families, read_only=read_only)
+
+
+def supports_column_families():
+    return hasattr(rocksdb, 'list_column_families')
+
+
+def list_column_families(db_path, db_options=None):
+    """
+    :return: the names of the column families in a DB, other than the default one
+    """
+    if not os.path.exists(os.path.join(db_path, 'CURRENT')) or not supports_column_families():
+        # the DB does not exist yet, or cannot have been written with column families
+        return []
+
+    return [
+        name for name in rocksdb.list_column_families(db_path, db_options or rocksdb.Options())
+        if name != b'default'
+    ]
 
 
 def get_connection_to_latest(max_retries=0, retry=0, **kwargs):
@@ -83,6 +152,7 @@ def purge_data_dbs(keep_n_latest=1):
         for db_path in dbs_by_mtime[keep_n_latest:]:
             print(f'Deleting old DB {db_path}', flush=True)
             shutil.rmtree(db_path)
+            remove_static_index(db_path)
 
 
 def split_values(value_bytes):
@@ -94,31 +164,136 @@ def split_values(value_bytes):
 
 
 def is_cluster_membership(value_bytes):
-    return SINGLETON_LOCAL_SEPARATOR in value_bytes
+    return (
+        is_finalised_cluster(value_bytes)
+        or SINGLETON_LOCAL_SEPARATOR in value_bytes
+    )
+
+
+def is_finalised_cluster(value_bytes):
+    return value_bytes[:1] == FINALISED_MARKER
 
 
 def sorted_cluster(value_bytes):
-    values = split_values(value_bytes)
-    sorted_values = sorted(
-        values,
-        key=lambda t: (len(t[0]), t[0])
-    )
-    singletons, local_ids = zip(*sorted_values)
+    if is_finalised_cluster(value_bytes):
+        # members of a finalised cluster are already unique and sorted
+        members = list(iter_cluster(value_bytes))
+    else:
+        members = sorted(
+            set(map(tuple, split_values(value_bytes))),
+            key=member_sort_key
+        )
+    singletons, local_ids = zip(*members)
     return singletons, local_ids
 
 
+def member_sort_key(member):
+    singleton = member[0]
+    return len(singleton), singleton
+
+
+def encode_varint(number: int) -> bytes:
+    encoded = bytearray()
+    while number >= 0x80:
+        encoded.append((number & 0x7F) | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def decode_varint(value_bytes: bytes, position: int) -> Tuple[int, int]:
+    number = 0
+    shift = 0
+    while True:
+        byte = value_bytes[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def finalise_members(member_values):
+    """
+    Encode cluster members once: deduplicated, sorted, and length-prefixed.
+
+    The encoded value starts with FINALISED_MARKER and the number of members,
+    followed by the length-prefixed singleton ID and local IRI of each member.
+
+    :param member_values: iterable of `singleton_id || local_iri` bytes
+    :return: encoded cluster value
+    """
+    members = sorted(
+        {tuple(value.split(SINGLETON_LOCAL_SEPARATOR, 1)) for value in member_values},
+        key=member_sort_key
+    )
+    encoded = [FINALISED_MARKER, encode_varint(len(members))]
+    for singleton, local_iri in members:
+        encoded.extend((
+            encode_varint(len(singleton)), singleton,
+            encode_varint(len(local_iri)), local_iri,
+        ))
+    return b''.join(encoded)
+
+
+def finalise_cluster(value_bytes):
+    return finalise_members(value_bytes.split(SEPARATOR))
+
+
+def get_cluster_size(value_bytes: bytes) -> int:
+    if is_finalised_cluster(value_bytes):
+        return decode_varint(value_bytes, 1)[0]
+    return len(set(value_bytes.split(SEPARATOR)))
+
+
+def iter_cluster(value_bytes):
+    """
+    Decode the members of a finalised cluster in their stored order.
+
+    :param value_bytes: encoded cluster value
+    :return: generator of (singleton_id, local_iri) strings
+    """
+    member_count, position = decode_varint(value_bytes, 1)
+    for _ in range(member_count):
+        length, position = decode_varint(value_bytes, position)
+        singleton = value_bytes[position:position + length].decode('utf8')
+        position += length
+        length, position = decode_varint(value_bytes, position)
+        local_iri = value_bytes[position:position + length].decode('utf8')
+        position += length
+        yield singleton, local_iri
+
+
 class StringAddOperator(AssociativeMergeOperator):
+    """
+    Append cluster members while loading; duplicates are removed when
+    clusters are finalised after loading.
+    """
     def merge(self, key, existing_value, value):
-        new_value = existing_value or value
-        if existing_value and value not in existing_value:
-            new_value = existing_value + SEPARATOR + value
+        if existing_value:
+            return True, existing_value + SEPARATOR + value
 
-        return True, new_value
+        return True, value
 
     def name(self):
         return b'StringAddOperator'
 
 
+class ConcatenateOperator(AssociativeMergeOperator):
+    """
+    Append the self-delimiting cluster members of the compact layout while
+    loading; duplicates are removed when clusters are finalised after loading.
+    """
+    def merge(self, key, existing_value, value):
+        if existing_value:
+            return True, existing_value + value
+
+        return True, value
+
+    def name(self):
+        return b'ConcatenateOperator'
+
+
 def get_rocksdb_options():
     rocks_options = rocksdb.Options()
     rocks_options.create_if_missing = True
@@ -134,16 +309,100 @@ def get_rocksdb_options():
     # we want to set this option, but it's not included in the python client
     # rocks_options.optimize_filters_for_hits = True
 
-    rocks_options.table_factory = rocksdb.BlockBasedTableFactory(
-        block_cache=rocksdb.LRUCache(1 * 1024**3),
-        block_size=16 * 1024,
-        filter_policy=rocksdb.BloomFilterPolicy(10),
-    )
+    rocks_options.table_factory = get_table_factory(rocksdb.LRUCache(1 * 1024**3))
     return rocks_options
 
 
+def get_serving_options():
+    """
+    Options for the read-only connections of the http workers.
+
+    The block cache is shared by all connections (and column families) in a
+    worker, and is sized as a share of the cache budget of the whole host.
+    """
+    rocks_options = rocksdb.Options()
+    # unmerged operands may be read while a snapshot is being loaded
+    rocks_options.merge_operator = StringAddOperator()
+    rocks_options.max_open_files = SERVING_MAX_OPEN_FILES
+    rocks_options.allow_mmap_reads = SERVING_MMAP_READS
+    rocks_options.max_log_file_size = 4 * 1024**2
+    rocks_options.keep_log_file_num = 10
+    rocks_options.table_factory = get_table_factory(get_serving_block_cache())
+    return rocks_options
+
+
+def get_column_family_options(name, db_options):
+    """
+    Options of a column family, which shares the table factory (and thereby
+    the block cache) of the DB.
+    """
+    cf_options = rocksdb.ColumnFamilyOptions()
+    cf_options.compression = db_options.compression
+    cf_options.write_buffer_size = db_options.write_buffer_size
+    cf_options.max_write_buffer_number = db_options.max_write_buffer_number
+    cf_options.target_file_size_base = db_options.target_file_size_base
+    cf_options.table_factory = db_options.table_factory
+    if name == CLUSTERS_CF:
+        cf_options.merge_operator = ConcatenateOperator()
+
+    return cf_options
+
+
+def get_serving_block_cache():
+    global serving_block_cache
+    if serving_block_cache is None:
+        worker_share = SERVING_BLOCK_CACHE_MB * 1024**2 // HTTP_WORKERS
+        serving_block_cache = rocksdb.LRUCache(worker_share)
+
+    return serving_block_cache
+
+
+def get_table_factory(block_cache):
+    # the block size and the bloom filter are stored in the SST files when
+    # they are written by the loader, and are therefore used by every reader
+    return rocksdb.BlockBasedTableFactory(
+        block_cache=block_cache,
+        block_size=BLOCK_SIZE_KB * 1024,
+        filter_policy=rocksdb.BloomFilterPolicy(BLOOM_BITS_PER_KEY),
+    )
+
+
+def copy_db(source_name, target_name):
+    """
+    Copy a DB that is not being written to, by hard-linking its SST files.
+
+    SST files are never modified, so they can be shared by both DBs;
+    the other (mutable) files are copied.
+    """
+    source_path = get_db_path(source_name)
+    target_path = get_db_path(target_name)
+    os.makedirs(target_path)
+    for file_name in os.listdir(source_path):
+        link_or_copy(os.path.join(source_path, file_name), os.path.join(target_path, file_name))
+
+
+def link_or_copy(source_file, target_file):
+    """
+    Hard-link an SST file, or copy any other (mutable) file of a DB.
+
+    :return: whether the file was linked
+    """
+    if source_file.endswith('.sst'):
+        try:
+            os.link(source_file, target_file)
+            return True
+        except OSError:
+            # e.g. on another file system: fall back to a copy
+            pass
+
+    shutil.copy2(source_file, target_file)
+    return False
+
+
 def replace_db(db_name, temporary_name):
     old_db_path = get_db_path(db_name)
     new_db_path = get_db_path(temporary_name)
     shutil.rmtree(old_db_path)
+    # the static index of the old DB is outdated
+    remove_static_index(db_name)
     os.replace(new_db_path, old_db_path)
@@ -0,0 +1,139 @@
+import bz2
+
+# bzip2 blocks are not byte-aligned: each one starts with this 48-bit magic
+# (the BCD digits of pi) at an arbitrary bit offset, and each stream ends
+# with the end-of-stream magic (sqrt(pi)), followed by the combined CRC.
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+CRC_BITS = 32
+# a block header with the largest block size allows any block to be decoded
+STREAM_HEADER = b'BZh9'
+SCAN_WINDOW = 16 * 1024**2
+
+
+def get_magic_patterns(magic):
+    """
+    Describe a 48-bit magic at each of the eight possible bit alignments.
+
+    Every alignment fits in a 7-byte window, in which the middle 5 bytes are
+    fully determined by the magic. Those bytes can be found with a fast
+    substring search, after which the whole window is verified with a mask.
+
+    :param magic: 48-bit integer
+    :return: list of (bit_shift, core_bytes, window_value, window_mask)
+    """
+    patterns = []
+    for shift in range(8):
+        offset = 56 - MAGIC_BITS - shift
+        window_value = magic << offset
+        window_mask = ((1 << MAGIC_BITS) - 1) << offset
+        core_bytes = window_value.to_bytes(7, 'big')[1:6]
+        patterns.append((shift, core_bytes, window_value, window_mask))
+    return patterns
+
+
+BLOCK_PATTERNS = get_magic_patterns(BLOCK_MAGIC)
+EOS_PATTERNS = get_magic_patterns(EOS_MAGIC)
+
+
+def find_magic(buffer, patterns, start, end):
+    """
+    Find the bit offsets of a magic that starts within buffer[start:end].
+    """
+    buffer_size = len(buffer)
+    bit_offsets = []
+    for shift, core_bytes, window_value, window_mask in patterns:
+        position = buffer.find(core_bytes, start + 1, min(end + 5, buffer_size))
+        while position != -1:
+            window_start = position - 1
+            if window_start + 7 <= buffer_size:
+                window = int.from_bytes(buffer[window_start:window_start + 7], 'big')
+                if window & window_mask == window_value:
+                    bit_offsets.append(window_start * 8 + shift)
+            position = buffer.find(core_bytes, position + 1, min(end + 5, buffer_size))
+
+    return bit_offsets
+
+
+def is_end_of_stream(buffer, bit_offset):
+    """
+    Verify that an end-of-stream magic is followed by the CRC and padding,
+    and either by the end of the file or by the header of the next stream.
+    """
+    next_stream = (bit_offset + MAGIC_BITS + CRC_BITS + 7) // 8
+    if next_stream == len(buffer):
+        return True
+
+    next_header = buffer[next_stream:next_stream + 4]
+    return (
+        len(next_header) == 4
+        and next_header[:3] == b'BZh'
+        and next_header[3:] in b'123456789'
+    )
+
+
+def find_blocks(buffer, window_size=SCAN_WINDOW, start_bit=0):
+    """
+    Scan a (memory-mapped) bzip2 file and yield the bit range of each block.
+
+    A block ends where the next block or the end of its stream begins. The
+    block magic is not escaped in the compressed data, so rarely a range may
+    be delimited by a false positive, which makes it fail to decompress.
+
+    :param buffer: bytes-like object that supports `find`, e.g. an mmap
+    :param window_size: number of bytes to scan at a time
+    :param start_bit: bit offset of the first block to yield, e.g. to resume reading
+    :return: generator of (start_bit, end_bit) tuples
+    """
+    block_start = None
+    for window_start in range(start_bit // 8, len(buffer), window_size):
+        window_end = window_start + window_size
+        markers = [
+            (bit_offset, True)
+            for bit_offset in find_magic(buffer, BLOCK_PATTERNS, window_start, window_end)
+        ] + [
+            (bit_offset, False)
+            for bit_offset in find_magic(buffer, EOS_PATTERNS, window_start, window_end)
+            if is_end_of_stream(buffer, bit_offset)
+        ]
+        for bit_offset, starts_block in sorted(markers):
+            if bit_offset < start_bit:
+                continue
+            if block_start is not None:
+                yield block_start, bit_offset
+            block_start = bit_offset if starts_block else None
+
+    if block_start is not None:
+        # the file is truncated, decompression of this block will fail
+        yield block_start, len(buffer) * 8
+
+
+def decompress_block(file_path, start_bit, end_bit):
+    """
+    Decompress a single block by wrapping it in a stream of its own.
+
+    The block is shifted to a byte boundary and followed by an end-of-stream
+    marker. The combined CRC of a single-block stream equals its block CRC,
+    which is stored right after the block magic.
+
+    :param file_path: path of the bzip2 file
+    :param start_bit: bit offset of the block magic
+    :param end_bit: bit offset of the next block or end-of-stream magic
+    :return: decompressed bytes
+    """
+    first_byte, last_byte = start_bit // 8, (end_bit + 7) // 8
+    with open(file_path, 'rb') as f:
+        f.seek(first_byte)
+        raw_bytes = f.read(last_byte - first_byte)
+
+    block_bits = end_bit - start_bit
+    block = int.from_bytes(raw_bytes, 'big') >> (last_byte * 8 - end_bit)
+    block &= (1 << block_bits) - 1
+    block_crc = (block >> (block_bits - MAGIC_BITS - CRC_BITS)) & 0xFFFFFFFF
+
+    stream = (((block << MAGIC_BITS) | EOS_MAGIC) << CRC_BITS) | block_crc
+    stream_bits = block_bits + MAGIC_BITS + CRC_BITS
+    padding = -stream_bits % 8
+    stream_bytes = (stream << padding).to_bytes((stream_bits + padding) // 8, 'big')
+    return bz2.decompress(STREAM_HEADER + stream_bytes)
@@ -1,3 +1,11 @@
 
 class UriNotFound(Exception):
     pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class NotReady(Exception):
+    pass
@@ -0,0 +1,37 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from same_thing.exceptions import Overloaded
+
+
+class LookupExecutor:
+    """
+    Run blocking lookups in a dedicated thread pool, with admission control.
+
+    Lookups that arrive while `max_pending` lookups are already running or
+    waiting for a thread are refused, instead of queueing without limit.
+    """
+
+    def __init__(self, max_workers, max_pending):
+        assert max_pending >= max_workers, '`max_pending` should be at least `max_workers`'
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lookup')
+        self.max_pending = max_pending
+        # only modified from the event loop, so no lock is needed
+        self.pending = 0
+
+    async def run(self, func, *args, **kwargs):
+        if self.pending >= self.max_pending:
+            raise Overloaded(f'{self.pending} lookups are already pending')
+
+        loop = asyncio.get_event_loop()
+        future = self.pool.submit(func, *args, **kwargs)
+        self.pending += 1
+        # a cancelled request does not stop a running lookup, so it stays pending until its thread is done
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.lookup_done))
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def lookup_done(self):
+        self.pending -= 1
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,298 @@
+"""
+Export all clusters of a loaded snapshot, as sharded and compressed NDJSON or TSV.
+
+The keyspace of the clusters is split into ranges at the boundaries of the
+SST files of the data DB, so that each range holds about as much data.
+Every range is read with its own iterator, in its own process, and written
+to its own shard, so that decoding and compressing are spread over all cores.
+
+Each NDJSON line is a cluster as it is returned by a lookup. TSV lines have
+the columns of the upstream snapshot, grouped by cluster.
+"""
+import argparse
+import bz2
+import gzip
+import json
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Optional, Tuple
+
+from same_thing.config import env_int
+from same_thing.db import DB_ROOT_PATH, get_connection, get_data_db_name
+from same_thing.layout import COMPACT, ID_WIDTH, open_layout
+from same_thing.serialize import dumps
+from same_thing.source import print_with_timestamp
+from same_thing.uris import DBP_GLOBAL_MARKER, DBP_GLOBAL_PREFIX
+
+FORMATS = ('ndjson', 'tsv')
+MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'tsv': 'text/tab-separated-values'}
+COMPRESSIONS = ('gzip', 'bz2', 'none')
+EXTENSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'none': ''}
+TSV_HEADER = b'original_iri\tsingleton_id_base58\tcluster_id_base58\n'
+EXPORT_PATH = os.path.join(DB_ROOT_PATH, 'exports')
+EXPORT_WORKERS = multiprocessing.cpu_count()
+# more shards than workers, so that uneven ranges still keep every worker busy
+SHARD_COUNT = 4 * EXPORT_WORKERS
+COMPRESS_LEVEL = env_int('SAME_THING_EXPORT_COMPRESS_LEVEL', 6)
+CHUNK_BYTES = 4 * 1024**2
+MANIFEST_FILENAME = 'manifest.json'
+
+KeyRange = Tuple[Optional[bytes], Optional[bytes]]
+
+
+def could_be_cluster_id(layout, key: bytes) -> bool:
+    """
+    :return: whether a key can be a cluster ID, rather than e.g. a local IRI
+    """
+    if layout.name == COMPACT:
+        return len(key) == ID_WIDTH
+    # base58 IDs are alphanumeric
+    return key.isalnum()
+
+
+def get_key_ranges(data_db, layout, range_count: int) -> List[KeyRange]:
+    """
+    Split the keys of the clusters into ranges of about the same size,
+    at the smallest keys of the SST files of the DB.
+
+    :return: list of (start, end) keys, in which None stands for an open end
+    """
+    files = [
+        file_metadata for file_metadata in data_db.get_live_files_metadata()
+        if could_be_cluster_id(layout, file_metadata['smallestkey'])
+    ]
+    files.sort(key=lambda file_metadata: file_metadata['smallestkey'])
+    total_size = sum(file_metadata['size'] for file_metadata in files)
+
+    split_keys: List[bytes] = []
+    cumulative_size = 0
+    for file_metadata in files:
+        key = file_metadata['smallestkey']
+        if (
+                cumulative_size >= total_size * (len(split_keys) + 1) / range_count
+                and (not split_keys or key > split_keys[-1])
+        ):
+            split_keys.append(key)
+        cumulative_size += file_metadata['size']
+
+    starts: List[Optional[bytes]] = [None, *split_keys]
+    ends: List[Optional[bytes]] = [*split_keys, None]
+    return list(zip(starts, ends))
+
+
+def format_cluster(layout, cluster_id: bytes, value_bytes: bytes, output_format: str) -> bytes:
+    """
+    :return: the lines of a cluster in the output format
+    """
+    if output_format == 'tsv':
+        global_id = layout.get_global_id(cluster_id).encode('utf8')
+        return b''.join(
+            local_iri + b'\t' + layout.decode_singleton(singleton).encode('utf8') + b'\t' + global_id + b'\n'
+            for singleton, local_iri in layout.iter_members(value_bytes)
+        )
+
+    global_id, singletons, local_ids = layout.decode_cluster(cluster_id, value_bytes)
+    return dumps({
+        'global': f'{DBP_GLOBAL_PREFIX}{DBP_GLOBAL_MARKER}{global_id}',
+        'locals': local_ids,
+        'cluster': singletons,
+    }) + b'\n'
+
+
+def iter_export(
+        layout,
+        output_format: str,
+        start: Optional[bytes] = None,
+        end: Optional[bytes] = None,
+) -> Iterator[bytes]:
+    """
+    :return: generator of chunks of about CHUNK_BYTES, of the clusters in a range
+    """
+    if output_format == 'tsv':
+        yield TSV_HEADER
+
+    chunk = []
+    chunk_size = 0
+    for cluster_id, value_bytes in layout.iter_clusters(start, end):
+        lines = format_cluster(layout, cluster_id, value_bytes, output_format)
+        chunk.append(lines)
+        chunk_size += len(lines)
+        if chunk_size >= CHUNK_BYTES:
+            yield b''.join(chunk)
+            chunk = []
+            chunk_size = 0
+
+    if chunk:
+        yield b''.join(chunk)
+
+
+def gzip_chunks(chunks: Iterator[bytes], level: int = COMPRESS_LEVEL) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def open_shard(shard_path, compression):
+    if compression == 'gzip':
+        return gzip.open(shard_path, 'wb', compresslevel=COMPRESS_LEVEL)
+    elif compression == 'bz2':
+        return bz2.open(shard_path, 'wb', compresslevel=COMPRESS_LEVEL)
+    return open(shard_path, 'wb')
+
+
+def get_shard_filename(shard_index, output_format, compression):
+    return f'clusters-{shard_index:05d}.{output_format}{EXTENSIONS[compression]}'
+
+
+def export_range(db_name, shard_path, output_format, compression, start, end):
+    """
+    Write the clusters in a range of keys to a shard, in a worker process.
+
+    :return: dict that describes the shard
+    """
+    data_db = get_connection(db_name, read_only=True)
+    layout = open_layout(data_db)
+    line_count = 0
+    temporary_path = shard_path + '.tmp'
+    with open_shard(temporary_path, compression) as shard_file:
+        for chunk in iter_export(layout, output_format, start, end):
+            shard_file.write(chunk)
+            line_count += chunk.count(b'\n')
+    os.replace(temporary_path, shard_path)
+    if output_format == 'tsv':
+        # every shard starts with the header, which is not counted as a line
+        line_count -= 1
+
+    return {
+        'path': os.path.basename(shard_path),
+        'lines': line_count,
+        'bytes': os.path.getsize(shard_path),
+    }
+
+
+def remove_previous_export(output_dir):
+    """
+    Remove the shards of an earlier export to the same directory.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    for shard in manifest['shards']:
+        shard_path = os.path.join(output_dir, shard['path'])
+        if os.path.isfile(shard_path):
+            os.remove(shard_path)
+    os.remove(manifest_path)
+
+
+def export_clusters(db_name, output_dir, output_format='ndjson', compression='gzip',
+                    shard_count=SHARD_COUNT, workers=EXPORT_WORKERS):
+    """
+    Export all clusters of a data DB (in either layout) to shards in the output directory,
+    and describe them in its manifest.
+
+    :param db_name: name or path of the data DB
+    :param output_format: one of FORMATS
+    :param compression: one of COMPRESSIONS
+    :param shard_count: the maximum number of shards; fewer are written for a small DB
+    :param workers: the number of worker processes
+    :return: the manifest
+    """
+    assert output_format in FORMATS, f'`output_format` should be one of {FORMATS}'
+    assert compression in COMPRESSIONS, f'`compression` should be one of {COMPRESSIONS}'
+    started_at = time.monotonic()
+    data_db = get_connection(db_name, read_only=True)
+    key_ranges = get_key_ranges(data_db, open_layout(data_db), shard_count)
+    del data_db
+
+    os.makedirs(output_dir, exist_ok=True)
+    remove_previous_export(output_dir)
+    print_with_timestamp(f'Exporting the clusters of {db_name} to {len(key_ranges)} shards in {output_dir}')
+    shards = []
+    with ProcessPoolExecutor(
+            max_workers=max(1, min(workers, len(key_ranges))),
+            mp_context=multiprocessing.get_context('spawn'),
+    ) as pool:
+        exporting = [
+            pool.submit(
+                export_range,
+                db_name,
+                os.path.join(output_dir, get_shard_filename(shard_index, output_format, compression)),
+                output_format,
+                compression,
+                start,
+                end,
+            )
+            for shard_index, (start, end) in enumerate(key_ranges)
+        ]
+        for future in as_completed(exporting):
+            shards.append(future.result())
+            print_with_timestamp(f'Exported {len(shards)} of {len(key_ranges)} shards')
+
+    shards.sort(key=lambda shard: shard['path'])
+    manifest = {
+        'db': os.path.basename(db_name),
+        'format': output_format,
+        'compression': compression,
+        'lines': sum(shard['lines'] for shard in shards),
+        'shards': shards,
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    elapsed = time.monotonic() - started_at
+    print_with_timestamp(
+        f"Exported {manifest['lines']} lines in {elapsed:.0f} seconds "
+        f"({sum(shard['bytes'] for shard in shards) / 1024**2 / max(elapsed, 1e-3):.1f} MB/s written)"
+    )
+    return manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Export all clusters of a loaded snapshot, as sharded and compressed NDJSON or TSV.'
+    )
+    parser.add_argument(
+        'snapshot', nargs='?',
+        help='name of the snapshot, e.g. 2020.03.01 (default: the most recently completed snapshot)',
+    )
+    parser.add_argument(
+        '--output-dir',
+        help=f'directory to write the shards and their manifest to (default: {EXPORT_PATH}/<snapshot>)',
+    )
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='gzip')
+    parser.add_argument(
+        '--shards', type=int, default=SHARD_COUNT,
+        help='maximum number of key ranges, each of which is written to its own shard',
+    )
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS, help='number of worker processes')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from same_thing.snapshots import find_serving_db
+
+    args = parse_args()
+    if args.snapshot:
+        db_name = get_data_db_name(args.snapshot)
+    else:
+        db_name, _ = find_serving_db()
+    if db_name is None:
+        raise SystemExit(f'No DBs found in {DB_ROOT_PATH}')
+    export_clusters(
+        db_name,
+        args.output_dir or os.path.join(EXPORT_PATH, os.path.basename(db_name)),
+        output_format=args.format,
+        compression=args.compression,
+        shard_count=args.shards,
+        workers=args.workers,
+    )
@@ -0,0 +1,668 @@
+"""
+Storage layouts of a data DB.
+
+The `legacy` layout keeps pointers and clusters in a single keyspace, and
+tells them apart by their values. The `compact` layout keeps each record
+type in its own column family (see COMPACT_COLUMN_FAMILIES): local IRIs
+are stored with a dictionary code instead of their prefix, and base58 IDs
+as fixed-width binary numbers. Both layouts are looked up the same way,
+so lookups do not need to know how a snapshot was loaded.
+
+Either layout can also store pointers from the aliases of local IRIs and
+global IRIs (see same_thing.uris). Lookups in such a DB first look up
+each URI as it was given, with a single read, and only normalize the
+URIs that were not found.
+"""
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from same_thing.bulk import MEMBER_TAG, SINGLETON_TAG
+from same_thing.db import (
+    CLUSTERS_CF,
+    FINALISED_MARKER,
+    LOCALS_CF,
+    SEPARATOR,
+    SINGLETON_LOCAL_SEPARATOR,
+    SINGLETONS_CF,
+    decode_varint,
+    encode_varint,
+    finalise_cluster,
+    finalise_members,
+    get_cluster_size,
+    is_cluster_membership,
+    is_finalised_cluster,
+    member_sort_key,
+    sorted_cluster,
+)
+from same_thing.metrics import LOOKUP_STAGE_SECONDS
+from same_thing.uris import UriKey, get_alias_key, get_aliases, normalize_uri
+
+LEGACY = 'legacy'
+COMPACT = 'compact'
+LAYOUTS = (LEGACY, COMPACT)
+
+# the global ID, singleton IDs and local IRIs of a cluster
+DecodedCluster = Tuple[str, List[str], List[str]]
+
+BASE58_ALPHABET = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BASE58_VALUES = {char: value for value, char in enumerate(BASE58_ALPHABET)}
+# the number of characters, followed by the big-endian value of the ID;
+# encoded IDs sort like `member_sort_key`, i.e. by length, then base58 order
+ID_VALUE_BYTES = 8
+ID_WIDTH = 1 + ID_VALUE_BYTES
+# prefix codes of local IRIs are stored in the default column family;
+# code 0 stands for the empty prefix of IRIs that are stored in full
+PREFIX_KEY_PREFIX = b'\x00layout:prefix:'
+MAX_PREFIXES = 2 ** 16
+# present in the default column family of DBs that were loaded with aliases
+ALIASES_KEY = b'\x00layout:aliases'
+
+
+def has_aliases(db):
+    return db is not None and db.get(ALIASES_KEY) is not None
+
+
+def resolve_aliases(
+        uri_keys: Dict[str, UriKey],
+        get_pointers: Callable[[List[bytes]], Dict[bytes, Optional[bytes]]],
+) -> Dict[str, bytes]:
+    """
+    Look up URIs as they were given, and only normalize the URIs that were not found.
+
+    :param uri_keys: URI key (see `get_uri_key`) by URI
+    :param get_pointers: returns the cluster ID that each of a list of alias keys points to
+    :return: the cluster ID of each found URI
+    """
+    cluster_ids: Dict[str, bytes] = {}
+    with LOOKUP_STAGE_SECONDS.time(stage='get_alias'):
+        found_ids = get_pointers(list({key for _, key in uri_keys.values()}))
+
+    normalized_keys: Dict[str, bytes] = {}
+    for uri, (_, key) in uri_keys.items():
+        cluster_id = found_ids[key]
+        if cluster_id is not None:
+            cluster_ids[uri] = cluster_id
+        else:
+            alias_key = get_alias_key(normalize_uri(uri))
+            if alias_key != key:
+                normalized_keys[uri] = alias_key
+
+    if normalized_keys:
+        with LOOKUP_STAGE_SECONDS.time(stage='get_alias'):
+            found_ids = get_pointers(list(set(normalized_keys.values())))
+        for uri, key in normalized_keys.items():
+            cluster_id = found_ids[key]
+            if cluster_id is not None:
+                cluster_ids[uri] = cluster_id
+
+    return cluster_ids
+
+
+def get_layout_name(db):
+    # a connection without column families may not have `get_column_family`
+    get_column_family = getattr(db, 'get_column_family', None)
+    return COMPACT if get_column_family and get_column_family(CLUSTERS_CF) is not None else LEGACY
+
+
+def open_layout(db):
+    """
+    :param db: a connection to a data DB, with all of its column families
+    :return: LegacyLayout or CompactLayout, depending on how the DB was loaded
+    """
+    if get_layout_name(db) == COMPACT:
+        return CompactLayout(db)
+    return LegacyLayout(db)
+
+
+def encode_id(base58_id: bytes) -> bytes:
+    """
+    :raise ValueError: if the ID is not base58, or too large to encode
+    """
+    number = 0
+    try:
+        for char in base58_id:
+            number = number * 58 + BASE58_VALUES[char]
+    except KeyError:
+        raise ValueError(f'{base58_id!r} is not a base58 ID') from None
+
+    if not base58_id or len(base58_id) > 255 or number >> (8 * ID_VALUE_BYTES):
+        raise ValueError(f'{base58_id!r} does not fit in {ID_WIDTH} bytes')
+    return bytes((len(base58_id),)) + number.to_bytes(ID_VALUE_BYTES, 'big')
+
+
+def decode_id(encoded_id: bytes) -> bytes:
+    length = encoded_id[0]
+    number = int.from_bytes(encoded_id[1:ID_WIDTH], 'big')
+    chars = bytearray()
+    while number:
+        number, value = divmod(number, 58)
+        chars.append(BASE58_ALPHABET[value])
+    # leading zeroes are encoded by the length
+    chars.extend(BASE58_ALPHABET[:1] * (length - len(chars)))
+    chars.reverse()
+    return bytes(chars)
+
+
+def split_prefix(iri: bytes) -> Tuple[bytes, bytes]:
+    """
+    Split an IRI after the first segment of its path, e.g. into
+    `http://de.dbpedia.org/resource/` and `Berlin`, or after its host,
+    if the first segment is the whole remainder, e.g. `http://sws.geonames.org/`
+    and `2950159/`.
+
+    :return: (prefix, suffix), in which the prefix is empty for IRIs without a path
+    """
+    host_start = iri.find(b'://')
+    if host_start < 0:
+        return b'', iri
+
+    host_end = iri.find(b'/', host_start + 3)
+    if host_end < 0:
+        return b'', iri
+
+    segment_end = iri.find(b'/', host_end + 1)
+    if segment_end < 0 or segment_end == len(iri) - 1:
+        return iri[:host_end + 1], iri[host_end + 1:]
+    return iri[:segment_end + 1], iri[segment_end + 1:]
+
+
+class PrefixDictionary:
+    """
+    Codes for the prefixes of local IRIs, which are assigned while loading.
+
+    Once MAX_PREFIXES are assigned, IRIs with a new prefix are encoded with
+    the code of their host, if it has one, or are otherwise stored in full.
+    """
+
+    def __init__(self, prefixes: Iterable[bytes] = ()) -> None:
+        self.prefixes: List[bytes] = [b''] + list(prefixes)
+        self.codes: Dict[bytes, int] = {prefix: code for code, prefix in enumerate(self.prefixes)}
+        # codes that have not been written to the DB yet
+        self.added: List[int] = []
+
+    @classmethod
+    def read(cls, db):
+        keys = db.iterkeys()
+        keys.seek(PREFIX_KEY_PREFIX)
+        prefix_keys = []
+        for key in keys:
+            if not key.startswith(PREFIX_KEY_PREFIX):
+                break
+            prefix_keys.append(key)
+
+        # the keys sort by their big-endian codes
+        prefixes = db.multi_get(prefix_keys)
+        return cls(prefixes[key] for key in prefix_keys)
+
+    def write_added(self, write_batch):
+        """
+        Write the codes that were added since the last call, e.g. in the
+        same WriteBatch as the first IRIs that are encoded with them.
+        """
+        for code in self.added:
+            write_batch.put(get_prefix_key(code), self.prefixes[code])
+        self.added = []
+
+    def encode(self, iri: bytes, add: bool = False) -> bytes:
+        """
+        :param iri: local IRI
+        :param add: assign a code to a new prefix, if there are codes left
+        :return: the prefix code (as varint), followed by the rest of the IRI
+        """
+        prefix, suffix = split_prefix(iri)
+        code = self.codes.get(prefix)
+        if code is None:
+            if add and len(self.prefixes) < MAX_PREFIXES:
+                code = len(self.prefixes)
+                self.prefixes.append(prefix)
+                self.codes[prefix] = code
+                self.added.append(code)
+            else:
+                host_end = iri.find(b'/', iri.find(b'://') + 3)
+                code = self.codes.get(iri[:host_end + 1], 0) if host_end > 0 else 0
+                suffix = iri[len(self.prefixes[code]):]
+
+        return encode_varint(code) + suffix
+
+    def decode(self, encoded_iri: bytes) -> bytes:
+        code, position = decode_varint(encoded_iri, 0)
+        return self.prefixes[code] + encoded_iri[position:]
+
+
+def get_prefix_key(code):
+    return PREFIX_KEY_PREFIX + code.to_bytes(4, 'big')
+
+
+def iter_compact_members(value_bytes: bytes, position: int = 0) -> Iterator[bytes]:
+    """
+    :return: generator of the encoded members of a compact cluster value, from position on
+    """
+    while position < len(value_bytes):
+        length, iri_start = decode_varint(value_bytes, position + ID_WIDTH)
+        member_end = iri_start + length
+        yield value_bytes[position:member_end]
+        position = member_end
+
+
+def finalise_compact_cluster(value_bytes: bytes) -> bytes:
+    """
+    Deduplicate and sort the members of a compact cluster value once.
+
+    :return: FINALISED_MARKER and the number of members, followed by the
+        members, which sort by their singleton IDs as `member_sort_key` does
+    """
+    members = sorted(set(iter_compact_members(value_bytes)))
+    return FINALISED_MARKER + encode_varint(len(members)) + b''.join(members)
+
+
+class LegacyLayout:
+    """
+    Local IRIs and singleton IDs point to cluster IDs, and cluster IDs hold
+    the members of their cluster, all in the default column family.
+    """
+    name = LEGACY
+
+    def __init__(self, db):
+        self.db = db
+        self.has_aliases = has_aliases(db)
+
+    def enable_aliases(self):
+        """
+        Store pointers from the aliases of every line that is put from now on.
+        """
+        self.db.put(ALIASES_KEY, b'1')
+        self.has_aliases = True
+
+    def get_uri_key(self, uri: str) -> UriKey:
+        """
+        :return: the key with which a URI is looked up (and cached)
+        """
+        if self.has_aliases:
+            return False, uri.encode('utf8')
+        return normalize_uri(uri)
+
+    def put_line(self, write_batch, local_iri, singleton_id, cluster_id):
+        singleton_and_local = singleton_id + SINGLETON_LOCAL_SEPARATOR + local_iri
+        write_batch.merge(cluster_id, singleton_and_local)
+        if self.has_aliases:
+            for alias in get_aliases(local_iri, singleton_id, cluster_id):
+                write_batch.put(alias, cluster_id)
+        write_batch.put(local_iri, cluster_id)
+        if not singleton_id == cluster_id:
+            write_batch.put(singleton_id, cluster_id)
+
+    def put_record(self, write_batch, key, tag, values):
+        """
+        Put a record of sorted runs (see same_thing.bulk) with its grouped values.
+        """
+        if tag == MEMBER_TAG:
+            write_batch.put(key, finalise_members(values))
+        else:
+            write_batch.put(key, values[0])
+
+    def iter_finalised_clusters(self):
+        """
+        :return: generator of (key, value) of the clusters that were not finalised yet
+        """
+        items = self.db.iteritems()
+        items.seek_to_first()
+        for key, value in items:
+            if is_cluster_membership(value) and not is_finalised_cluster(value):
+                yield key, finalise_cluster(value)
+
+    def iter_clusters(self, start: Optional[bytes] = None, end: Optional[bytes] = None):
+        """
+        :param start: first key of the range to iterate over (default: the first key)
+        :param end: key after the range (default: after the last key)
+        :return: generator of (cluster_id, value) of all clusters in the range, in key order
+        """
+        items = self.db.iteritems()
+        if start is None:
+            items.seek_to_first()
+        else:
+            items.seek(start)
+        for key, value in items:
+            if end is not None and key >= end:
+                break
+            if is_cluster_membership(value):
+                yield key, value
+
+    def resolve_cluster_ids(
+            self,
+            uri_keys: Dict[str, UriKey],
+    ) -> Tuple[Dict[str, bytes], Dict[bytes, Optional[bytes]]]:
+        """
+        Follow the pointers from normalized URIs to the IDs of their clusters.
+
+        :param uri_keys: URI key (see `get_uri_key`) by URI
+        :return: the cluster ID of each found URI, and the fetched cluster values
+        """
+        if self.has_aliases:
+            return resolve_aliases(uri_keys, self.get_pointers), {}
+
+        lookup_ids: Dict[str, bytes] = {}
+        local_keys: Dict[str, bytes] = {}
+        for uri, (is_global, key) in uri_keys.items():
+            if is_global:
+                lookup_ids[uri] = key
+            else:
+                local_keys[uri] = key
+
+        # local IRI -> cluster ID
+        if local_keys:
+            with LOOKUP_STAGE_SECONDS.time(stage='get_local_iri'):
+                found_ids = self.db.multi_get(list(set(local_keys.values())))
+            for uri, key in local_keys.items():
+                if found_ids[key]:
+                    lookup_ids[uri] = found_ids[key]
+
+        # cluster ID -> cluster members, or singleton ID -> cluster ID
+        values: Dict[bytes, Optional[bytes]] = {}
+        if lookup_ids:
+            with LOOKUP_STAGE_SECONDS.time(stage='get_lookup_id'):
+                values = self.db.multi_get(list(set(lookup_ids.values())))
+        redirects = {
+            lookup_id: value
+            for lookup_id, value in values.items()
+            if value and not is_cluster_membership(value)
+        }
+        if redirects:
+            with LOOKUP_STAGE_SECONDS.time(stage='get_redirect'):
+                values.update(self.db.multi_get(list(set(redirects.values()))))
+
+        cluster_ids: Dict[str, bytes] = {}
+        for uri, lookup_id in lookup_ids.items():
+            cluster_id = redirects.get(lookup_id, lookup_id)
+            value_bytes = values.get(cluster_id)
+            if value_bytes and is_cluster_membership(value_bytes):
+                cluster_ids[uri] = cluster_id
+
+        return cluster_ids, values
+
+    def get_pointers(self, keys: List[bytes]) -> Dict[bytes, Optional[bytes]]:
+        """
+        :return: the cluster ID that each key points to, or None
+        """
+        values = self.db.multi_get(keys)
+        return {
+            # a cluster ID points to itself
+            key: key if value and is_cluster_membership(value) else value
+            for key, value in values.items()
+        }
+
+    def get_cluster_values(self, cluster_ids: List[bytes]) -> Dict[bytes, Optional[bytes]]:
+        with LOOKUP_STAGE_SECONDS.time(stage='get_cluster'):
+            values: Dict[bytes, Optional[bytes]] = self.db.multi_get(cluster_ids)
+        return values
+
+    def decode_cluster(self, cluster_id: bytes, value_bytes: Optional[bytes]) -> Optional[DecodedCluster]:
+        if not value_bytes or not is_cluster_membership(value_bytes):
+            return None
+
+        singletons, local_ids = sorted_cluster(value_bytes)
+        return cluster_id.decode('utf8'), list(singletons), list(local_ids)
+
+    def is_cluster(self, value_bytes: Optional[bytes]) -> bool:
+        return bool(value_bytes) and is_cluster_membership(value_bytes)
+
+    def get_global_id(self, cluster_id: bytes) -> str:
+        return cluster_id.decode('utf8')
+
+    def count_members(self, value_bytes: bytes) -> int:
+        return get_cluster_size(value_bytes)
+
+    def iter_members(self, value_bytes: bytes) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        Iterate over the members of a cluster in their returned order, without decoding them.
+
+        :return: generator of (singleton, local_iri), in which singleton is
+            decoded with `decode_singleton`
+        """
+        if not is_finalised_cluster(value_bytes):
+            members = sorted(set(
+                (singleton, local_iri)
+                for singleton, _, local_iri in (
+                    value.partition(SINGLETON_LOCAL_SEPARATOR) for value in value_bytes.split(SEPARATOR)
+                )
+            ), key=member_sort_key)
+            yield from members
+            return
+
+        member_count, position = decode_varint(value_bytes, 1)
+        for _ in range(member_count):
+            length, position = decode_varint(value_bytes, position)
+            singleton = value_bytes[position:position + length]
+            position += length
+            length, position = decode_varint(value_bytes, position)
+            yield singleton, value_bytes[position:position + length]
+            position += length
+
+    def decode_singleton(self, singleton: bytes) -> str:
+        return singleton.decode('utf8')
+
+
+class CompactLayout:
+    """
+    Local IRIs point to cluster IDs in the `locals` column family, singleton
+    IDs that differ from their cluster ID in `singletons`, and cluster IDs
+    hold the members of their cluster in `clusters`. Aliases are stored like
+    local IRIs.
+
+    A member is the encoded singleton ID, followed by the length-prefixed
+    encoded local IRI, so that members can be appended while loading.
+    """
+    name = COMPACT
+
+    def __init__(self, db):
+        self.db = db
+        self.locals_cf = db.get_column_family(LOCALS_CF)
+        self.singletons_cf = db.get_column_family(SINGLETONS_CF)
+        self.clusters_cf = db.get_column_family(CLUSTERS_CF)
+        self.prefixes = PrefixDictionary.read(db)
+        self.has_aliases = has_aliases(db)
+
+    def enable_aliases(self):
+        """
+        Store pointers from the aliases of every line that is put from now on.
+        """
+        self.db.put(ALIASES_KEY, b'1')
+        self.has_aliases = True
+
+    def get_uri_key(self, uri: str) -> UriKey:
+        """
+        :return: the key with which a URI is looked up (and cached)
+        """
+        if self.has_aliases:
+            return False, uri.encode('utf8')
+        return normalize_uri(uri)
+
+    @staticmethod
+    def encode_member(encoded_singleton, encoded_iri):
+        return encoded_singleton + encode_varint(len(encoded_iri)) + encoded_iri
+
+    def put_line(self, write_batch, local_iri, singleton_id, cluster_id):
+        """
+        :raise ValueError: if an ID cannot be encoded, before anything is put
+        """
+        encoded_cluster = encode_id(cluster_id)
+        encoded_singleton = encode_id(singleton_id)
+        encoded_iri = self.prefixes.encode(local_iri, add=True)
+        write_batch.merge((self.clusters_cf, encoded_cluster), self.encode_member(encoded_singleton, encoded_iri))
+        if self.has_aliases:
+            for alias in get_aliases(local_iri, singleton_id, cluster_id):
+                write_batch.put((self.locals_cf, self.prefixes.encode(alias, add=True)), encoded_cluster)
+        write_batch.put((self.locals_cf, encoded_iri), encoded_cluster)
+        if not singleton_id == cluster_id:
+            write_batch.put((self.singletons_cf, encoded_singleton), encoded_cluster)
+        # codes are committed with the first IRIs that use them
+        self.prefixes.write_added(write_batch)
+
+    def put_record(self, write_batch, key, tag, values):
+        """
+        Put a record of sorted runs (see same_thing.bulk) with its grouped values.
+
+        :raise ValueError: if an ID cannot be encoded, before anything is put
+        """
+        if tag == MEMBER_TAG:
+            members = []
+            for value in values:
+                singleton_id, local_iri = value.split(SINGLETON_LOCAL_SEPARATOR, 1)
+                members.append(self.encode_member(
+                    encode_id(singleton_id), self.prefixes.encode(local_iri, add=True)
+                ))
+            write_batch.put((self.clusters_cf, encode_id(key)), finalise_compact_cluster(b''.join(members)))
+        elif tag == SINGLETON_TAG:
+            write_batch.put((self.singletons_cf, encode_id(key)), encode_id(values[0]))
+        else:
+            write_batch.put((self.locals_cf, self.prefixes.encode(key, add=True)), encode_id(values[0]))
+        self.prefixes.write_added(write_batch)
+
+    def iter_finalised_clusters(self):
+        """
+        :return: generator of (key, value) of the clusters that were not finalised yet
+        """
+        items = self.db.iteritems(self.clusters_cf)
+        items.seek_to_first()
+        for (_, key), value in items:
+            if not is_finalised_cluster(value):
+                yield (self.clusters_cf, key), finalise_compact_cluster(value)
+
+    def iter_clusters(self, start: Optional[bytes] = None, end: Optional[bytes] = None):
+        """
+        :param start: first (encoded) cluster ID of the range to iterate over (default: the first)
+        :param end: (encoded) cluster ID after the range (default: after the last)
+        :return: generator of (cluster_id, value) of all clusters in the range, in key order
+        """
+        items = self.db.iteritems(self.clusters_cf)
+        if start is None:
+            items.seek_to_first()
+        else:
+            items.seek(start)
+        for (_, key), value in items:
+            if end is not None and key >= end:
+                break
+            yield key, value
+
+    def resolve_cluster_ids(
+            self,
+            uri_keys: Dict[str, UriKey],
+    ) -> Tuple[Dict[str, bytes], Dict[bytes, Optional[bytes]]]:
+        """
+        Follow the pointers from normalized URIs to the (encoded) IDs of their clusters.
+
+        :param uri_keys: URI key (see `get_uri_key`) by URI
+        :return: the cluster ID of each found URI, and the fetched cluster values
+        """
+        if self.has_aliases:
+            return resolve_aliases(uri_keys, self.get_pointers), {}
+
+        lookup_ids: Dict[str, bytes] = {}
+        local_keys: Dict[str, bytes] = {}
+        for uri, (is_global, key) in uri_keys.items():
+            if is_global:
+                try:
+                    lookup_ids[uri] = encode_id(key)
+                except ValueError:
+                    # not an ID that can be stored, so it is not found
+                    continue
+            else:
+                local_keys[uri] = self.prefixes.encode(key)
+
+        # local IRI -> cluster ID
+        cluster_ids: Dict[str, bytes] = {}
+        if local_keys:
+            with LOOKUP_STAGE_SECONDS.time(stage='get_local_iri'):
+                found_ids = self.db.multi_get([(self.locals_cf, key) for key in set(local_keys.values())])
+            for uri, key in local_keys.items():
+                cluster_id = found_ids[(self.locals_cf, key)]
+                if cluster_id:
+                    cluster_ids[uri] = cluster_id
+
+        # cluster ID -> cluster members, and global ID -> cluster ID, if it is a singleton ID
+        values: Dict[bytes, Optional[bytes]] = {}
+        redirects: Dict[bytes, bytes] = {}
+        if cluster_ids or lookup_ids:
+            lookup_keys = {(self.clusters_cf, cluster_id) for cluster_id in cluster_ids.values()}
+            for lookup_id in lookup_ids.values():
+                lookup_keys.add((self.clusters_cf, lookup_id))
+                lookup_keys.add((self.singletons_cf, lookup_id))
+            with LOOKUP_STAGE_SECONDS.time(stage='get_lookup_id'):
+                found_values = self.db.multi_get(list(lookup_keys))
+            for (column_family, key), value in found_values.items():
+                if column_family is self.clusters_cf:
+                    values[key] = value
+                elif value:
+                    redirects[key] = value
+
+        unfetched_ids = set(redirects.values()) - set(values)
+        if unfetched_ids:
+            values.update(self.get_cluster_values(list(unfetched_ids), stage='get_redirect'))
+
+        for uri, lookup_id in lookup_ids.items():
+            cluster_id = lookup_id if values.get(lookup_id) else redirects.get(lookup_id)
+            if cluster_id and values.get(cluster_id):
+                cluster_ids[uri] = cluster_id
+
+        return cluster_ids, values
+
+    def get_pointers(self, keys: List[bytes]) -> Dict[bytes, Optional[bytes]]:
+        """
+        :return: the (encoded) cluster ID that each local IRI or alias points to, or None
+        """
+        encoded_keys = {key: self.prefixes.encode(key) for key in keys}
+        found_ids = self.db.multi_get([(self.locals_cf, encoded_key) for encoded_key in encoded_keys.values()])
+        return {key: found_ids[(self.locals_cf, encoded_key)] for key, encoded_key in encoded_keys.items()}
+
+    def get_cluster_values(self, cluster_ids: List[bytes], stage: str = 'get_cluster') -> Dict[bytes, Optional[bytes]]:
+        with LOOKUP_STAGE_SECONDS.time(stage=stage):
+            found_values = self.db.multi_get([(self.clusters_cf, cluster_id) for cluster_id in cluster_ids])
+        return {key: value for (_, key), value in found_values.items()}
+
+    def decode_cluster(self, cluster_id: bytes, value_bytes: Optional[bytes]) -> Optional[DecodedCluster]:
+        if not value_bytes:
+            return None
+
+        if is_finalised_cluster(value_bytes):
+            # members of a finalised cluster are already unique and sorted
+            _, position = decode_varint(value_bytes, 1)
+            members = list(iter_compact_members(value_bytes, position))
+        else:
+            members = sorted(set(iter_compact_members(value_bytes)))
+
+        singletons: List[str] = []
+        local_ids: List[str] = []
+        for member in members:
+            length, iri_start = decode_varint(member, ID_WIDTH)
+            singletons.append(decode_id(member[:ID_WIDTH]).decode('utf8'))
+            local_ids.append(self.prefixes.decode(member[iri_start:iri_start + length]).decode('utf8'))
+
+        return decode_id(cluster_id).decode('utf8'), singletons, local_ids
+
+    def is_cluster(self, value_bytes: Optional[bytes]) -> bool:
+        return bool(value_bytes)
+
+    def get_global_id(self, cluster_id: bytes) -> str:
+        return decode_id(cluster_id).decode('utf8')
+
+    def count_members(self, value_bytes: bytes) -> int:
+        if is_finalised_cluster(value_bytes):
+            return decode_varint(value_bytes, 1)[0]
+        return len(set(iter_compact_members(value_bytes)))
+
+    def iter_members(self, value_bytes: bytes) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        Iterate over the members of a cluster in their returned order, without decoding them.
+
+        :return: generator of (singleton, local_iri), in which singleton is
+            decoded with `decode_singleton`
+        """
+        if is_finalised_cluster(value_bytes):
+            members = iter_compact_members(value_bytes, decode_varint(value_bytes, 1)[1])
+        else:
+            members = iter(sorted(set(iter_compact_members(value_bytes))))
+
+        for member in members:
+            length, iri_start = decode_varint(member, ID_WIDTH)
+            yield member[:ID_WIDTH], self.prefixes.decode(member[iri_start:iri_start + length])
+
+    def decode_singleton(self, singleton: bytes) -> str:
+        return decode_id(singleton).decode('utf8')
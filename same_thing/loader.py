@@ -1,24 +1,109 @@
+import argparse
 import asyncio
 import multiprocessing
 
 from aiorun import run
 
-from same_thing.sink import load_snapshot
-from same_thing.source import fetch_latest_snapshot
+from same_thing.layout import LAYOUTS, LEGACY
+from same_thing.sink import load_snapshot, LOAD_MODES, BATCH_SIZE, QUEUE_SIZE
+from same_thing.source import (
+    DownloadError,
+    fetch_latest_snapshot,
+    find_latest_snapshot,
+    is_downloaded,
+    open_session,
+    print_with_timestamp,
+    remove_old_downloads,
+    stream_snapshot,
+)
 
 
 CPU_COUNT = multiprocessing.cpu_count()
 
 
-async def load_identifiers():
+async def load_identifiers(pipelined=False, **load_options):
     loop = asyncio.get_event_loop()
     try:
+        if pipelined and await load_while_downloading(**load_options):
+            return
         latest_snapshot = await fetch_latest_snapshot()
-        await load_snapshot(latest_snapshot)
+        await load_snapshot(latest_snapshot, **load_options)
     except Exception:
         raise
     finally:
         loop.stop()
 
+
+async def load_while_downloading(**load_options):
+    """
+    Load the latest snapshot as it is downloaded, if it hasn't been downloaded yet.
+
+    :return: whether the snapshot was loaded; if the download was interrupted,
+        it should be resumed and loaded from the file instead
+    """
+    async with open_session() as session:
+        latest_snapshot, snapshot_url, sha256sum = await find_latest_snapshot(session)
+        if is_downloaded(latest_snapshot):
+            return False
+
+        remove_old_downloads(latest_snapshot)
+        compressed_chunks = await stream_snapshot(session, latest_snapshot, snapshot_url, sha256sum)
+        try:
+            await load_snapshot(latest_snapshot, compressed_chunks=compressed_chunks, **load_options)
+        except DownloadError as e:
+            print_with_timestamp(f'{e}\nFalling back to downloading the snapshot before loading it')
+            return False
+
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Download the latest Global ID snapshot and load it into a fresh DB.'
+    )
+    parser.add_argument(
+        '--mode', choices=LOAD_MODES, default='online',
+        help='load lines as they are read (online), sort them by key before writing (offline), '
+             'or only write the changes since the previous snapshot (delta)',
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=BATCH_SIZE,
+        help='number of lines that are written to the DB in a single batch',
+    )
+    parser.add_argument(
+        '--queue-size', type=int, default=QUEUE_SIZE,
+        help='maximum number of batches waiting to be written to the DB',
+    )
+    parser.add_argument(
+        '--layout', choices=LAYOUTS, default=LEGACY,
+        help='store all records in a single keyspace (legacy), or each record type in its own '
+             'column family, with dictionary-coded IRI prefixes and binary IDs (compact)',
+    )
+    parser.add_argument(
+        '--aliases', action='store_true',
+        help='also store pointers from global IRIs, and from the /page/ and wikipedia.org/wiki/ '
+             'variants of DBpedia IRIs, so that these are looked up without normalizing them',
+    )
+    parser.add_argument(
+        '--pipelined', action='store_true',
+        help='load a new snapshot while it is downloaded (only in the online mode)',
+    )
+    args = parser.parse_args()
+    if args.pipelined and args.mode != 'online':
+        parser.error('--pipelined can only be used in the online mode')
+    return args
+
+
 if __name__ == '__main__':
-    run(load_identifiers(), use_uvloop=True)
+    args = parse_args()
+    run(
+        load_identifiers(
+            mode=args.mode,
+            batch_size=args.batch_size,
+            queue_size=args.queue_size,
+            pipelined=args.pipelined,
+            layout=args.layout,
+            aliases=args.aliases,
+        ),
+        use_uvloop=True,
+    )
@@ -0,0 +1,111 @@
+import asyncio
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from same_thing.config import env_int
+from same_thing.source import print_with_timestamp
+
+REPORT_SECONDS = env_int('SAME_THING_LOAD_REPORT_SECONDS', 30)
+# e.g. `Cumulative stall: 00:00:1.234 H:M:S, 0.5 percent` in the `rocksdb.stats` property
+CUMULATIVE_STALL_RE = re.compile(rb'Cumulative stall: (\d+):(\d+):(\d+(?:\.\d+)?) H:M:S')
+
+
+def parse_write_stall_seconds(db_stats):
+    """
+    :param db_stats: value of the `rocksdb.stats` property
+    :return: seconds that writes were stalled, or None if unknown
+    """
+    match = CUMULATIVE_STALL_RE.search(db_stats or b'')
+    if match is None:
+        return None
+
+    hours, minutes, seconds = match.groups()
+    return 3600 * int(hours) + 60 * int(minutes) + float(seconds)
+
+
+class LoadStats:
+    """
+    Timers and throughput counters for the stages of a load.
+
+    Stages are timed by how long they take, or by how long a stage waits for
+    the next one (e.g. `queue_put` is the time the reader waits for the writer).
+    """
+
+    def __init__(self, snapshot_name=None, mode=None):
+        self.snapshot_name = snapshot_name
+        self.mode = mode
+        self.started_at = time.monotonic()
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+        self.queue_samples = 0
+        self.queue_occupancy_sum = 0
+        self.queue_occupancy_max = 0
+        self.write_stall_seconds = None
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def add_time(self, stage, seconds):
+        self.timers[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += time.perf_counter() - started_at
+
+    def sample_queue(self, queue):
+        occupancy = queue.qsize()
+        self.queue_samples += 1
+        self.queue_occupancy_sum += occupancy
+        self.queue_occupancy_max = max(self.queue_occupancy_max, occupancy)
+
+    def update_write_stalls(self, data_db):
+        stall_seconds = parse_write_stall_seconds(data_db.get_property(b'rocksdb.stats'))
+        if stall_seconds is not None:
+            self.write_stall_seconds = stall_seconds
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        timers = dict(self.timers)
+        if 'read' in timers:
+            # reading time that was not spent waiting for chunks or for the queue
+            timers['split'] = max(
+                0.0, timers['read'] - timers.get('decompress', 0.0) - timers.get('queue_put', 0.0)
+            )
+
+        return {
+            'snapshot_name': self.snapshot_name,
+            'mode': self.mode,
+            'elapsed_seconds': round(elapsed, 3),
+            'lines': self.counters['lines'],
+            'lines_per_second': round(self.counters['lines'] / max(elapsed, 1e-3), 1),
+            'compressed_mb_per_second': round(self.counters['compressed_bytes'] / 1024**2 / max(elapsed, 1e-3), 3),
+            'decompressed_mb_per_second': round(self.counters['decompressed_bytes'] / 1024**2 / max(elapsed, 1e-3), 3),
+            'queue_occupancy_mean': round(self.queue_occupancy_sum / max(self.queue_samples, 1), 2),
+            'queue_occupancy_max': self.queue_occupancy_max,
+            'write_stall_seconds': self.write_stall_seconds,
+            'counters': dict(self.counters),
+            'stage_seconds': {stage: round(seconds, 3) for stage, seconds in sorted(timers.items())},
+        }
+
+    def report(self):
+        summary = self.summary()
+        stages = ', '.join(f'{stage} {seconds:.1f}s' for stage, seconds in summary['stage_seconds'].items())
+        stalls = summary['write_stall_seconds']
+        return (
+            f"{summary['lines']} lines ({summary['lines_per_second']:.0f} lines/s), "
+            f"{summary['decompressed_mb_per_second']:.1f} MB/s decompressed, "
+            f"queue {summary['queue_occupancy_mean']:.1f} (max {summary['queue_occupancy_max']}), "
+            f"write stalls {'n/a' if stalls is None else f'{stalls:.1f}s'}; {stages}"
+        )
+
+    async def report_periodically(self, data_db, interval=REPORT_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            self.update_write_stalls(data_db)
+            print_with_timestamp(f'Progress: {self.report()}')
@@ -0,0 +1,384 @@
+import asyncio
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import ClassVar
+
+# every worker writes a snapshot of its metrics to this directory,
+# which are summed when the metrics are exported
+METRICS_DIR = os.environ.get('SAME_THING_METRICS_DIR', '/tmp/same_thing_metrics')
+# counters of workers that exited are added to this file
+ARCHIVE_NAME = 'archive.json'
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Metric:
+    # the Prometheus metric type, set by each subclass
+    type: ClassVar[str]
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.samples = {}
+        self.lock = threading.Lock()
+        (registry or default_registry).register(self)
+
+    def describe(self):
+        return {'type': self.type, 'help': self.documentation}
+
+    def collect(self):
+        with self.lock:
+            return {
+                label_key(labels): value
+                for labels, value in self.samples.items()
+            }
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.samples[labels] = self.samples.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauges are summed over the live workers, and dropped when a worker exits.
+
+    A gauge of a value that every worker observes of the same shared resource
+    (e.g. the size of the snapshot DB) takes the maximum instead, with `merge='max'`.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, merge='sum', registry=None):
+        assert merge in ('sum', 'max'), "`merge` should be 'sum' or 'max'"
+        self.merge = merge
+        super().__init__(name, documentation, registry)
+
+    def describe(self):
+        return dict(super().describe(), merge=self.merge)
+
+    def set(self, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.samples[labels] = value
+
+    def inc(self, amount=1, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.samples[labels] = self.samples.get(labels, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, registry)
+
+    def describe(self):
+        return dict(super().describe(), buckets=self.buckets)
+
+    def observe(self, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        bucket_index = bisect_buckets(self.buckets, value)
+        with self.lock:
+            sample = self.samples.get(labels)
+            if sample is None:
+                # a count per bucket (and +Inf), the sum, and the total count
+                sample = self.samples[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            sample[0][bucket_index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def collect(self):
+        with self.lock:
+            return {
+                label_key(labels): [list(counts), total, count]
+                for labels, (counts, total, count) in self.samples.items()
+            }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        assert metric.name not in self.metrics, f'{metric.name} is already registered'
+        self.metrics[metric.name] = metric
+
+    def add_collector(self, collector):
+        """
+        Add a function that updates metrics (e.g. gauges) right before they are collected.
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f'Could not collect metrics with {collector.__name__}: {e!r}', flush=True)
+
+        return {
+            name: dict(metric.describe(), samples=metric.collect())
+            for name, metric in self.metrics.items()
+        }
+
+
+def bisect_buckets(buckets, value):
+    for index, upper_bound in enumerate(buckets):
+        if value <= upper_bound:
+            return index
+
+    return len(buckets)
+
+
+def label_key(labels):
+    # JSON object keys must be strings
+    return json.dumps(labels)
+
+
+def get_snapshot_path(pid, metrics_dir=METRICS_DIR):
+    return os.path.join(metrics_dir, f'worker_{pid}.json')
+
+
+def write_snapshot(registry=None, metrics_dir=METRICS_DIR):
+    """
+    Write the metrics of this process to its snapshot file, atomically.
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    snapshot_path = get_snapshot_path(os.getpid(), metrics_dir)
+    temp_path = f'{snapshot_path}.tmp'
+    with open(temp_path, 'w') as snapshot_file:
+        json.dump((registry or default_registry).collect(), snapshot_file)
+    os.replace(temp_path, snapshot_path)
+
+
+def merge_snapshots(merged, snapshot, include_gauges=True):
+    """
+    Add the samples of a metrics snapshot to another snapshot, in place.
+    """
+    for name, metric in snapshot.items():
+        if metric['type'] == 'gauge' and not include_gauges:
+            continue
+
+        merged_metric = merged.setdefault(name, dict(metric, samples={}))
+        merged_samples = merged_metric['samples']
+        for key, value in metric['samples'].items():
+            if key not in merged_samples:
+                merged_samples[key] = value
+            elif metric.get('merge') == 'max':
+                merged_samples[key] = max(merged_samples[key], value)
+            elif metric['type'] == 'histogram':
+                counts, total, count = merged_samples[key]
+                merged_samples[key] = [
+                    [a + b for a, b in zip(counts, value[0])],
+                    total + value[1],
+                    count + value[2],
+                ]
+            else:
+                merged_samples[key] += value
+
+    return merged
+
+
+def read_snapshot(snapshot_path):
+    try:
+        with open(snapshot_path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_merged_snapshots(metrics_dir=METRICS_DIR):
+    """
+    Sum the metrics of all workers, and of the workers that have exited.
+    """
+    merged = {}
+    if not os.path.isdir(metrics_dir):
+        return merged
+
+    for file_name in sorted(os.listdir(metrics_dir)):
+        if file_name.endswith('.json'):
+            merge_snapshots(merged, read_snapshot(os.path.join(metrics_dir, file_name)))
+
+    return merged
+
+
+def mark_process_dead(pid, metrics_dir=METRICS_DIR):
+    """
+    Add the counters and histograms of an exited worker to the archive,
+    so that they keep increasing monotonically, and drop its gauges.
+    """
+    snapshot_path = get_snapshot_path(pid, metrics_dir)
+    if not os.path.exists(snapshot_path):
+        return
+
+    archive_path = os.path.join(metrics_dir, ARCHIVE_NAME)
+    with open(os.path.join(metrics_dir, 'archive.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        archive = merge_snapshots(
+            read_snapshot(archive_path),
+            read_snapshot(snapshot_path),
+            include_gauges=False,
+        )
+        temp_path = f'{archive_path}.tmp'
+        with open(temp_path, 'w') as archive_file:
+            json.dump(archive, archive_file)
+        os.replace(temp_path, archive_path)
+        os.remove(snapshot_path)
+
+
+def clear_snapshots(metrics_dir=METRICS_DIR):
+    if not os.path.isdir(metrics_dir):
+        return
+
+    for file_name in os.listdir(metrics_dir):
+        os.remove(os.path.join(metrics_dir, file_name))
+
+
+def render_text(merged):
+    """
+    Render metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric['samples'].items()):
+            labels = json.loads(key)
+            if metric['type'] == 'histogram':
+                counts, total, count = value
+                cumulative = 0
+                for upper_bound, bucket_count in zip(list(metric['buckets']) + [math.inf], counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if upper_bound == math.inf else repr(float(upper_bound))
+                    lines.append(f"{name}_bucket{format_labels(labels + [['le', le]])} {cumulative}")
+                lines.append(f'{name}_sum{format_labels(labels)} {total!r}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+            else:
+                lines.append(f'{name}{format_labels(labels)} {value!r}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(
+        f'{name}="{escape_label_value(value)}"' for name, value in labels
+    ) + '}'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+async def write_periodically(interval, registry=None, metrics_dir=METRICS_DIR):
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, write_snapshot, registry, metrics_dir)
+        except OSError as e:
+            print(f'Could not write metrics: {e!r}', flush=True)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that counts requests by route and status,
+    and keeps track of their latency and of the requests in flight.
+    """
+
+    def __init__(self, app, routes=()):
+        self.app = app
+        self.routes = set(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = scope['path'] if scope['path'] in self.routes else 'other'
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started_at, route=route)
+            HTTP_REQUESTS.inc(route=route, status=str(status))
+
+
+default_registry = Registry()
+
+LOOKUP_STAGE_SECONDS = Histogram(
+    'same_thing_lookup_stage_seconds',
+    'Time spent in each stage of a lookup',
+)
+CLUSTER_SIZE = Histogram(
+    'same_thing_cluster_size',
+    'Number of members of the clusters that were found',
+    buckets=SIZE_BUCKETS,
+)
+LOOKUP_URIS = Counter(
+    'same_thing_lookup_uris_total',
+    'Number of looked up URIs, by whether they were found',
+)
+HTTP_REQUESTS = Counter(
+    'same_thing_http_requests_total',
+    'Number of HTTP requests, by route and status code',
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'same_thing_http_request_seconds',
+    'Time until an HTTP response was completely sent, by route',
+)
+HTTP_IN_FLIGHT = Gauge(
+    'same_thing_http_requests_in_flight',
+    'Number of HTTP requests that are being handled',
+)
+CACHE_STATS = Gauge(
+    'same_thing_cache',
+    'Statistics of the cluster cache of the current snapshot (entries, bytes, hits, misses, evictions)',
+)
+ROCKSDB_PROPERTIES = Gauge(
+    'same_thing_rocksdb_property',
+    'Integer properties of the DB instance of each worker for the current snapshot, e.g. its block cache usage',
+)
+ROCKSDB_DB_PROPERTIES = Gauge(
+    'same_thing_rocksdb_db_property',
+    'Integer properties of the files of the current snapshot DB, which all workers share',
+    merge='max',
+)
@@ -1,51 +1,346 @@
 from __future__ import annotations
 
-import re
-from typing import Dict, Union, List
-from urllib.parse import unquote
+from itertools import islice
+from typing import Dict, Union, List, Iterable, Iterator, Optional, NamedTuple, FrozenSet, Set, Tuple
 
-from same_thing.db import get_connection_to_latest, is_cluster_membership, sorted_cluster
+from same_thing.cache import ClusterCache
+from same_thing.config import env_int
 from same_thing.exceptions import UriNotFound
-from same_thing.sink import DBP_GLOBAL_PREFIX, DBP_GLOBAL_MARKER
+from same_thing.layout import LegacyLayout, CompactLayout
+from same_thing.metrics import (
+    default_registry,
+    LOOKUP_STAGE_SECONDS,
+    CLUSTER_SIZE,
+    LOOKUP_URIS,
+    CACHE_STATS,
+    ROCKSDB_PROPERTIES,
+    ROCKSDB_DB_PROPERTIES,
+)
+from same_thing.serialize import dumps
+from same_thing.snapshots import SnapshotManager
+from same_thing.uris import DBP_GLOBAL_PREFIX, DBP_GLOBAL_MARKER, UriKey
+from same_thing.warmup import HotKeySampler, warm_up
+
+UriCluster = Dict[str, Union[str, int, List[str]]]
+Layout = Union[LegacyLayout, CompactLayout]
+
+
+class CachedCluster(NamedTuple):
+    fields: UriCluster
+    # the fields, serialized once, ready to be sent
+    json: bytes
+
+
+class MemberFilter(NamedTuple):
+    """
+    Which members of each cluster to return, and whether to count them.
+    """
+    members: bool = True
+    # hosts of the local IRIs of the members to return, e.g. `www.wikidata.org`; all hosts if empty
+    hosts: FrozenSet[bytes] = frozenset()
+    limit: Optional[int] = None
+    # the number of (matching) members to skip, as returned in `next_cursor`
+    cursor: int = 0
+    # not named `count`, which would shadow `tuple.count`
+    count_members: bool = False
+
+    @property
+    def needs_members(self) -> bool:
+        return self.members or self.count_members
+
+
+ALL_MEMBERS = MemberFilter()
 
-UriCluster = Dict[str, Union[str, List[str]]]
+CACHE_MB = env_int('SAME_THING_CACHE_MB', 128)
+NOT_FOUND_CACHE_MB = env_int('SAME_THING_NOT_FOUND_CACHE_MB', 16)
 
-db = get_connection_to_latest(max_retries=12, read_only=True)
-wiki_article_re = re.compile(
-    r'https?://(?P<locale>[a-z-]{2,}\.)wikipedia.org/wiki/(?P<slug>.+)$'
+SNAPSHOT_POLL_SECONDS = env_int('SAME_THING_SNAPSHOT_POLL_SECONDS', 30)
+# exported as metrics, for the DB that is currently served: properties of the
+# DB instance of each worker, which are summed, and of the DB files, which are not
+ROCKSDB_WORKER_PROPERTY_NAMES = (
+    b'rocksdb.block-cache-usage',
+    b'rocksdb.block-cache-pinned-usage',
+    b'rocksdb.estimate-table-readers-mem',
+)
+ROCKSDB_DB_PROPERTY_NAMES = (
+    b'rocksdb.estimate-num-keys',
+    b'rocksdb.total-sst-files-size',
+    b'rocksdb.num-live-versions',
 )
 
 
-def get_cluster(uri: str) -> UriCluster:
-    normalized_uri = uri.lstrip(DBP_GLOBAL_PREFIX)
-    if normalized_uri.startswith(DBP_GLOBAL_MARKER):
-        lookup_id = normalized_uri[len(DBP_GLOBAL_MARKER):].encode('utf8')
-    else:
-        uri = unquote(uri).replace(' ', '_').replace('"', '%22')
-        if 'dbpedia.org' in uri:
-            uri = uri.replace('dbpedia.org/page/', 'dbpedia.org/resource/')
-        else:
-            # todo: assigment expression candidate
-            wiki_match = wiki_article_re.match(uri)
-            if wiki_match:
-                locale = wiki_match.group('locale').replace('en.', '')
-                uri = f"http://{locale}dbpedia.org/resource/{wiki_match.group('slug')}"
-
-        lookup_id = db.get(uri.encode('utf8'))
-        if not lookup_id:
-            raise UriNotFound()
-
-    value_bytes = db.get(lookup_id)
-    if not value_bytes:
+def warm_up_snapshot(snapshot) -> None:
+    """
+    Look up the hot keys in a newly opened snapshot, before it is served.
+    """
+    warm_up(lambda uris: lookup_in_snapshot(uris, snapshot.layout, snapshot.cache))
+
+
+# every snapshot gets its own cache, so that it is invalidated when the snapshot changes;
+# a snapshot is opened by `snapshots.watch`, after the http workers have been forked
+snapshots = SnapshotManager(
+    create_cache=lambda: ClusterCache(CACHE_MB * 1024**2, NOT_FOUND_CACHE_MB * 1024**2),
+    warm_up=warm_up_snapshot,
+)
+hot_keys = HotKeySampler()
+
+
+def get_locale_host(locale: str) -> str:
+    """
+    :return: the host of the DBpedia chapter of a locale, e.g. `de.dbpedia.org`
+    """
+    return 'dbpedia.org' if locale == 'en' else f'{locale}.dbpedia.org'
+
+
+def get_host(iri: bytes) -> bytes:
+    host_start = iri.find(b'://')
+    if host_start < 0:
+        return b''
+
+    host_end = iri.find(b'/', host_start + 3)
+    return iri[host_start + 3:] if host_end < 0 else iri[host_start + 3:host_end]
+
+
+def get_cluster(uri: str, member_filter: MemberFilter = ALL_MEMBERS) -> UriCluster:
+    cluster = get_clusters([uri], member_filter)[uri]
+    if cluster is None:
         raise UriNotFound()
-    elif not is_cluster_membership(value_bytes):
-        lookup_id = value_bytes
-        value_bytes = db.get(value_bytes)
 
-    singletons, local_ids = sorted_cluster(value_bytes)
+    return cluster
+
 
+def get_clusters(
+        uris: Iterable[str],
+        member_filter: MemberFilter = ALL_MEMBERS,
+) -> Dict[str, Optional[UriCluster]]:
     return {
-        'global': f"{DBP_GLOBAL_PREFIX}{DBP_GLOBAL_MARKER}{lookup_id.decode('utf8')}",
+        uri: cluster.fields if cluster else None
+        for uri, cluster in lookup_clusters(uris, member_filter).items()
+    }
+
+
+def lookup_clusters(
+        uris: Iterable[str],
+        member_filter: MemberFilter = ALL_MEMBERS,
+) -> Dict[str, Optional[CachedCluster]]:
+    """
+    Look up the clusters of many URIs at once, with one `multi_get` per hop.
+
+    Each cluster is decoded and serialized only once, however many of the
+    URIs belong to it, and is kept in the cluster cache for subsequent lookups.
+    Clusters of which only some members are returned (or counted) are
+    decoded lazily instead, and are not cached.
+
+    :param uris: any global or local IRIs
+    :param member_filter: which members of each cluster to return
+    :return: the cluster of each URI, or None if the URI was not found
+    """
+    uris = list(uris)
+    with snapshots.connection() as snapshot:
+        hot_keys.sample(uris)
+        return lookup_in_snapshot(uris, snapshot.layout, snapshot.cache, member_filter)
+
+
+def lookup_in_snapshot(
+        uris: List[str],
+        layout: Layout,
+        cache: ClusterCache,
+        member_filter: MemberFilter = ALL_MEMBERS,
+) -> Dict[str, Optional[CachedCluster]]:
+    cluster_ids: Dict[str, Optional[bytes]] = {}
+    unresolved: Dict[str, UriKey] = {}
+    with LOOKUP_STAGE_SECONDS.time(stage='normalize'):
+        uri_keys = [layout.get_uri_key(uri) for uri in uris]
+
+    for uri, uri_key in zip(uris, uri_keys):
+        if cache.not_found.get(uri_key):
+            cluster_ids[uri] = None
+            continue
+
+        cluster_id = cache.cluster_ids.get(uri_key)
+        if cluster_id is None:
+            unresolved[uri] = uri_key
+        else:
+            cluster_ids[uri] = cluster_id
+
+    values: Dict[bytes, Optional[bytes]] = {}
+    if unresolved:
+        resolved_ids, values = layout.resolve_cluster_ids(unresolved)
+        for uri, uri_key in unresolved.items():
+            cluster_id = resolved_ids.get(uri)
+            cluster_ids[uri] = cluster_id
+            if cluster_id is None:
+                cache.not_found.put(uri_key, True)
+            else:
+                cache.cluster_ids.put(uri_key, cluster_id)
+
+    found_ids = set(filter(None, cluster_ids.values()))
+    if member_filter == ALL_MEMBERS:
+        clusters = get_cached_clusters(found_ids, values, layout, cache)
+    else:
+        clusters = get_filtered_clusters(found_ids, values, layout, member_filter)
+
+    clusters_by_uri: Dict[str, Optional[CachedCluster]] = {}
+    for uri in uris:
+        cluster_id = cluster_ids[uri]
+        clusters_by_uri[uri] = clusters.get(cluster_id) if cluster_id else None
+    found_count = 0
+    for cluster in clusters_by_uri.values():
+        if cluster is not None:
+            found_count += 1
+            singletons = cluster.fields.get('cluster')
+            if member_filter == ALL_MEMBERS and isinstance(singletons, list):
+                CLUSTER_SIZE.observe(len(singletons))
+    LOOKUP_URIS.inc(found_count, found='true')
+    LOOKUP_URIS.inc(len(clusters_by_uri) - found_count, found='false')
+
+    return clusters_by_uri
+
+
+def get_cached_clusters(
+        cluster_ids: Set[bytes],
+        values: Dict[bytes, Optional[bytes]],
+        layout: Layout,
+        cache: ClusterCache,
+) -> Dict[bytes, Optional[CachedCluster]]:
+    """
+    :param values: cluster values that were already fetched
+    :return: the whole cluster of each ID, from the cache if possible
+    """
+    clusters: Dict[bytes, Optional[CachedCluster]] = {}
+    uncached_ids = []
+    for cluster_id in cluster_ids:
+        cluster = cache.clusters.get(cluster_id)
+        if cluster is not None:
+            clusters[cluster_id] = cluster
+        elif cluster_id in values:
+            clusters[cluster_id] = decode_cluster(layout, cluster_id, values[cluster_id])
+        else:
+            uncached_ids.append(cluster_id)
+
+    if uncached_ids:
+        uncached_values = layout.get_cluster_values(uncached_ids)
+        for cluster_id, value_bytes in uncached_values.items():
+            clusters[cluster_id] = decode_cluster(layout, cluster_id, value_bytes)
+
+    for cluster_id, cluster in clusters.items():
+        if cluster is not None:
+            cache.clusters.put(cluster_id, cluster)
+
+    return clusters
+
+
+def get_filtered_clusters(
+        cluster_ids: Set[bytes],
+        values: Dict[bytes, Optional[bytes]],
+        layout: Layout,
+        member_filter: MemberFilter,
+) -> Dict[bytes, Optional[CachedCluster]]:
+    """
+    Decode only the members that pass the filter, and stop reading a cluster
+    as soon as the requested members have been found.
+
+    :param values: cluster values that were already fetched
+    :return: the filtered cluster of each ID
+    """
+    unfetched_ids = [cluster_id for cluster_id in cluster_ids if cluster_id not in values]
+    if unfetched_ids and member_filter.needs_members:
+        values = {**values, **layout.get_cluster_values(unfetched_ids)}
+
+    clusters: Dict[bytes, Optional[CachedCluster]] = {}
+    for cluster_id in cluster_ids:
+        fields: UriCluster = {
+            'global': f'{DBP_GLOBAL_PREFIX}{DBP_GLOBAL_MARKER}{layout.get_global_id(cluster_id)}',
+        }
+        if member_filter.needs_members:
+            value_bytes = values.get(cluster_id)
+            if value_bytes is None or not layout.is_cluster(value_bytes):
+                clusters[cluster_id] = None
+                continue
+            with LOOKUP_STAGE_SECONDS.time(stage='filter'):
+                fields.update(filter_members(layout, value_bytes, member_filter))
+
+        with LOOKUP_STAGE_SECONDS.time(stage='serialize_cluster'):
+            clusters[cluster_id] = CachedCluster(fields, dumps(fields))
+
+    return clusters
+
+
+def filter_members(layout: Layout, value_bytes: bytes, member_filter: MemberFilter) -> UriCluster:
+    """
+    :return: the `locals` and `cluster` fields of the members that pass the filter,
+        `next_cursor` if more members pass it, and `count` if it was requested
+    """
+    fields: UriCluster = {}
+    if member_filter.members:
+        limit, cursor = member_filter.limit, member_filter.cursor
+        # read one member past the page, to know whether there is a next page
+        stop = None if limit is None else cursor + limit + 1
+        page = list(islice(iter_matching_members(layout, value_bytes, member_filter.hosts), cursor, stop))
+        has_next_page = limit is not None and len(page) > limit
+        if has_next_page:
+            page = page[:limit]
+        fields['locals'] = [local_iri.decode('utf8') for _, local_iri in page]
+        fields['cluster'] = [layout.decode_singleton(singleton) for singleton, _ in page]
+        if has_next_page:
+            fields['next_cursor'] = str(cursor + len(page))
+
+    if member_filter.count_members:
+        if member_filter.hosts:
+            fields['count'] = sum(1 for _ in iter_matching_members(layout, value_bytes, member_filter.hosts))
+        else:
+            # the number of members is stored at the start of a finalised cluster
+            fields['count'] = layout.count_members(value_bytes)
+
+    return fields
+
+
+def iter_matching_members(
+        layout: Layout,
+        value_bytes: bytes,
+        hosts: FrozenSet[bytes],
+) -> Iterator[Tuple[bytes, bytes]]:
+    members = layout.iter_members(value_bytes)
+    if not hosts:
+        return members
+    return (member for member in members if get_host(member[1]) in hosts)
+
+
+def decode_cluster(layout: Layout, cluster_id: bytes, value_bytes: Optional[bytes]) -> Optional[CachedCluster]:
+    with LOOKUP_STAGE_SECONDS.time(stage='decode'):
+        decoded = layout.decode_cluster(cluster_id, value_bytes)
+    if decoded is None:
+        return None
+
+    global_id, singletons, local_ids = decoded
+    fields: UriCluster = {
+        'global': f"{DBP_GLOBAL_PREFIX}{DBP_GLOBAL_MARKER}{global_id}",
         'locals': local_ids,
         'cluster': singletons,
     }
+    with LOOKUP_STAGE_SECONDS.time(stage='serialize_cluster'):
+        fields_json = dumps(fields)
+
+    return CachedCluster(fields, fields_json)
+
+
+def collect_snapshot_metrics() -> None:
+    snapshot = snapshots.current
+    db, cache = (snapshot.db, snapshot.cache) if snapshot else (None, None)
+    if db is not None:
+        for property_names, gauge in (
+                (ROCKSDB_WORKER_PROPERTY_NAMES, ROCKSDB_PROPERTIES),
+                (ROCKSDB_DB_PROPERTY_NAMES, ROCKSDB_DB_PROPERTIES),
+        ):
+            for property_name in property_names:
+                value = db.get_property(property_name)
+                if value is not None:
+                    gauge.set(int(value), property=property_name.decode('utf8'))
+
+    if cache is not None:
+        for cache_name, cache_stats in cache.stats().items():
+            for stat_name in ('entries', 'bytes', 'hits', 'misses', 'evictions'):
+                CACHE_STATS.set(cache_stats[stat_name], cache=cache_name, stat=stat_name)
+
+
+default_registry.add_collector(collect_snapshot_metrics)
@@ -1,12 +1,53 @@
+"""
+Backups of data DBs, and restoring them.
+
+By default, a backup is a checkpoint: the SST files of a closed DB are
+hard-linked into a directory under `backups/checkpoints`, and its few other
+files are copied, which takes next to no time or space. A checkpoint shares
+the disk of the DB, so it protects against losing or corrupting the DB, but
+not against losing the disk. Set `SAME_THING_BACKUP_MODE=engine` to copy
+each DB with RocksDB's BackupEngine instead.
+
+Both kinds of backups are numbered in a single sequence, under the
+`backup:<id>` keys of the admin DB, and are restored the same way.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from tabulate import tabulate
+from tqdm import tqdm
 
-from same_thing.db import get_db_path, backupper, get_connection, get_data_db_name
+from same_thing.config import env_int
+from same_thing.db import (
+    BACKUP_PATH,
+    backupper,
+    db_exists,
+    get_connection,
+    get_data_db_name,
+    get_db_path,
+    link_or_copy,
+    list_column_families,
+    replace_db,
+)
 from same_thing.source import print_with_timestamp
 
 
 BACKUP_PREFIX = b'backup:'
+CHECKPOINT = 'checkpoint'
+ENGINE = 'engine'
+BACKUP_MODES = (CHECKPOINT, ENGINE)
+BACKUP_MODE = os.environ.get('SAME_THING_BACKUP_MODE', CHECKPOINT)
+CHECKPOINT_PATH = os.path.join(BACKUP_PATH, 'checkpoints')
+# files that RocksDB creates when a DB is opened, which need no backup
+UNSAVED_FILE_PREFIXES = ('LOCK', 'LOG')
+KEEP_BACKUPS = 2
+RESTORE_WORKERS = env_int('SAME_THING_RESTORE_WORKERS', 8)
 
 
 class BackupNotFound(Exception):
@@ -17,29 +58,280 @@ def get_backup_key(backup_id):
     return b'%s%d' % (BACKUP_PREFIX, backup_id)
 
 
-def create_backup(data_db, snapshot_name, admin_connection=None):
-    backupper.create_backup(data_db, flush_before_backup=True)
-    backup_id = next(reversed(backupper.get_backup_info()))['backup_id']
+def get_checkpoint_dir(backup_id):
+    return os.path.join(CHECKPOINT_PATH, str(backup_id))
+
+
+def get_checkpoint_meta_path(backup_id):
+    return get_checkpoint_dir(backup_id) + '.json'
+
+
+def get_checkpoint_info():
+    """
+    :return: list of dicts with the `backup_id`, `timestamp` and `files` (sizes by name) of each checkpoint
+    """
+    if not os.path.isdir(CHECKPOINT_PATH):
+        return []
+
+    checkpoints = []
+    for file_name in os.listdir(CHECKPOINT_PATH):
+        if file_name.endswith('.json'):
+            with open(os.path.join(CHECKPOINT_PATH, file_name)) as meta_file:
+                checkpoints.append(json.load(meta_file))
+    return sorted(checkpoints, key=lambda checkpoint: checkpoint['backup_id'])
+
+
+def get_backup_info():
+    """
+    :return: list of dicts with the `backup_id`, `timestamp` and `type` of
+        every checkpoint and BackupEngine backup, from oldest to newest
+    """
+    backups = [
+        {'backup_id': checkpoint['backup_id'], 'timestamp': checkpoint['timestamp'], 'type': CHECKPOINT}
+        for checkpoint in get_checkpoint_info()
+    ]
+    backups.extend(
+        {'backup_id': backup_meta['backup_id'], 'timestamp': backup_meta['timestamp'], 'type': ENGINE}
+        for backup_meta in backupper.get_backup_info()
+    )
+    # the BackupEngine numbers its backups regardless of the checkpoints
+    return sorted(backups, key=lambda backup: (backup['timestamp'], backup['backup_id']))
+
+
+def find_backup(backup_id):
+    for backup in get_backup_info():
+        if backup['backup_id'] == backup_id:
+            return backup
+
+    raise BackupNotFound(f'No backup with ID {backup_id} was found')
+
+
+def copy_files(source_path, target_path, file_names, description):
+    """
+    Link or copy files from one directory to another, in parallel, and show the progress.
+
+    :return: the number of files that were linked and copied
+    """
+    sizes = {file_name: os.path.getsize(os.path.join(source_path, file_name)) for file_name in file_names}
+    linked = 0
+    with tqdm(total=sum(sizes.values()), unit='B', unit_scale=True, desc=description) as progress_bar:
+
+        def link_or_copy_file(file_name):
+            is_linked = link_or_copy(os.path.join(source_path, file_name), os.path.join(target_path, file_name))
+            progress_bar.update(sizes[file_name])
+            return is_linked
+
+        with ThreadPoolExecutor(RESTORE_WORKERS) as executor:
+            for is_linked in executor.map(link_or_copy_file, file_names):
+                linked += is_linked
+
+    return linked, len(file_names) - linked
+
+
+def create_checkpoint(db_name, backup_id):
+    """
+    Save a closed DB as a checkpoint, which is only complete once its metadata is written.
+    """
+    db_path = get_db_path(db_name)
+    checkpoint_dir = get_checkpoint_dir(backup_id)
+    temporary_dir = checkpoint_dir + '.tmp'
+    if os.path.exists(temporary_dir):
+        shutil.rmtree(temporary_dir)
+    os.makedirs(temporary_dir)
+
+    file_names = [
+        file_name for file_name in os.listdir(db_path)
+        if not file_name.startswith(UNSAVED_FILE_PREFIXES)
+    ]
+    copy_files(db_path, temporary_dir, file_names, description=f'Checkpoint {backup_id}')
+    os.replace(temporary_dir, checkpoint_dir)
+    write_checkpoint_meta(backup_id, {
+        'backup_id': backup_id,
+        'timestamp': int(time.time()),
+        'files': {
+            file_name: os.path.getsize(os.path.join(checkpoint_dir, file_name))
+            for file_name in file_names
+        },
+    })
+
+
+def write_checkpoint_meta(backup_id, checkpoint):
+    meta_path = get_checkpoint_meta_path(backup_id)
+    with open(meta_path + '.tmp', 'w') as meta_file:
+        json.dump(checkpoint, meta_file)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def renumber_checkpoint(backup_id, new_backup_id, admin_db):
+    """
+    Give a checkpoint a new ID, e.g. because the BackupEngine used its ID.
+    """
+    with open(get_checkpoint_meta_path(backup_id)) as meta_file:
+        checkpoint = json.load(meta_file)
+    os.remove(get_checkpoint_meta_path(backup_id))
+    os.replace(get_checkpoint_dir(backup_id), get_checkpoint_dir(new_backup_id))
+    write_checkpoint_meta(new_backup_id, dict(checkpoint, backup_id=new_backup_id))
+    snapshot_name = admin_db.get(get_backup_key(backup_id))
+    if snapshot_name is not None:
+        admin_db.put(get_backup_key(new_backup_id), snapshot_name)
+
+
+def create_backup(db_name, snapshot_name, admin_connection=None, mode=BACKUP_MODE):
+    """
+    Back up a data DB that was closed after loading, so that its memtables were flushed.
+
+    :param db_name: name or path of the data DB
+    :param mode: one of BACKUP_MODES
+    :return: the ID of the backup
+    """
+    assert mode in BACKUP_MODES, f'`mode` should be one of {BACKUP_MODES}'
     admin_db = admin_connection or get_connection('admin', read_only=False)
+    started_at = time.monotonic()
+    if mode == ENGINE:
+        data_db = get_connection(db_name, read_only=False)
+        backupper.create_backup(data_db, flush_before_backup=True)
+        del data_db
+        backup_id = next(reversed(backupper.get_backup_info()))['backup_id']
+        checkpoint_ids = {checkpoint['backup_id'] for checkpoint in get_checkpoint_info()}
+        if backup_id in checkpoint_ids:
+            renumber_checkpoint(backup_id, max(checkpoint_ids) + 1, admin_db)
+    else:
+        backup_id = max((backup['backup_id'] for backup in get_backup_info()), default=0) + 1
+        create_checkpoint(db_name, backup_id)
+
     backup_key = get_backup_key(backup_id)
     admin_db.put(backup_key, snapshot_name.encode('utf8'))
-    backupper.purge_old_backups(2)
+    purge_old_backups(KEEP_BACKUPS)
     print_with_timestamp(
-        f'Backup of {snapshot_name} was created with ID {backup_id}'
+        f'Backup of {snapshot_name} was created with ID {backup_id} '
+        f'({mode}, in {time.monotonic() - started_at:.0f} seconds)'
     )
     return backup_id
 
 
+def purge_old_backups(keep_n_latest):
+    backups = get_backup_info()
+    kept = backups[-keep_n_latest:]
+    for backup in backups[:-keep_n_latest]:
+        if backup['type'] == CHECKPOINT:
+            os.remove(get_checkpoint_meta_path(backup['backup_id']))
+            shutil.rmtree(get_checkpoint_dir(backup['backup_id']))
+    backupper.purge_old_backups(sum(backup['type'] == ENGINE for backup in kept))
+
+
 def restore_backup(backup_id, db_name):
     db_path = get_db_path(db_name)
-    backupper.restore_backup(backup_id, db_path, db_path)
+    started_at = time.monotonic()
+    if find_backup(backup_id)['type'] == ENGINE:
+        backupper.restore_backup(backup_id, db_path, db_path)
+    else:
+        restore_checkpoint(backup_id, db_name)
     print_with_timestamp(
-        f'Backup {backup_id} was succesfully restored to {db_path}'
+        f'Backup {backup_id} was succesfully restored to {db_path} '
+        f'in {time.monotonic() - started_at:.0f} seconds'
+    )
+
+
+def restore_checkpoint(backup_id, db_name):
+    """
+    Link or copy the files of a checkpoint to a new DB, and replace the DB with it.
+    """
+    problems = verify_backup(backup_id)
+    if problems:
+        raise ValueError(f'Backup {backup_id} cannot be restored: ' + '; '.join(problems))
+
+    temporary_name = f'_{db_name}'
+    temporary_path = get_db_path(temporary_name)
+    if db_exists(temporary_name):
+        shutil.rmtree(temporary_path)
+    os.makedirs(temporary_path)
+    checkpoint_dir = get_checkpoint_dir(backup_id)
+    linked, copied = copy_files(
+        checkpoint_dir, temporary_path, os.listdir(checkpoint_dir), description=f'Restoring {backup_id}'
     )
+    print_with_timestamp(f'Linked {linked} and copied {copied} files of backup {backup_id}')
+
+    if db_exists(db_name):
+        replace_db(db_name, temporary_name)
+    else:
+        os.replace(temporary_path, get_db_path(db_name))
+
+
+def verify_backup(backup_id, deep=False):
+    """
+    Check that all files of a backup are present, without restoring it.
+
+    :param deep: also read every key of a checkpoint, and verify the checksums of its blocks
+    :return: list of the problems that were found
+    """
+    backup = find_backup(backup_id)
+    if backup['type'] == ENGINE:
+        return verify_engine_backup(backup_id)
+
+    with open(get_checkpoint_meta_path(backup_id)) as meta_file:
+        checkpoint = json.load(meta_file)
+    checkpoint_dir = get_checkpoint_dir(backup_id)
+    problems = []
+    for file_name, size in checkpoint['files'].items():
+        file_path = os.path.join(checkpoint_dir, file_name)
+        if not os.path.isfile(file_path):
+            problems.append(f'{file_name} is missing')
+        elif os.path.getsize(file_path) != size:
+            problems.append(f'{file_name} has {os.path.getsize(file_path)} instead of {size} bytes')
+
+    if deep and not problems:
+        try:
+            key_count = count_keys(checkpoint_dir)
+            print_with_timestamp(f'Read {key_count} keys of backup {backup_id}')
+        except Exception as e:
+            problems.append(f'reading the keys failed: {e!r}')
+
+    return problems
+
+
+def count_keys(db_path):
+    """
+    :return: the number of keys in all column families of a DB, after verifying the checksums of its blocks
+    """
+    db = get_connection(db_path, read_only=True)
+    if list_column_families(db_path):
+        all_keys = [
+            db.iterkeys(column_family, verify_checksums=True, fill_cache=False)
+            for column_family in db.column_families
+        ]
+    else:
+        all_keys = [db.iterkeys(verify_checksums=True, fill_cache=False)]
+
+    key_count = 0
+    for keys in all_keys:
+        keys.seek_to_first()
+        key_count += sum(1 for _ in keys)
+    return key_count
+
+
+def verify_engine_backup(backup_id):
+    """
+    Check that the files that the metadata of a BackupEngine backup lists are present.
+
+    Their checksums can only be verified by restoring the backup.
+    """
+    meta_path = os.path.join(BACKUP_PATH, 'meta', str(backup_id))
+    if not os.path.isfile(meta_path):
+        return [f'{meta_path} is missing']
+
+    problems = []
+    with open(meta_path) as meta_file:
+        for line in meta_file:
+            # `<path> crc32 <checksum>`, after a few header lines
+            if ' crc32 ' in line:
+                file_name = line.split(' ', 1)[0]
+                if not os.path.isfile(os.path.join(BACKUP_PATH, file_name)):
+                    problems.append(f'{file_name} is missing')
+    return problems
 
 
 def get_available_snapshots():
-    available_backups = reversed(backupper.get_backup_info())
+    available_backups = reversed(get_backup_info())
     admin_db = get_connection('admin', read_only=True)
     available_snapshots = []
     for backup_meta in available_backups:
@@ -50,6 +342,7 @@ def get_available_snapshots():
                 'id': backup_meta['backup_id'],
                 'key': backup_key.decode('utf8'),
                 'snapshot': backup_snapshot.decode('utf8'),
+                'type': backup_meta['type'],
                 'created_at': datetime.utcfromtimestamp(
                     backup_meta['timestamp']
                 ).astimezone().isoformat(timespec='seconds')
@@ -87,7 +380,7 @@ def restore_interactively():
 
             if selected_id == snap['id']:
                 backup_id = selected_id
-            elif query in snap.values():
+            elif query in (snap['key'], snap['snapshot'], snap['created_at']):
                 backup_id = snap['id']
 
             if backup_id:
@@ -104,5 +397,39 @@ def restore_interactively():
             )
 
 
+def verify_backups(backup_ids, deep=False):
+    """
+    :return: whether all backups are complete
+    """
+    all_complete = True
+    for backup_id in backup_ids:
+        problems = verify_backup(backup_id, deep)
+        if problems:
+            all_complete = False
+            print_with_timestamp(f'Backup {backup_id} is incomplete: ' + '; '.join(problems))
+        else:
+            print_with_timestamp(f'Backup {backup_id} is complete')
+    return all_complete
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Restore a data DB from a backup (interactively), or verify backups.'
+    )
+    parser.add_argument(
+        '--verify', type=int, nargs='*', metavar='ID',
+        help='verify these backups (default: all) without restoring them',
+    )
+    parser.add_argument(
+        '--deep', action='store_true',
+        help='also read every key of each checkpoint while verifying, to verify the block checksums',
+    )
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.verify is not None:
+        verified_ids = args.verify or [backup['backup_id'] for backup in get_backup_info()]
+        sys.exit(0 if verify_backups(verified_ids, args.deep) else 1)
     restore_interactively()
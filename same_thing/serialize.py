@@ -0,0 +1,53 @@
+import json
+from typing import Any
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize to compact UTF-8 JSON bytes, with orjson if it is installed.
+
+    The stdlib output is identical to that of Starlette's JSONResponse.
+    """
+    if HAS_ORJSON:
+        return orjson.dumps(obj)
+
+    return json.dumps(
+        obj,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(',', ':'),
+    ).encode('utf8')
+
+
+def join_object(fields):
+    """
+    Assemble a JSON object from keys and already serialized values.
+
+    :param fields: iterable of (key, JSON bytes or None) pairs
+    :return: JSON bytes
+    """
+    return b'{' + b','.join(
+        dumps(key) + b':' + (value if value is not None else b'null')
+        for key, value in fields
+    ) + b'}'
+
+
+def extend_object(object_json, fields):
+    """
+    Add fields with already serialized values to a serialized JSON object.
+    """
+    if not fields:
+        return object_json
+
+    extra_json = join_object(fields)
+    if object_json == b'{}':
+        return extra_json
+
+    return object_json[:-1] + b',' + extra_json[1:]
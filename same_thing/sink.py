@@ -1,18 +1,49 @@
 import asyncio
 import bz2
+import json
+import mmap
+import multiprocessing
 import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import aiofiles
-from aiofiles.os import stat
+import rocksdb
 from tqdm import tqdm
 
+from same_thing.bulk import (
+    MEMBER_TAG,
+    CHANGES,
+    UNCHANGED,
+    REMOVED,
+    RUN_SIZE,
+    MAX_MERGE_FANIN,
+    get_run_path,
+    write_sorted_run,
+    merge_runs,
+    iter_grouped_records,
+    iter_delta,
+)
 from same_thing.db import (
     get_connection,
+    DB_ROOT_PATH,
     SINGLETON_LOCAL_SEPARATOR,
+    COMPACT_COLUMN_FAMILIES,
+    finalise_members,
     db_exists,
     get_data_db_name,
+    get_db_path,
+    list_column_families,
+    copy_db,
     replace_db,
 )
+from same_thing.decompress import find_blocks, decompress_block
+from same_thing.layout import ALIASES_KEY, LEGACY, COMPACT, LAYOUTS, open_layout
+from same_thing.loadstats import LoadStats
 from same_thing.restore import create_backup, restore_latest_with_name, BackupNotFound
 from same_thing.source import (
     DOWNLOAD_PATH,
@@ -21,26 +52,119 @@ from same_thing.source import (
     get_timestamp,
 )
 
-DBP_GLOBAL_PREFIX = 'https://'
-DBP_GLOBAL_MARKER = 'global.dbpedia.org/id/'
 SNAPSHOT_PREFIX = b'snapshot:'
+LOAD_STATS_PREFIX = b'load:'
+# reserved key in a data DB that is being loaded online, removed once loading completes
+CHECKPOINT_KEY = b'\x00loader:checkpoint'
+BATCH_SIZE = 5000
 QUEUE_SIZE = 40
+# leave one core for splitting lines and writing to the DB
+DECOMPRESSION_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+SORT_WORKERS = DECOMPRESSION_WORKERS
+MAX_BLOCK_MERGES = 3
+LOAD_MODES = ('online', 'offline', 'delta')
 
 
 def get_snapshot_key(snapshot_name):
     return SNAPSHOT_PREFIX + snapshot_name.encode('utf8')
 
 
-async def load_snapshot(snapshot_name):
+def get_load_stats_key(snapshot_name):
+    return LOAD_STATS_PREFIX + snapshot_name.encode('utf8')
+
+
+def iter_completed_snapshots(admin_db):
+    """
+    :return: generator of (snapshot_name, completed_at) strings
+    """
+    keys = admin_db.iterkeys()
+    keys.seek(SNAPSHOT_PREFIX)
+    for key in keys:
+        if not key.startswith(SNAPSHOT_PREFIX):
+            break
+        snapshot_name = key[len(SNAPSHOT_PREFIX):].decode('utf8')
+        yield snapshot_name, admin_db.get(key).decode('utf8')
+
+
+def find_previous_snapshot(admin_db, snapshot_name):
+    """
+    Find the most recently completed snapshot (other than snapshot_name) of which the DB still exists.
     """
-    Load lines from a snapshot into its own DB, using async producer/consumer tasks.
+    completed = [
+        (completed_at, name)
+        for name, completed_at in iter_completed_snapshots(admin_db)
+        if name != snapshot_name and db_exists(get_data_db_name(name))
+    ]
+    return max(completed)[1] if completed else None
+
+
+def read_checkpoint(data_db, snapshot_path):
+    """
+    :return: the checkpoint of an interrupted load of the snapshot file, or None
+    """
+    checkpoint_value = data_db.get(CHECKPOINT_KEY)
+    if checkpoint_value is None:
+        return None
+
+    checkpoint = json.loads(checkpoint_value.decode('utf8'))
+    if checkpoint['file_size'] != os.path.getsize(snapshot_path):
+        # the snapshot file was downloaded again after the checkpoint was made
+        return None
+    return checkpoint
+
+
+def find_checkpoint(db_name, snapshot_path):
+    """
+    Find a data DB in which an earlier online load of the snapshot was interrupted.
+
+    :return: (db_name, checkpoint), or (None, None) if no load can be resumed
+    """
+    for candidate_name in (f'_{db_name}', db_name):
+        if not db_exists(candidate_name):
+            continue
+        candidate_db = get_connection(candidate_name, read_only=True)
+        checkpoint = read_checkpoint(candidate_db, snapshot_path)
+        del candidate_db
+        if checkpoint is not None:
+            return candidate_name, checkpoint
+
+    return None, None
+
+
+async def load_snapshot(snapshot_name, mode='online', batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE,
+                        compressed_chunks=None, layout=LEGACY, aliases=False):
+    """
+    Load lines from a snapshot into its own DB.
+
+    In the `online` mode lines are loaded as they are read, using async
+    producer/consumer tasks. Every batch is written together with a checkpoint,
+    from which an interrupted online load is resumed when it is restarted.
+    The `offline` mode first sorts all records by key, and then writes every
+    key exactly once. The `delta` mode copies the DB of the previous snapshot,
+    and only writes the keys that changed.
+
+    The `compact` layout (see same_thing.layout) can be loaded in the online
+    and offline modes; a delta load of it is done in the offline mode.
+    An interrupted load is resumed in the layout in which it was started,
+    and with aliases only if it was started with them.
+    With `aliases`, pointers from the aliases of each line (see same_thing.uris)
+    are stored as well, in either layout.
 
     :param snapshot_name:
+    :param mode: one of LOAD_MODES
+    :param batch_size: number of lines that are written to the DB at once
+    :param queue_size: maximum number of batches waiting to be written
+    :param compressed_chunks: async iterable of the compressed snapshot, to load it
+        while it is downloaded instead of from the file (in the `online` mode)
+    :param layout: one of LAYOUTS
+    :param aliases: whether to store pointers from aliases, so that lookups need no normalization
     :return:
     """
+    assert mode in LOAD_MODES, f'`mode` should be one of {LOAD_MODES}'
+    assert layout in LAYOUTS, f'`layout` should be one of {LAYOUTS}'
+    assert compressed_chunks is None or mode == 'online', 'only the `online` mode can load a download'
     print_with_timestamp(f'Loading latest downloaded snapshot {snapshot_name}')
     admin_db = get_connection('admin', read_only=False)
-    loop = asyncio.get_event_loop()
     snapshot_key = get_snapshot_key(snapshot_name)
     db_name = get_data_db_name(snapshot_name)
     already_loaded_at = admin_db.get(snapshot_key)
@@ -63,44 +187,166 @@ async def load_snapshot(snapshot_name):
                     'Proceeding to load from the latest downloaded snapshot'
                 )
 
-    if db_exists(db_name):
-        # write new DB to a temporary directory
-        db_name = f'_{db_name}'
-
-    data_db = get_connection(db_name, read_only=False)
     snapshot_path = os.path.join(DOWNLOAD_PATH, get_snapshot_path(snapshot_name))
+    checkpoint = None
+    if mode == 'online' and compressed_chunks is None:
+        resume_db_name, checkpoint = find_checkpoint(db_name, snapshot_path)
+        if checkpoint is not None:
+            print_with_timestamp(
+                f'Resuming the interrupted load into {resume_db_name} '
+                f"after line {checkpoint['line_number']}"
+            )
+            db_name = resume_db_name
 
-    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
-    # schedule the consumer
-    consumer = loop.create_task(consume_lines(queue, data_db))
-    # wait for the producer to read the whole file
-    await produce_lines(queue, snapshot_path)
-    # wait until all lines have been processed
-    await queue.join()
-    # stop waiting for lines
-    consumer.cancel()
+    if checkpoint is None and db_exists(db_name):
+        # write new DB to a temporary directory
+        db_name = f'_{db_name}'
+        if db_exists(db_name):
+            # an incomplete DB of an earlier attempt that cannot be resumed
+            shutil.rmtree(get_db_path(db_name))
+
+    previous_db = None
+    if mode == 'delta':
+        previous_snapshot = find_previous_snapshot(admin_db, snapshot_name)
+        if previous_snapshot is None:
+            print_with_timestamp('No previous snapshot to compare with: loading in offline mode')
+            mode = 'offline'
+        elif layout != LEGACY or list_column_families(get_db_path(get_data_db_name(previous_snapshot))):
+            print_with_timestamp('Only the legacy layout can be compared key by key: loading in offline mode')
+            mode = 'offline'
+        else:
+            print_with_timestamp(f'Copying the DB of the previous snapshot {previous_snapshot}')
+            if db_exists(db_name):
+                # an incomplete DB of an earlier attempt
+                shutil.rmtree(get_db_path(db_name))
+            copy_db(get_data_db_name(previous_snapshot), db_name)
+            previous_db = get_connection(get_data_db_name(previous_snapshot), read_only=True)
+
+    if checkpoint is not None:
+        # the column families of the interrupted load
+        column_family_names = None
+    else:
+        column_family_names = COMPACT_COLUMN_FAMILIES if layout == COMPACT else ()
+    data_db = get_connection(db_name, read_only=False, column_family_names=column_family_names)
+    data_layout = open_layout(data_db)
+    if checkpoint is not None:
+        # the lines before the checkpoint only have alias pointers if the interrupted load stored them
+        if aliases != data_layout.has_aliases:
+            print_with_timestamp(
+                f"Resuming {'with' if data_layout.has_aliases else 'without'} aliases, "
+                f'as the interrupted load was started'
+            )
+        aliases = data_layout.has_aliases
+    elif aliases:
+        data_layout.enable_aliases()
+
+    started_at = time.monotonic()
+    stats = LoadStats(snapshot_name, mode)
+    reporting = asyncio.ensure_future(stats.report_periodically(data_db))
+    try:
+        if mode == 'delta':
+            line_count = await load_delta(data_db, previous_db, snapshot_path, batch_size, stats, aliases)
+        elif mode == 'offline':
+            line_count = await load_sorted(data_layout, snapshot_path, batch_size, stats)
+        else:
+            line_count = await load_lines(
+                data_layout, snapshot_path, batch_size, queue_size, stats, checkpoint, compressed_chunks
+            )
+            await finalise_clusters(data_layout, batch_size, stats)
+            data_db.delete(CHECKPOINT_KEY)
+    finally:
+        reporting.cancel()
+        # let the reporting task finish, so that it no longer refers to the data DB
+        await asyncio.gather(reporting, return_exceptions=True)
+        del previous_db
+        del data_layout
+
+    elapsed = time.monotonic() - started_at
+    print_with_timestamp(
+        f'Loaded {line_count} lines in {elapsed:.0f} seconds '
+        f'({line_count / max(elapsed, 1e-3):.0f} lines/s)'
+    )
+    stats.update_write_stalls(data_db)
+    print_with_timestamp(f'Load statistics: {stats.report()}')
+    admin_db.put(get_load_stats_key(snapshot_name), json.dumps(stats.summary()).encode('utf8'))
+
+    # closing the data DB flushes its memtables, since the WAL is disabled,
+    # so that all of it is in the files that are backed up
+    del data_db
+    print_with_timestamp(f'Loading finished! Saving backup...')
+    create_backup(db_name, snapshot_name, admin_connection=admin_db)
 
     if db_name.startswith('_'):
         # replace the old DB with the newly loaded one
         replace_db(db_name[1:], db_name)
 
-    print_with_timestamp(f'Loading finished! Saving backup...')
+    # the http workers switch to a snapshot once it is marked as completed
     now = get_timestamp()
     admin_db.put(snapshot_key, now.encode('utf8'))
-    create_backup(data_db, snapshot_name, admin_connection=admin_db)
     print_with_timestamp(f'All done, loading completed without errors.')
 
 
-async def produce_lines(queue, snapshot_path):
+async def load_lines(data_layout, snapshot_path, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE, stats=None,
+                     checkpoint=None, compressed_chunks=None):
     """
-    Read lines from the snapshot file, split them, and put them in the queue.
+    Load lines from the snapshot file as they are read, using async producer/consumer tasks.
 
-    :param queue:
+    :param data_layout: layout of the data DB to write to
     :param snapshot_path:
-    :return:
+    :param batch_size: number of lines that are written to the DB at once
+    :param queue_size: maximum number of batches waiting to be written
+    :param stats: LoadStats to record the stages of the load in
+    :param checkpoint: resume an interrupted load from this checkpoint
+    :param compressed_chunks: async iterable of the compressed snapshot, to read instead of the file
+    :return: the number of loaded lines, including those loaded before the checkpoint
+    """
+    loop = asyncio.get_event_loop()
+    stats = stats or LoadStats()
+    queue = asyncio.Queue(maxsize=queue_size)
+    # schedule the consumer
+    consumer = loop.create_task(consume_lines(queue, data_layout, stats))
+    try:
+        # wait for the producer to read the whole file
+        line_count = await unless_failed(
+            consumer, produce_lines(queue, snapshot_path, batch_size, stats, checkpoint, compressed_chunks)
+        )
+        # wait until all lines have been processed
+        await unless_failed(consumer, queue.join())
+    finally:
+        # stop waiting for lines
+        consumer.cancel()
+    return line_count
+
+
+async def unless_failed(watched_task, coroutine):
+    """
+    Await the coroutine, unless the watched task fails first.
+
+    Otherwise, e.g. a producer would wait forever for a consumer that
+    failed to write, instead of stopping the load with its exception.
+    """
+    task = asyncio.ensure_future(coroutine)
+    await asyncio.wait([task, watched_task], return_when=asyncio.FIRST_COMPLETED)
+    if not task.done():
+        task.cancel()
+        # raise the exception of the watched task
+        watched_task.result()
+    return task.result()
+
+
+async def read_snapshot_lines(snapshot_path, stats=None, stream_reader=None):
+    """
+    Read lines from the snapshot file, check the headers, and split the lines.
+
+    :param snapshot_path:
+    :param stats: LoadStats to count decompressed bytes in
+    :param stream_reader: StreamingBZ2File to read the lines with, e.g. to make checkpoints
+    :return: async generator of (local_iri, singleton_id, cluster_id) tuples
     """
-    stream_reader = StreamingBZ2File(snapshot_path)
-    tsv_headers = None
+    if stream_reader is None:
+        stream_reader = StreamingBZ2File(snapshot_path, workers=DECOMPRESSION_WORKERS, stats=stats)
+    # the headers were checked before the checkpoint that is resumed from
+    tsv_headers = None if stream_reader.resume_from is None else True
     async for tsv_line in stream_reader.read_lines():
         if tsv_headers is None:
             tsv_headers = tsv_line.split(b'\t')
@@ -118,83 +364,575 @@ async def produce_lines(queue, snapshot_path):
             )
             continue
 
-        split_line = (local_iri, singleton_id, cluster_id)
-        await queue.put(split_line)
+        yield local_iri, singleton_id, cluster_id
 
 
-async def consume_lines(queue, data_db):
+async def produce_lines(queue, snapshot_path, batch_size=BATCH_SIZE, stats=None, checkpoint=None,
+                        compressed_chunks=None):
     """
-    Take single split lines from the queue and load them into the data_db.
+    Read split lines from the snapshot file, and put them in the queue in batches.
+
+    Each batch is put in the queue with the checkpoint after its last line,
+    so that the consumer can write both at once. Lines that are read from
+    compressed_chunks have no checkpoints.
 
     :param queue:
-    :param data_db:
+    :param snapshot_path:
+    :param batch_size:
+    :param stats: LoadStats to record reading and waiting for the queue in
+    :param checkpoint: resume reading from this checkpoint
+    :param compressed_chunks: async iterable of the compressed snapshot, to read instead of the file
+    :return: the number of lines that were put in the queue, including those before the checkpoint
+    """
+    stats = stats or LoadStats()
+    if compressed_chunks is not None:
+        stream_reader = StreamingBZ2Download(compressed_chunks, stats=stats)
+    else:
+        stream_reader = StreamingBZ2File(
+            snapshot_path, workers=DECOMPRESSION_WORKERS, stats=stats, resumable=True, resume_from=checkpoint,
+        )
+    line_count = checkpoint['lines_loaded'] if checkpoint else 0
+    batch = []
+    batch_started_at = time.perf_counter()
+
+    async def put_batch():
+        nonlocal batch_started_at
+        checkpoint_value = None
+        batch_checkpoint = stream_reader.checkpoint()
+        if batch_checkpoint is not None:
+            batch_checkpoint['lines_loaded'] = line_count
+            checkpoint_value = json.dumps(batch_checkpoint).encode('utf8')
+        stats.sample_queue(queue)
+        with stats.timer('queue_put'):
+            await queue.put((batch, checkpoint_value))
+        stats.count('lines', len(batch))
+        stats.add_time('read', time.perf_counter() - batch_started_at)
+        batch_started_at = time.perf_counter()
+
+    async for split_line in read_snapshot_lines(snapshot_path, stats, stream_reader):
+        batch.append(split_line)
+        if len(batch) >= batch_size:
+            line_count += len(batch)
+            await put_batch()
+            batch = []
+
+    if batch:
+        line_count += len(batch)
+        await put_batch()
+
+    return line_count
+
+
+async def consume_lines(queue, data_layout, stats=None):
+    """
+    Take batches of split lines from the queue and load each batch into the data DB.
+
+    The lines in a batch are committed together with their checkpoint in a single
+    WriteBatch, which is written in a thread, so that the producer can meanwhile
+    prepare the next batch. Since the WAL is disabled, a crash loses the most
+    recent batches, but the checkpoint that survives always matches the lines.
+
+    :param queue:
+    :param data_layout: layout of the data DB to write to
+    :param stats: LoadStats to record writing and waiting for the queue in
     :return:
     """
+    loop = asyncio.get_event_loop()
+    stats = stats or LoadStats()
+    data_db = data_layout.db
     while True:
-        local_iri, singleton_id, cluster_id = await queue.get()
-
-        singleton_and_local = singleton_id + SINGLETON_LOCAL_SEPARATOR + local_iri
-        data_db.merge(cluster_id, singleton_and_local, disable_wal=True)
-        data_db.put(local_iri, cluster_id, disable_wal=True)
-        if not singleton_id == cluster_id:
-            data_db.put(singleton_id, cluster_id, disable_wal=True)
+        with stats.timer('queue_get'):
+            batch, checkpoint_value = await queue.get()
 
+        write_batch = rocksdb.WriteBatch()
+        for split_line in batch:
+            try:
+                data_layout.put_line(write_batch, *split_line)
+            except ValueError as e:
+                print_with_timestamp(f'Skipped a line that does not fit the {data_layout.name} layout: {e}')
+        if checkpoint_value is not None:
+            write_batch.put(CHECKPOINT_KEY, checkpoint_value)
+
+        with stats.timer('write'):
+            await loop.run_in_executor(
+                None, partial(data_db.write, write_batch, disable_wal=True)
+            )
+        stats.count('written_batches')
         queue.task_done()
 
 
+async def finalise_clusters(data_layout, batch_size=BATCH_SIZE, stats=None):
+    """
+    Rewrite each loaded cluster once: deduplicated, sorted, and compactly encoded.
+
+    Iterators read from an implicit snapshot, so the rewritten clusters
+    can safely be written while iterating.
+
+    :param data_layout: layout of the data DB
+    :param batch_size: number of clusters that are written to the DB at once
+    :param stats: LoadStats to record the time spent on finalising in
+    :return: the number of finalised clusters
+    """
+    print_with_timestamp('Finalising clusters...')
+    loop = asyncio.get_event_loop()
+    stats = stats or LoadStats()
+    started_at = time.perf_counter()
+    cluster_count = 0
+    writing = None
+    data_db = data_layout.db
+    write_batch = rocksdb.WriteBatch()
+    for key, value in data_layout.iter_finalised_clusters():
+        write_batch.put(key, value)
+        cluster_count += 1
+        if write_batch.count() >= batch_size:
+            if writing is not None:
+                await writing
+            writing = loop.run_in_executor(
+                None, partial(data_db.write, write_batch, disable_wal=True)
+            )
+            write_batch = rocksdb.WriteBatch()
+
+    if writing is not None:
+        await writing
+    if write_batch.count():
+        data_db.write(write_batch, disable_wal=True)
+
+    stats.add_time('finalise', time.perf_counter() - started_at)
+    stats.count('finalised_clusters', cluster_count)
+    print_with_timestamp(f'Finalised {cluster_count} clusters')
+    return cluster_count
+
+
+async def load_sorted(data_layout, snapshot_path, batch_size=BATCH_SIZE, stats=None):
+    """
+    Load a snapshot offline: sort its records by key in external runs, and write every key once.
+
+    Cluster members are grouped before they are written, so no merge
+    operands reach the DB, and writes in key order keep compactions cheap.
+
+    :param data_layout: layout of the data DB to write to
+    :param snapshot_path:
+    :param batch_size: number of records that are written to the DB at once
+    :param stats: LoadStats to record the stages of the load in
+    :return: the number of loaded lines
+    """
+    stats = stats or LoadStats()
+    with tempfile.TemporaryDirectory(prefix='_sort_', dir=DB_ROOT_PATH) as sort_dir:
+        line_count, run_paths = await sort_records(snapshot_path, sort_dir, stats, data_layout.has_aliases)
+        print_with_timestamp(f'Writing sorted records from {len(run_paths)} runs')
+        await write_grouped_records(data_layout, run_paths, batch_size, stats)
+
+    return line_count
+
+
+async def load_delta(data_db, previous_db, snapshot_path, batch_size=BATCH_SIZE, stats=None, aliases=False):
+    """
+    Load a snapshot as the difference with the previous snapshot.
+
+    The data_db should start as a copy of the previous_db. The records of the
+    new snapshot are sorted by key, and compared with the previous_db in a
+    single pass, so that only added and changed keys are written, and
+    removed keys are deleted.
+
+    :param data_db: copy of the previous snapshot DB
+    :param previous_db: the previous snapshot DB, which is only read
+    :param snapshot_path:
+    :param batch_size: number of changes that are written to the DB at once
+    :param stats: LoadStats to record the stages of the load in
+    :param aliases: whether the new snapshot should have pointers from aliases
+    :return: the number of loaded lines
+    """
+    stats = stats or LoadStats()
+    with tempfile.TemporaryDirectory(prefix='_sort_', dir=DB_ROOT_PATH) as sort_dir:
+        line_count, run_paths = await sort_records(snapshot_path, sort_dir, stats, aliases)
+        print_with_timestamp(f'Comparing sorted records from {len(run_paths)} runs with the previous snapshot')
+        await write_delta(data_db, previous_db, run_paths, batch_size, stats, aliases)
+
+    print_with_timestamp(
+        'Changed keys: ' + ', '.join(f'{stats.counters[change]} {change}' for change in CHANGES)
+    )
+    return line_count
+
+
+async def sort_records(snapshot_path, sort_dir, stats, aliases=False):
+    """
+    Turn the lines of a snapshot into records, and sort them in external runs.
+
+    Runs are sorted in a process pool while the snapshot is being read,
+    and merged until at most MAX_MERGE_FANIN runs are left.
+
+    :param snapshot_path:
+    :param sort_dir: directory for the temporary run files
+    :param stats: LoadStats to record the stages of the sort in
+    :param aliases: whether to add records for the aliases of each line
+    :return: the number of lines, and the paths of the sorted runs
+    """
+    loop = asyncio.get_event_loop()
+    line_count = 0
+    stage_started_at = time.perf_counter()
+    with ProcessPoolExecutor(
+            max_workers=SORT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+    ) as pool:
+
+        def sort_run(split_lines):
+            run_path = get_run_path(sort_dir, len(sorting))
+            return loop.run_in_executor(
+                pool, write_sorted_run, split_lines, run_path, SINGLETON_LOCAL_SEPARATOR, aliases
+            )
+
+        sorting = []
+        split_lines = []
+        async for split_line in read_snapshot_lines(snapshot_path, stats):
+            split_lines.append(split_line)
+            if len(split_lines) >= RUN_SIZE:
+                line_count += len(split_lines)
+                stats.count('lines', len(split_lines))
+                sorting.append(sort_run(split_lines))
+                split_lines = []
+                # limit the number of unsorted runs that are held in memory
+                unsorted = [f for f in sorting if not f.done()]
+                if len(unsorted) > SORT_WORKERS:
+                    await asyncio.wait(unsorted, return_when=asyncio.FIRST_COMPLETED)
+
+        if split_lines:
+            line_count += len(split_lines)
+            stats.count('lines', len(split_lines))
+            sorting.append(sort_run(split_lines))
+
+        stats.add_time('read', time.perf_counter() - stage_started_at)
+        with stats.timer('sort'):
+            run_paths = await asyncio.gather(*sorting)
+        stage_started_at = time.perf_counter()
+        merge_pass = 0
+        while len(run_paths) > MAX_MERGE_FANIN:
+            merge_pass += 1
+            print_with_timestamp(f'Merging {len(run_paths)} sorted runs (pass {merge_pass})')
+            run_paths = await asyncio.gather(*(
+                loop.run_in_executor(
+                    pool,
+                    merge_runs,
+                    run_paths[i:i + MAX_MERGE_FANIN],
+                    get_run_path(sort_dir, i, merge_pass),
+                )
+                for i in range(0, len(run_paths), MAX_MERGE_FANIN)
+            ))
+        stats.add_time('merge', time.perf_counter() - stage_started_at)
+
+    return line_count, run_paths
+
+
+def iter_record_values(run_paths, aliases=False):
+    """
+    :param aliases: whether the records include aliases, which is marked with ALIASES_KEY
+    :return: generator of (key, value) as they are stored in the legacy layout, in key order
+    """
+    if aliases:
+        # sorts before any IRI or ID
+        yield ALIASES_KEY, b'1'
+    for key, tag, values in iter_grouped_records(run_paths):
+        if tag == MEMBER_TAG:
+            yield key, finalise_members(values)
+        else:
+            yield key, values[0]
+
+
+async def write_delta(data_db, previous_db, run_paths, batch_size=BATCH_SIZE, stats=None, aliases=False):
+    """
+    Write the changes between the previous_db and the sorted runs to the data_db.
+
+    :param data_db:
+    :param previous_db:
+    :param run_paths:
+    :param batch_size:
+    :param stats: LoadStats to count the changes in
+    :param aliases: whether the sorted runs include aliases
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    stats = stats or LoadStats()
+    started_at = time.perf_counter()
+    writing = None
+    write_batch = rocksdb.WriteBatch()
+    previous_items = previous_db.iteritems()
+    previous_items.seek_to_first()
+    for change, key, value in iter_delta(previous_items, iter_record_values(run_paths, aliases)):
+        stats.count(change)
+        if change == UNCHANGED:
+            continue
+        elif change == REMOVED:
+            write_batch.delete(key)
+        else:
+            write_batch.put(key, value)
+
+        if write_batch.count() >= batch_size:
+            if writing is not None:
+                await writing
+            writing = loop.run_in_executor(
+                None, partial(data_db.write, write_batch, disable_wal=True)
+            )
+            stats.count('written_batches')
+            write_batch = rocksdb.WriteBatch()
+
+    if writing is not None:
+        await writing
+    if write_batch.count():
+        data_db.write(write_batch, disable_wal=True)
+        stats.count('written_batches')
+    stats.add_time('write', time.perf_counter() - started_at)
+
+
+async def write_grouped_records(data_layout, run_paths, batch_size=BATCH_SIZE, stats=None):
+    """
+    Write merged records to the data DB, while the next batch is being prepared.
+
+    :param data_layout: layout of the data DB to write to
+    :param run_paths:
+    :param batch_size:
+    :param stats: LoadStats to record the time spent on writing in
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    stats = stats or LoadStats()
+    started_at = time.perf_counter()
+    writing = None
+    data_db = data_layout.db
+    write_batch = rocksdb.WriteBatch()
+    for key, tag, values in iter_grouped_records(run_paths):
+        try:
+            data_layout.put_record(write_batch, key, tag, values)
+        except ValueError as e:
+            print_with_timestamp(f'Skipped a record that does not fit the {data_layout.name} layout: {e}')
+        if write_batch.count() >= batch_size:
+            if writing is not None:
+                await writing
+            writing = loop.run_in_executor(
+                None, partial(data_db.write, write_batch, disable_wal=True)
+            )
+            stats.count('written_batches')
+            write_batch = rocksdb.WriteBatch()
+
+    if writing is not None:
+        await writing
+    if write_batch.count():
+        data_db.write(write_batch, disable_wal=True)
+        stats.count('written_batches')
+    stats.add_time('write', time.perf_counter() - started_at)
+
+
 class StreamingBZ2File:
-    # TODO: implement multi-stream decompression
 
-    def __init__(self, file_path, chunk_size=4*1024):
+    def __init__(self, file_path, chunk_size=4*1024, workers=1, stats=None, resumable=False, resume_from=None):
+        """
+        :param file_path:
+        :param chunk_size: number of compressed bytes to read at a time, if read sequentially
+        :param workers: number of processes that decompress blocks in parallel
+        :param stats: LoadStats to count the read and decompressed bytes in
+        :param resumable: read the file block by block, so that `checkpoint()` can be used
+        :param resume_from: a checkpoint, to continue reading after the line at which it was made
+        """
         assert chunk_size > 0, '`chunk_size` needs a non-zero number of bytes'
+        assert workers > 0, '`workers` needs to be a positive number of processes'
         self.decompressor = bz2.BZ2Decompressor()
         self.file_path = file_path
+        self.file_size = None if file_path is None else os.path.getsize(file_path)
         self.chunk_size = chunk_size
+        self.workers = workers
+        self.stats = stats or LoadStats()
+        self.resume_from = resume_from
+        self.resumable = resumable or resume_from is not None
+        if resume_from is not None:
+            assert resume_from['file_size'] == self.file_size, 'the checkpoint was made in another file'
         self.last_line_number = 0
         self.incomplete_line = b''
+        # the block range in which the current line ends, and the incomplete line that precedes it
+        self.piece_start_bit = None
+        self.piece_carry = b''
+        self.lines_in_piece = 0
+
+    def checkpoint(self):
+        """
+        Describe the position after the last line that was read, from which reading can be resumed.
+
+        :return: JSON serializable dict, or None if this position is not known
+        """
+        if not self.resumable or self.piece_start_bit is None:
+            return None
+
+        return {
+            'file_size': self.file_size,
+            'start_bit': self.piece_start_bit,
+            'carry': self.piece_carry.hex(),
+            'lines_in_piece': self.lines_in_piece,
+            'line_number': self.last_line_number,
+        }
 
     async def read_lines(self):
+        skip_lines = 0
         self.last_line_number = 0
         self.incomplete_line = b''
+        if self.resume_from is not None:
+            # read the piece of the checkpoint again, up to its last line
+            skip_lines = self.resume_from['lines_in_piece']
+            self.last_line_number = self.resume_from['line_number'] - skip_lines
+            self.incomplete_line = bytes.fromhex(self.resume_from['carry'])
+
+        async for piece_start_bit, chunk in self.read_chunks():
+            if piece_start_bit is not None:
+                self.piece_start_bit = piece_start_bit
+                self.piece_carry = self.incomplete_line
+                self.lines_in_piece = 0
+
+            if b'\n' not in chunk:
+                # this chunk is so small it doesn't contain any newline
+                self.incomplete_line += chunk
+                continue
+
+            lines = chunk.splitlines()
+            lines[0] = self.incomplete_line + lines[0]
+            if chunk.endswith(b'\n'):
+                self.incomplete_line = b''
+            else:
+                self.incomplete_line = lines.pop()
+
+            for line in lines:
+                self.last_line_number += 1
+                self.lines_in_piece += 1
+                if skip_lines:
+                    skip_lines -= 1
+                    continue
+                yield line
+
+        if self.incomplete_line:
+            self.last_line_number += 1
+            self.lines_in_piece += 1
+            if not skip_lines:
+                yield self.incomplete_line
+
+    async def read_chunks(self):
+        """
+        Yield decompressed chunks in file order, which may end mid-line.
+
+        :return: async generator of (start_bit, chunk), in which start_bit is
+            the offset of the decompressed block range, if it is known
+        """
+        start_bit = self.resume_from['start_bit'] if self.resume_from else 0
+        with tqdm(
+                total=self.file_size,
+                initial=start_bit // 8,
+                unit='b',
+                unit_scale=True,
+                unit_divisor=1024
+        ) as progress_bar:
+            if self.workers > 1 or self.resumable:
+                chunks = self.decompress_parallel(progress_bar, start_bit)
+            else:
+                chunks = self.decompress_sequential(progress_bar)
+
+            while True:
+                # time spent waiting for the next decompressed chunk
+                with self.stats.timer('decompress'):
+                    try:
+                        piece_start_bit, chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                if chunk:
+                    self.stats.count('decompressed_bytes', len(chunk))
+                    yield piece_start_bit, chunk
+
+    async def read_compressed(self):
         async with aiofiles.open(self.file_path, 'rb') as af:
-            file_stats = await stat(af.fileno())
-            with tqdm(
-                    total=file_stats.st_size,
-                    unit='b',
-                    unit_scale=True,
-                    unit_divisor=1024
-            ) as progress_bar:
-
-                while True:
-                    raw_bytes = await af.read(self.chunk_size)
-                    if not raw_bytes:
+            while True:
+                raw_bytes = await af.read(self.chunk_size)
+                if not raw_bytes:
+                    break
+                yield raw_bytes
+
+    async def decompress_sequential(self, progress_bar):
+        async for raw_bytes in self.read_compressed():
+            progress_bar.update(len(raw_bytes))
+            self.stats.count('compressed_bytes', len(raw_bytes))
+            while raw_bytes:
+                # You must construct additional pylons!
+                # (the chunk is empty if not enough bytes have been decompressed)
+                yield None, self.decompressor.decompress(raw_bytes)
+                raw_bytes = b''
+                if self.decompressor.eof:
+                    # continue with the next stream of a multi-stream file
+                    raw_bytes = self.decompressor.unused_data
+                    self.decompressor = bz2.BZ2Decompressor()
+
+    async def decompress_parallel(self, progress_bar, start_bit=0):
+        """
+        Decompress bzip2 blocks in a process pool, and yield them in file order.
+
+        A block range that fails to decompress was delimited by a false
+        positive block magic, so it is merged with the next range and retried.
+
+        :param progress_bar:
+        :param start_bit: offset of the first block to decompress
+        :return: async generator of (start_bit, decompressed bytes) per block range
+        """
+        loop = asyncio.get_event_loop()
+        max_pending = 2 * self.workers
+        pending = deque()
+        with open(self.file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file, \
+                ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                ) as pool:
+
+            block_ranges = find_blocks(mapped_file, start_bit=start_bit)
+
+            def submit(start_bit, end_bit):
+                return loop.run_in_executor(
+                    pool, decompress_block, self.file_path, start_bit, end_bit
+                )
+
+            def fill_pending():
+                while len(pending) < max_pending:
+                    block_range = next(block_ranges, None)
+                    if block_range is None:
+                        break
+                    pending.append((block_range, submit(*block_range)))
+
+            fill_pending()
+            while pending:
+                (start_bit, end_bit), decompressed = pending.popleft()
+                for merge_attempt in range(MAX_BLOCK_MERGES + 1):
+                    try:
+                        chunk = await decompressed
                         break
+                    except (OSError, ValueError, EOFError):
+                        fill_pending()
+                        if merge_attempt == MAX_BLOCK_MERGES or not pending:
+                            raise
+                        (_, end_bit), next_decompressed = pending.popleft()
+                        next_decompressed.cancel()
+                        decompressed = submit(start_bit, end_bit)
 
-                    progress_bar.update(self.chunk_size)
-                    chunk = self.decompressor.decompress(raw_bytes)
-                    if not chunk:
-                        # You must construct additional pylons!
-                        # not enough bytes have been decompressed
-                        continue
-                    elif b'\n' not in chunk:
-                        # this chunk is so small it doesn't contain any newline
-                        self.incomplete_line += chunk
-                        continue
-
-                    lines = chunk.splitlines()
-                    self.last_line_number += 1
-                    yield self.incomplete_line + lines[0]
-                    self.incomplete_line = b''
-
-                    if chunk.endswith(b'\n'):
-                        full_lines = lines[1:]
-                    else:
-                        full_lines = lines[1:-1]
-                        self.incomplete_line = lines[-1]
-
-                    for line in full_lines:
-                        self.last_line_number += 1
-                        yield line
-
-            if self.incomplete_line:
-                yield self.incomplete_line
+                fill_pending()
+                progress_bar.update((end_bit - start_bit) // 8)
+                self.stats.count('compressed_bytes', (end_bit - start_bit) // 8)
+                yield start_bit, chunk
+
+
+class StreamingBZ2Download(StreamingBZ2File):
+    """
+    Decompress a bzip2 file from an async iterable of its compressed chunks,
+    e.g. while it is being downloaded.
+    """
+
+    def __init__(self, compressed_chunks, stats=None):
+        """
+        :param compressed_chunks: async iterable, with the `size` of the whole file if it is known
+            (e.g. a SnapshotStream), to show the progress of decompressing it
+        """
+        super().__init__(None, stats=stats)
+        self.compressed_chunks = compressed_chunks
+        self.file_size = getattr(compressed_chunks, 'size', None)
+
+    async def read_compressed(self):
+        async for raw_bytes in self.compressed_chunks:
+            yield raw_bytes
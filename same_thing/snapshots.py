@@ -0,0 +1,219 @@
+import asyncio
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from same_thing.db import (
+    DB_ROOT_PATH,
+    get_connection,
+    get_data_db_name,
+    get_data_dbs,
+    get_db_path,
+    get_serving_options,
+    db_exists,
+)
+from same_thing.exceptions import NotReady
+from same_thing.layout import open_layout
+from same_thing.sink import iter_completed_snapshots
+from same_thing.source import print_with_timestamp
+from same_thing.static import StaticLayout, find_static_index
+
+MAX_RETRY_SECONDS = 60
+
+
+def get_completed_snapshots():
+    """
+    Read which snapshots completed loading (and when) from the admin DB.
+
+    :return: dict of completion timestamps by snapshot name
+    """
+    if not db_exists('admin'):
+        return {}
+
+    admin_db = get_connection('admin', read_only=True)
+    return dict(iter_completed_snapshots(admin_db))
+
+
+def find_serving_db():
+    """
+    Find the data DB of the most recently completed snapshot.
+
+    Before any snapshot has completed, the most recently modified data DB
+    is served, i.e. the one that is being loaded.
+
+    :return: (db_path, completed_at), in which completed_at may be None
+    """
+    completed = [
+        (datetime.fromisoformat(completed_at), snapshot_name, completed_at)
+        for snapshot_name, completed_at in get_completed_snapshots().items()
+        if db_exists(get_data_db_name(snapshot_name))
+    ]
+    if completed:
+        _, snapshot_name, completed_at = max(completed)
+        return get_db_path(get_data_db_name(snapshot_name)), completed_at
+
+    data_dbs = get_data_dbs()
+    if data_dbs:
+        return max(data_dbs, key=os.path.getmtime), None
+
+    return None, None
+
+
+class SnapshotHandle:
+    """
+    Read-only connection to a data DB in either layout, with its own cluster cache.
+
+    If a static index of the DB was exported, lookups are served from the
+    index instead, and the DB is not opened.
+
+    A retired handle is closed as soon as no lookups are using it anymore.
+    """
+
+    def __init__(self, db_path, completed_at, cache=None):
+        self.db_path = db_path
+        self.completed_at = completed_at
+        self.index_path = find_static_index(db_path)
+        if self.index_path:
+            self.db = None
+            self.layout = StaticLayout(self.index_path)
+        else:
+            self.db = get_connection(db_path, db_options=get_serving_options(), read_only=True)
+            self.layout = open_layout(self.db)
+        self.cache = cache
+        self.in_flight = 0
+        self.retired = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            if self.retired and not self.in_flight:
+                self.close()
+
+    def retire(self):
+        with self.lock:
+            self.retired = True
+            if not self.in_flight:
+                self.close()
+
+    def close(self):
+        # python-rocksdb closes the DB (and mmap the static index) when its last reference is dropped
+        self.db = None
+        self.layout = None
+        self.cache = None
+
+
+class SnapshotManager:
+    """
+    Keeps track of the snapshot that is being served, and switches to a newly
+    completed snapshot between lookups, without restarting the process.
+
+    No snapshot is opened until `watch` runs, i.e. in each worker process after it was forked.
+    """
+
+    def __init__(self, create_cache=None, warm_up=None):
+        """
+        :param create_cache: function that creates the cache of a new snapshot
+        :param warm_up: function that is called with each newly opened snapshot before it is served
+        """
+        self.create_cache = create_cache
+        self.warm_up = warm_up
+        self.current = None
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.current is not None
+
+    def open_handle(self, db_path, completed_at):
+        cache = self.create_cache() if self.create_cache else None
+        handle = SnapshotHandle(db_path, completed_at, cache)
+        if self.warm_up:
+            self.warm_up(handle)
+        return handle
+
+    @contextmanager
+    def connection(self):
+        """
+        Use the current snapshot for the duration of a lookup.
+
+        :return: context manager that yields a SnapshotHandle
+        :raise NotReady: if no snapshot has been opened yet
+        """
+        with self.lock:
+            handle = self.current
+            if handle is None:
+                raise NotReady('No snapshot has been opened yet')
+            handle.acquire()
+        try:
+            yield handle
+        finally:
+            handle.release()
+
+    def swap(self, new_handle):
+        with self.lock:
+            old_handle = self.current
+            self.current = new_handle
+
+        if old_handle is not None:
+            old_handle.retire()
+
+    def refresh(self):
+        """
+        Switch to the most recently completed snapshot, if it is not served yet.
+
+        A snapshot that was opened before it completed loading is reopened,
+        because a read-only connection does not see later writes. A snapshot
+        is also reopened when its static index is exported or removed.
+
+        :return: True if a new snapshot is served
+        """
+        db_path, completed_at = find_serving_db()
+        current = self.current
+        if db_path is None or (
+                current is not None
+                and db_path == current.db_path
+                and completed_at == current.completed_at
+                and find_static_index(db_path) == current.index_path
+        ):
+            return False
+
+        self.swap(self.open_handle(db_path, completed_at))
+        source = f'static index {self.current.index_path}' if self.current.index_path else f'DB {db_path}'
+        print_with_timestamp(f'Switched to snapshot {source} (completed at {completed_at})')
+        return True
+
+    async def watch(self, interval, max_retry_seconds=MAX_RETRY_SECONDS):
+        """
+        Open the latest snapshot, and then periodically check for a newly completed snapshot.
+
+        While no DB can be opened, this is retried with exponential backoff,
+        without blocking the event loop.
+
+        :param interval: number of seconds between checks; 0 to only open the latest snapshot
+        :param max_retry_seconds: maximum number of seconds between attempts to open a snapshot
+        """
+        loop = asyncio.get_event_loop()
+        retry = 0
+        while not self.ready:
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                print_with_timestamp(f'Could not open a snapshot: {e!r}')
+            if not self.ready:
+                wait_seconds = min(2 ** retry, max_retry_seconds)
+                print_with_timestamp(f'No DB was opened in {DB_ROOT_PATH}: will retry in {wait_seconds} seconds')
+                await asyncio.sleep(wait_seconds)
+                retry += 1
+
+        while interval > 0:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                print_with_timestamp(f'Could not check for a new snapshot: {e!r}')
@@ -1,44 +1,63 @@
 import asyncio
+import hashlib
+import json
 import os
 import shutil
 from datetime import datetime, timezone
 from urllib.parse import urlencode, quote_plus
 
-import aiofiles
 import aiohttp
 from tqdm import tqdm
 
+from same_thing.config import env_int
 from same_thing.sparql_queries import latest_global_ids
 
-DOWNLOAD_PATH = '/downloads'
+DOWNLOAD_PATH = os.environ.get('SAME_THING_DOWNLOAD_PATH', '/downloads')
+DATABUS_SPARQL_URL = os.environ.get('SAME_THING_DATABUS_SPARQL_URL', 'https://databus.dbpedia.org/repo/sparql')
 SNAPSHOT_FILENAME = 'global-ids_base58.tsv.bz2'
-DOWNLOAD_TIMEOUT = 40 * 60
+# number of byte ranges that are downloaded in parallel, and the size of each range
+DOWNLOAD_CONNECTIONS = env_int('SAME_THING_DOWNLOAD_CONNECTIONS', 8)
+DOWNLOAD_PART_MB = env_int('SAME_THING_DOWNLOAD_PART_MB', 64)
+DOWNLOAD_RETRIES = env_int('SAME_THING_DOWNLOAD_RETRIES', 5)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# give up on a stalled connection, rather than on a download that takes long
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=120)
+# sidecar file with the completed parts, which only exists while a download is incomplete
+DOWNLOAD_STATE_SUFFIX = '.download.json'
 
 
-async def fetch_latest_snapshot():
-    existing_downloads = set(os.listdir(DOWNLOAD_PATH))
+class DownloadError(IOError):
+    pass
+
+
+def open_session():
+    conn = aiohttp.TCPConnector(limit_per_host=max(10, DOWNLOAD_CONNECTIONS))
+    return aiohttp.ClientSession(connector=conn, raise_for_status=True)
+
 
-    conn = aiohttp.TCPConnector(limit_per_host=10)
-    async with aiohttp.ClientSession(connector=conn, raise_for_status=True) as session:
-        latest_snapshot, snapshot_url = await find_latest_snapshot(session)
-        if latest_snapshot not in existing_downloads:
-            # delete older snapshots
-            for old_snapshot in existing_downloads:
-                shutil.rmtree(os.path.join(DOWNLOAD_PATH, old_snapshot))
+async def fetch_latest_snapshot():
+    async with open_session() as session:
+        latest_snapshot, snapshot_url, sha256sum = await find_latest_snapshot(session)
+        if not is_downloaded(latest_snapshot):
+            remove_old_downloads(latest_snapshot)
 
             # download new snapshot
-            await asyncio.gather(
-                download_snapshot(session, latest_snapshot, snapshot_url)
-            )
+            await download_snapshot(session, latest_snapshot, snapshot_url, sha256sum)
             print_with_timestamp(f'Saved new snapshot {latest_snapshot}')
 
     return latest_snapshot
 
 
+def remove_old_downloads(latest_snapshot):
+    # delete older snapshots, but keep an incomplete download of the latest one
+    for old_snapshot in set(os.listdir(DOWNLOAD_PATH)) - {latest_snapshot}:
+        shutil.rmtree(os.path.join(DOWNLOAD_PATH, old_snapshot))
+
+
 async def find_latest_snapshot(session):
     payload = {'query': latest_global_ids}
     parameters = urlencode(payload, quote_via=quote_plus)
-    sparql_request_url = f'https://databus.dbpedia.org/repo/sparql?{parameters}'
+    sparql_request_url = f'{DATABUS_SPARQL_URL}?{parameters}'
     sparql_json_mime = 'application/sparql-results+json'
     headers = {'Accept': sparql_json_mime}
     async with session.get(sparql_request_url, headers=headers) as resp:
@@ -54,47 +73,353 @@ async def find_latest_snapshot(session):
     first_binding = global_json['results']['bindings'][0]
     snapshot_name = first_binding['latest']['value']
     snapshot_url = first_binding['file']['value']
-    return snapshot_name, snapshot_url
+    # not every Databus distribution has a checksum
+    sha256sum = first_binding.get('sha256sum', {}).get('value')
+    return snapshot_name, snapshot_url, sha256sum
 
 
-async def download_snapshot(session, snapshot_name, snapshot_url):
+async def download_snapshot(session, snapshot_name, snapshot_url, sha256sum=None):
     destination_dir = os.path.join(DOWNLOAD_PATH, snapshot_name)
-    await download_file(session, snapshot_url, destination_dir)
+    await download_file(session, snapshot_url, destination_dir, sha256sum)
 
 
 def get_snapshot_path(snapshot_name):
     return f'{snapshot_name}/{SNAPSHOT_FILENAME}'
 
 
-async def download_file(session, url, destination_dir=DOWNLOAD_PATH):
-    async with session.get(url, timeout=DOWNLOAD_TIMEOUT) as response:
-        filename = os.path.basename(url)
-        filepath = os.path.join(destination_dir, filename)
-        print_with_timestamp(f'Downloading {filename} to {destination_dir}')
+def get_download_state_path(file_path):
+    return file_path + DOWNLOAD_STATE_SUFFIX
+
+
+def is_downloaded(snapshot_name):
+    snapshot_path = os.path.join(DOWNLOAD_PATH, get_snapshot_path(snapshot_name))
+    return os.path.exists(snapshot_path) and not os.path.exists(get_download_state_path(snapshot_path))
+
+
+async def download_file(session, url, destination_dir=DOWNLOAD_PATH, sha256sum=None,
+                        connections=DOWNLOAD_CONNECTIONS, part_size=DOWNLOAD_PART_MB * 1024 ** 2):
+    """
+    Download a file in parts, with parallel HTTP Range requests, into a preallocated file.
+
+    The completed parts are kept in a sidecar file, so that an interrupted
+    download resumes with the missing parts. If the server does not support
+    range requests, the file is downloaded in a single request.
+
+    :param session:
+    :param url:
+    :param destination_dir:
+    :param sha256sum: expected checksum of the file, if it is known
+    :param connections: number of parts that are downloaded at once
+    :param part_size: number of bytes in each part
+    :return:
+    """
+    filename = os.path.basename(url)
+    filepath = os.path.join(destination_dir, filename)
+    state_path = get_download_state_path(filepath)
+    os.makedirs(destination_dir, exist_ok=True)
+
+    size, accepts_ranges, etag = await get_download_info(session, url)
+    if size is not None and accepts_ranges:
+        parts = [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+    else:
+        # an open-ended request can't be resumed
+        parts = [(0, None)]
+        part_size = None
+
+    state = {'url': url, 'size': size, 'etag': etag, 'part_size': part_size, 'completed_parts': []}
+    previous_state = read_download_state(state_path)
+    if os.path.exists(filepath) and previous_state is None:
+        raise IOError(f'The destination path already exists: {filepath}')
+
+    resume = (
+        previous_state is not None
+        and part_size is not None
+        and all(previous_state.get(key) == state[key] for key in ('url', 'size', 'etag', 'part_size'))
+    )
+    if resume:
+        state['completed_parts'] = previous_state['completed_parts']
+        print_with_timestamp(
+            f"Resuming download of {filename}: {len(state['completed_parts'])} of {len(parts)} parts completed"
+        )
+    else:
+        print_with_timestamp(f'Downloading {filename} to {destination_dir} in {len(parts)} parts')
+    write_download_state(state_path, state)
+
+    loop = asyncio.get_event_loop()
+    completed_parts = set(state['completed_parts'])
+    file_descriptor = os.open(filepath, os.O_RDWR | os.O_CREAT | (0 if resume else os.O_TRUNC))
+    try:
+        if size is not None and not resume:
+            preallocate(file_descriptor, size)
+
+        semaphore = asyncio.Semaphore(connections)
+        with tqdm(
+            total=size,
+            initial=sum(parts[index][1] - parts[index][0] for index in completed_parts),
+            desc=filename,
+            unit='b',
+            unit_scale=True,
+            unit_divisor=1024
+        ) as progress_bar:
+            async def fetch_part(index):
+                start, end = parts[index]
+                async with semaphore:
+                    await download_part(session, url, file_descriptor, start, end, progress_bar)
+                    # the part is only marked as completed once it is on disk
+                    await loop.run_in_executor(None, os.fsync, file_descriptor)
+                completed_parts.add(index)
+                state['completed_parts'] = sorted(completed_parts)
+                write_download_state(state_path, state)
+
+            fetching = [
+                asyncio.ensure_future(fetch_part(index))
+                for index in range(len(parts)) if index not in completed_parts
+            ]
+            try:
+                await asyncio.gather(*fetching)
+            except BaseException:
+                # stop writing before the file is closed
+                for task in fetching:
+                    task.cancel()
+                await asyncio.gather(*fetching, return_exceptions=True)
+                raise
+    finally:
+        os.close(file_descriptor)
+
+    if sha256sum:
+        print_with_timestamp(f'Verifying the SHA-256 checksum of {filename}')
+        file_sha256sum = await loop.run_in_executor(None, get_sha256sum, filepath)
+        if file_sha256sum != sha256sum.lower():
+            # start over the next time
+            os.remove(filepath)
+            os.remove(state_path)
+            raise IOError(f'Checksum of {filename} is {file_sha256sum}, but {sha256sum} was expected')
+    else:
+        print_with_timestamp(f'No checksum is available to verify {filename}')
+
+    os.remove(state_path)
+    print_with_timestamp(f'Finished downloading {filename}')
+
+
+async def stream_snapshot(session, snapshot_name, snapshot_url, sha256sum=None):
+    """
+    Start downloading a snapshot, to load it while it is downloaded.
+
+    :return: SnapshotStream
+    """
+    snapshot_stream = SnapshotStream(session, snapshot_name, snapshot_url, sha256sum)
+    await snapshot_stream.prepare()
+    return snapshot_stream
+
+
+class SnapshotStream:
+    """
+    Async iterable of the compressed chunks of a snapshot, each of which is
+    yielded once it is written to the file.
+
+    If the download is interrupted, the parts that were completely written are
+    kept as completed parts, so that `download_file` can resume the download.
+    Conversely, the completed parts of an interrupted download are read from
+    the file, and only the rest is requested.
+    """
 
-        if os.path.exists(destination_dir):
-            if os.path.exists(filepath):
-                raise IOError(f'The destination path already exists: {filepath}')
+    def __init__(self, session, snapshot_name, snapshot_url, sha256sum=None):
+        self.session = session
+        self.url = snapshot_url
+        self.sha256sum = sha256sum
+        destination_dir = os.path.join(DOWNLOAD_PATH, snapshot_name)
+        os.makedirs(destination_dir, exist_ok=True)
+        self.filename = os.path.basename(snapshot_url)
+        self.filepath = os.path.join(destination_dir, self.filename)
+        self.state_path = get_download_state_path(self.filepath)
+        # the content length, if it is known
+        self.size = None
+        self.state = None
+        # the number of bytes at the start of the file that were already downloaded
+        self.resume_offset = 0
+
+    async def prepare(self):
+        """
+        Request the size of the snapshot, and decide whether to resume or remove an earlier download.
+        """
+        self.size, accepts_ranges, etag = await get_download_info(self.session, self.url)
+        part_size = DOWNLOAD_PART_MB * 1024 ** 2 if self.size is not None and accepts_ranges else None
+        self.state = {'url': self.url, 'size': self.size, 'etag': etag, 'part_size': part_size, 'completed_parts': []}
+
+        previous_state = read_download_state(self.state_path)
+        if os.path.exists(self.filepath):
+            resumable = (
+                previous_state is not None
+                and part_size is not None
+                and all(previous_state.get(key) == self.state[key] for key in ('url', 'size', 'etag', 'part_size'))
+            )
+            if resumable:
+                # only the parts from the start of the file can be streamed
+                completed_parts = set(previous_state['completed_parts'])
+                leading_parts = 0
+                while leading_parts in completed_parts:
+                    leading_parts += 1
+                self.state['completed_parts'] = list(range(leading_parts))
+                self.resume_offset = min(leading_parts * part_size, self.size)
+            if not self.resume_offset:
+                print_with_timestamp(f'Removing the earlier download of {self.filename}, which cannot be resumed')
+                os.remove(self.filepath)
+
+        write_download_state(self.state_path, self.state)
+        if self.resume_offset:
+            print_with_timestamp(
+                f'Resuming download of {self.filename} from byte {self.resume_offset} while it is loaded'
+            )
         else:
-            os.makedirs(destination_dir)
-
-        async with aiofiles.open(filepath, 'wb') as af:
-            with tqdm(
-                total=response.content_length,
-                desc=filename,
-                unit='b',
-                unit_scale=True,
-                unit_divisor=1024
-            ) as progress_bar:
-                chunk_size = 4 * 1024
+            print_with_timestamp(f'Downloading {self.filename} to {os.path.dirname(self.filepath)} while it is loaded')
+
+    def __aiter__(self):
+        return self.iter_chunks()
+
+    async def iter_chunks(self):
+        """
+        :return: async generator of compressed chunks
+        :raises DownloadError: if the download is interrupted, or the checksum doesn't match
+        """
+        assert self.state is not None, '`prepare` should be awaited first'
+        loop = asyncio.get_event_loop()
+        sha256 = hashlib.sha256()
+        offset = 0
+        with open(self.filepath, 'r+b' if self.resume_offset else 'wb') as snapshot_file:
+            while offset < self.resume_offset:
+                chunk = await loop.run_in_executor(
+                    None, snapshot_file.read, min(DOWNLOAD_CHUNK_SIZE, self.resume_offset - offset)
+                )
+                if not chunk:
+                    raise DownloadError(f'{self.filename} ended at byte {offset} instead of {self.resume_offset}')
+                sha256.update(chunk)
+                offset += len(chunk)
+                yield chunk
+
+            try:
+                if self.size is None or offset < self.size:
+                    headers = {'Range': f'bytes={offset}-'} if offset else {}
+                    async with self.session.get(self.url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                        if offset and response.status != 206:
+                            raise DownloadError(
+                                f'{self.url} did not respond with the requested range: {response.status}'
+                            )
+                        while True:
+                            chunk = await response.content.read(DOWNLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            await loop.run_in_executor(None, snapshot_file.write, chunk)
+                            sha256.update(chunk)
+                            offset += len(chunk)
+                            yield chunk
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                part_size = self.state['part_size']
+                if part_size is not None:
+                    snapshot_file.flush()
+                    os.fsync(snapshot_file.fileno())
+                    self.state['completed_parts'] = list(range(offset // part_size))
+                    write_download_state(self.state_path, self.state)
+                raise DownloadError(f'Downloading {self.filename} was interrupted at byte {offset}: {e!r}') from e
+
+            # e.g. a preallocated file of an earlier download
+            snapshot_file.truncate()
+
+        if self.sha256sum and sha256.hexdigest() != self.sha256sum.lower():
+            # start over the next time
+            os.remove(self.filepath)
+            os.remove(self.state_path)
+            raise DownloadError(
+                f'Checksum of {self.filename} is {sha256.hexdigest()}, but {self.sha256sum} was expected'
+            )
+
+        os.remove(self.state_path)
+        print_with_timestamp(f'Finished downloading {self.filename}')
+
+
+async def get_download_info(session, url):
+    """
+    :return: (content length or None, whether byte ranges are accepted, ETag or None)
+    """
+    try:
+        async with session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            return (
+                response.content_length,
+                response.headers.get('Accept-Ranges') == 'bytes',
+                response.headers.get('ETag'),
+            )
+    except aiohttp.ClientResponseError as e:
+        print_with_timestamp(f'Could not HEAD {url}: {e!r}')
+        return None, False, None
+
+
+async def download_part(session, url, file_descriptor, start, end, progress_bar):
+    """
+    Write the bytes from start up to end of the URL at the same offset in the file.
+
+    A failed request is retried from the offset at which it stopped,
+    or from the start if the part is open-ended (end is None).
+    """
+    loop = asyncio.get_event_loop()
+    offset = start
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        headers = {} if end is None else {'Range': f'bytes={offset}-{end - 1}'}
+        try:
+            async with session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                if end is not None and response.status != 206:
+                    raise IOError(f'{url} did not respond with the requested range: {response.status}')
                 while True:
-                    chunk = await response.content.read(chunk_size)
+                    chunk = await response.content.read(DOWNLOAD_CHUNK_SIZE)
                     if not chunk:
                         break
-                    await af.write(chunk)
-                    progress_bar.update(chunk_size)
+                    await loop.run_in_executor(None, os.pwrite, file_descriptor, chunk, offset)
+                    offset += len(chunk)
+                    progress_bar.update(len(chunk))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
+        else:
+            if end is None or offset >= end:
+                return
+            error = IOError(f'The response ended at byte {offset} instead of {end}')
 
-    print_with_timestamp(f'Finished downloading {filename}')
+        if attempt == DOWNLOAD_RETRIES:
+            raise error
+        print_with_timestamp(f'Retrying download of {url} from byte {offset} after: {error!r}')
+        await asyncio.sleep(2 ** attempt)
+        if end is None:
+            progress_bar.update(start - offset)
+            offset = start
+
+
+def preallocate(file_descriptor, size):
+    try:
+        os.posix_fallocate(file_descriptor, 0, size)
+    except (AttributeError, OSError):
+        # e.g. not supported by the platform or the file system
+        os.ftruncate(file_descriptor, size)
+
+
+def read_download_state(state_path):
+    if not os.path.exists(state_path):
+        return None
+
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def write_download_state(state_path, state):
+    # replace the state file atomically, so that it is never incomplete
+    temporary_path = state_path + '.tmp'
+    with open(temporary_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, state_path)
+
+
+def get_sha256sum(file_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as snapshot_file:
+        for chunk in iter(lambda: snapshot_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 
 def get_timestamp():
@@ -0,0 +1,339 @@
+"""
+Static index of a loaded snapshot: a read-only file that is memory-mapped
+by every http worker, so that they share it through the page cache.
+
+The file starts with a header, followed by a hash table of SLOT slots,
+the cluster records, and the key entries:
+- a slot holds the fingerprint of a key's hash, and the file offset of its key entry (0 if empty)
+- a key entry is the length-prefixed key (a local IRI, singleton ID or global ID, or
+  an alias if the snapshot was loaded with aliases), followed by the offset of its cluster record
+- a cluster record is the length-prefixed global ID, followed by the length-prefixed,
+  finalised value of its cluster (see `same_thing.db.finalise_members`)
+
+Every key points to its cluster record directly, so a URI is resolved
+with a single probe, however it was given.
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from same_thing.config import env_bool
+from same_thing.db import (
+    DB_ROOT_PATH,
+    FINALISED_MARKER,
+    decode_varint,
+    encode_varint,
+    get_connection,
+    get_data_db_name,
+    get_db_path,
+    get_static_index_path,
+)
+from same_thing.layout import LegacyLayout, open_layout
+from same_thing.metrics import LOOKUP_STAGE_SECONDS
+from same_thing.source import print_with_timestamp
+from same_thing.uris import UriKey, get_alias_key, get_aliases, normalize_uri
+
+MAGIC = b'SAMETHNG'
+VERSION = 2
+# magic, version, flags, slot count, key count, cluster count, slots offset, records offset, keys offset
+HEADER = struct.Struct('<8sIIQQQQQQ')
+# the index has the aliases of the snapshot's lines as keys (see `same_thing.uris.get_aliases`)
+FLAG_ALIASES = 1
+# fingerprint, key entry offset
+SLOT = struct.Struct('<IQ')
+MAX_LOAD_FACTOR = 0.7
+SERVE_STATIC_INDEX = env_bool('SAME_THING_STATIC_INDEX', True)
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def find_static_index(db_path):
+    """
+    :return: the path of the static index of a data DB, or None if it should be served from RocksDB
+    """
+    index_path = get_static_index_path(db_path)
+    if SERVE_STATIC_INDEX and os.path.isfile(index_path):
+        return index_path
+    return None
+
+
+def encode_cluster(members):
+    """
+    :param members: list of unique (singleton_id, local_iri) bytes, in the order in which they are returned
+    :return: finalised cluster value
+    """
+    encoded = [FINALISED_MARKER, encode_varint(len(members))]
+    for singleton, local_iri in members:
+        encoded.extend((
+            encode_varint(len(singleton)), singleton,
+            encode_varint(len(local_iri)), local_iri,
+        ))
+    return b''.join(encoded)
+
+
+def export_static_index(db_name):
+    """
+    Build the static index of a data DB (in either layout), and replace
+    the previous index of that DB atomically.
+
+    :return: the path of the index
+    """
+    index_path = get_static_index_path(db_name)
+    data_db = get_connection(db_name, read_only=True)
+    layout = open_layout(data_db)
+    started_at = time.monotonic()
+    print_with_timestamp(f'Exporting a static index of {get_db_path(db_name)}')
+    with tempfile.TemporaryDirectory(prefix='_static_', dir=DB_ROOT_PATH) as work_dir:
+        records_path = os.path.join(work_dir, 'records')
+        keys_path = os.path.join(work_dir, 'keys')
+        cluster_count, key_count = write_sections(layout, records_path, keys_path)
+        flags = FLAG_ALIASES if layout.has_aliases else 0
+        del layout, data_db
+
+        slot_count = 1
+        while slot_count * MAX_LOAD_FACTOR < key_count:
+            slot_count *= 2
+        slots_offset = HEADER.size
+        records_offset = slots_offset + slot_count * SLOT.size
+        keys_offset = records_offset + os.path.getsize(records_path)
+
+        temporary_path = index_path + '.tmp'
+        with open(temporary_path, 'wb') as index_file:
+            index_file.write(HEADER.pack(
+                MAGIC, VERSION, flags, slot_count, key_count, cluster_count,
+                slots_offset, records_offset, keys_offset,
+            ))
+            index_file.truncate(records_offset)
+            index_file.seek(records_offset)
+            for section_path in (records_path, keys_path):
+                with open(section_path, 'rb') as section_file:
+                    shutil.copyfileobj(section_file, index_file, 16 * 1024**2)
+
+    with open(temporary_path, 'r+b') as index_file:
+        index = mmap.mmap(index_file.fileno(), 0)
+        try:
+            fill_slots(index, slot_count, slots_offset, keys_offset)
+            index.flush()
+        finally:
+            index.close()
+        os.fsync(index_file.fileno())
+    os.replace(temporary_path, index_path)
+
+    print_with_timestamp(
+        f'Exported {cluster_count} clusters and {key_count} keys to {index_path} '
+        f'in {time.monotonic() - started_at:.0f} seconds'
+    )
+    return index_path
+
+
+def write_sections(layout, records_path, keys_path):
+    """
+    Write a record per cluster, and a key entry for each of its keys,
+    including the aliases of its members if the layout has them.
+
+    :return: the number of clusters and keys
+    """
+    cluster_count = 0
+    key_count = 0
+    record_offset = 0
+    with open(records_path, 'wb') as records_file, open(keys_path, 'wb') as keys_file:
+        for cluster_id, value_bytes in layout.iter_clusters():
+            members = [
+                (layout.decode_singleton(singleton).encode('utf8'), local_iri)
+                for singleton, local_iri in layout.iter_members(value_bytes)
+            ]
+            global_id = layout.get_global_id(cluster_id).encode('utf8')
+            value_bytes = encode_cluster(members)
+            record = b''.join((
+                encode_varint(len(global_id)), global_id,
+                encode_varint(len(value_bytes)), value_bytes,
+            ))
+            records_file.write(record)
+
+            keys = {global_id}
+            for singleton, local_iri in members:
+                keys.add(singleton)
+                keys.add(local_iri)
+                if layout.has_aliases:
+                    keys.update(get_aliases(local_iri, singleton, global_id))
+            encoded_offset = encode_varint(record_offset)
+            keys_file.write(b''.join(
+                encode_varint(len(key)) + key + encoded_offset for key in keys
+            ))
+            key_count += len(keys)
+            cluster_count += 1
+            record_offset += len(record)
+
+    return cluster_count, key_count
+
+
+def fill_slots(index, slot_count, slots_offset, keys_offset):
+    """
+    Insert every key entry in the hash table, with linear probing.
+
+    A key that occurs in more than one cluster keeps its first cluster.
+    """
+    mask = slot_count - 1
+    position = keys_offset
+    while position < len(index):
+        entry_offset = position
+        length, key_start = decode_varint(index, position)
+        key = index[key_start:key_start + length]
+        _, position = decode_varint(index, key_start + length)
+
+        key_hash = hash_key(key)
+        fingerprint = key_hash >> 32
+        slot = key_hash & mask
+        while True:
+            slot_fingerprint, slot_entry = SLOT.unpack_from(index, slots_offset + slot * SLOT.size)
+            if not slot_entry:
+                SLOT.pack_into(index, slots_offset + slot * SLOT.size, fingerprint, entry_offset)
+                break
+            elif slot_fingerprint == fingerprint:
+                slot_length, slot_key_start = decode_varint(index, slot_entry)
+                if index[slot_key_start:slot_key_start + slot_length] == key:
+                    break
+            slot = (slot + 1) & mask
+
+
+class StaticLayout(LegacyLayout):
+    """
+    Serve lookups from a static index instead of a data DB.
+
+    Cluster values are stored as in a finalised legacy layout, and are decoded as such.
+    As in the other layouts, URIs are looked up as they were given if the index has
+    aliases, and are only normalized if they were not found.
+    """
+    name = 'static'
+    # read from the header of the index
+    slot_count: int
+    key_count: int
+    cluster_count: int
+    slots_offset: int
+    records_offset: int
+    keys_offset: int
+
+    def __init__(self, index_path):
+        super().__init__(None)
+        self.index_path = index_path
+        with open(index_path, 'rb') as index_file:
+            self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic, version, flags, self.slot_count, self.key_count, self.cluster_count,
+            self.slots_offset, self.records_offset, self.keys_offset,
+        ) = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{index_path} is not a static index of version {VERSION}')
+        self.has_aliases = bool(flags & FLAG_ALIASES)
+        self.mask = self.slot_count - 1
+
+    def find_record(self, key: bytes) -> Optional[int]:
+        """
+        :return: the offset of the cluster record of a key, or None if it was not found
+        """
+        index = self.index
+        key_hash = hash_key(key)
+        fingerprint = key_hash >> 32
+        slot = key_hash & self.mask
+        while True:
+            slot_fingerprint, entry_offset = SLOT.unpack_from(index, self.slots_offset + slot * SLOT.size)
+            if not entry_offset:
+                return None
+            elif slot_fingerprint == fingerprint:
+                length, key_start = decode_varint(index, entry_offset)
+                if index[key_start:key_start + length] == key:
+                    return self.records_offset + decode_varint(index, key_start + length)[0]
+            slot = (slot + 1) & self.mask
+
+    def read_record(self, record_offset: int) -> Tuple[bytes, bytes]:
+        """
+        :return: the cluster ID and value of a cluster record
+        """
+        index = self.index
+        length, position = decode_varint(index, record_offset)
+        cluster_id = index[position:position + length]
+        length, position = decode_varint(index, position + length)
+        return cluster_id, index[position:position + length]
+
+    def iter_clusters(self, start: Optional[bytes] = None, end: Optional[bytes] = None):
+        """
+        :return: generator of (cluster_id, value) of all clusters in the range, in key order
+        """
+        record_offset = self.records_offset
+        while record_offset < self.keys_offset:
+            length, position = decode_varint(self.index, record_offset)
+            cluster_id = self.index[position:position + length]
+            length, position = decode_varint(self.index, position + length)
+            record_offset = position + length
+            if end is not None and cluster_id >= end:
+                break
+            if start is None or cluster_id >= start:
+                yield cluster_id, self.index[position:record_offset]
+
+    def resolve_cluster_ids(
+            self,
+            uri_keys: Dict[str, UriKey],
+    ) -> Tuple[Dict[str, bytes], Dict[bytes, Optional[bytes]]]:
+        """
+        Find the cluster of each URI with a single probe, or with a second
+        probe for its normalized alias if the URI was not found as given.
+
+        :param uri_keys: URI key (see `get_uri_key`) by URI
+        :return: the cluster ID of each found URI, and the fetched cluster values
+        """
+        cluster_ids: Dict[str, bytes] = {}
+        values: Dict[bytes, Optional[bytes]] = {}
+        with LOOKUP_STAGE_SECONDS.time(stage='get_lookup_id'):
+            for uri, (_, key) in uri_keys.items():
+                record_offset = self.find_record(key)
+                if record_offset is None and self.has_aliases:
+                    alias_key = get_alias_key(normalize_uri(uri))
+                    if alias_key != key:
+                        record_offset = self.find_record(alias_key)
+                if record_offset is not None:
+                    cluster_id, value_bytes = self.read_record(record_offset)
+                    cluster_ids[uri] = cluster_id
+                    values[cluster_id] = value_bytes
+
+        return cluster_ids, values
+
+    def get_cluster_values(self, cluster_ids: List[bytes]) -> Dict[bytes, Optional[bytes]]:
+        values: Dict[bytes, Optional[bytes]] = {}
+        with LOOKUP_STAGE_SECONDS.time(stage='get_cluster'):
+            for cluster_id in cluster_ids:
+                record_offset = self.find_record(cluster_id)
+                values[cluster_id] = None if record_offset is None else self.read_record(record_offset)[1]
+
+        return values
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Export a static index of a loaded snapshot, to serve lookups from.'
+    )
+    parser.add_argument(
+        'snapshot', nargs='?',
+        help='name of the snapshot, e.g. 2020.03.01 (default: the most recently completed snapshot)',
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from same_thing.snapshots import find_serving_db
+
+    args = parse_args()
+    if args.snapshot:
+        db_name = get_data_db_name(args.snapshot)
+    else:
+        db_name, _ = find_serving_db()
+    if db_name is None:
+        raise SystemExit(f'No DBs found in {DB_ROOT_PATH}')
+    export_static_index(db_name)
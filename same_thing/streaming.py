@@ -0,0 +1,105 @@
+import zlib
+from typing import AsyncIterator, List, Optional, Union
+
+# accept zlib and gzip headers alike
+GZIP_WBITS = 32 + zlib.MAX_WBITS
+MAX_LINE_BYTES = 64 * 1024
+
+
+class LineTooLong(ValueError):
+    pass
+
+
+async def iter_decompressed(
+        chunks: AsyncIterator[bytes],
+        max_length: int,
+) -> AsyncIterator[bytes]:
+    """
+    Decompress a gzip or zlib stream, in pieces of at most `max_length` bytes,
+    so that a small chunk cannot expand without limit.
+
+    A stream of concatenated gzip members (e.g. of `cat a.gz b.gz`) is decompressed as a whole.
+
+    :raise zlib.error: if the stream is not valid gzip or zlib data
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    async for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk, max_length)
+            chunk = decompressor.unconsumed_tail
+            if decompressor.eof and decompressor.unused_data:
+                # the start of the next member
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+
+    yield decompressor.flush()
+
+
+async def iter_lines(
+        chunks: AsyncIterator[bytes],
+        gzipped: bool = False,
+        max_line_bytes: int = MAX_LINE_BYTES,
+) -> AsyncIterator[Union[str, LineTooLong]]:
+    """
+    Split a (compressed) stream of bytes into lines, as it arrives.
+
+    At most one line is buffered at a time. A line that is longer than
+    `max_line_bytes` is skipped, and a LineTooLong error is yielded in its place.
+
+    :param chunks: the request body, in chunks of any size
+    :param gzipped: whether the body is gzip or zlib compressed
+    :return: async generator of stripped, non-empty lines (or errors)
+    """
+    if gzipped:
+        chunks = iter_decompressed(chunks, max_line_bytes)
+
+    buffer = b''
+    skipping = False
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if skipping:
+                # the remainder of a line that was too long
+                skipping = False
+                continue
+
+            if len(line) > max_line_bytes:
+                yield LineTooLong(f'lines can be at most {max_line_bytes} bytes long')
+                continue
+
+            uri = line.decode('utf8', errors='replace').strip()
+            if uri:
+                yield uri
+
+        if len(buffer) > max_line_bytes:
+            if not skipping:
+                yield LineTooLong(f'lines can be at most {max_line_bytes} bytes long')
+            skipping = True
+            buffer = b''
+
+    uri = buffer.decode('utf8', errors='replace').strip()
+    if uri and not skipping:
+        yield uri
+
+
+async def iter_batches(
+        items: AsyncIterator[Union[str, LineTooLong]],
+        batch_size: int,
+) -> AsyncIterator[List[Union[str, LineTooLong]]]:
+    batch: List[Union[str, LineTooLong]] = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def is_gzipped(content_encoding: Optional[str], content_type: Optional[str]) -> bool:
+    return (
+        (content_encoding or '').lower() in ('gzip', 'x-gzip', 'deflate')
+        or (content_type or '').startswith(('application/gzip', 'application/x-gzip'))
+    )
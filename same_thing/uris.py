@@ -0,0 +1,80 @@
+"""
+Normalization of looked up URIs, and the aliases under which a local IRI
+can also be stored, so that these URIs are found without normalizing them.
+"""
+import re
+from functools import lru_cache
+from typing import List, Tuple
+from urllib.parse import unquote
+
+from same_thing.config import env_int
+
+DBP_GLOBAL_PREFIX = 'https://'
+DBP_GLOBAL_MARKER = 'global.dbpedia.org/id/'
+# global IRIs are also accepted over http, and without a scheme
+GLOBAL_IRI_PREFIXES = tuple(
+    scheme + DBP_GLOBAL_MARKER for scheme in (DBP_GLOBAL_PREFIX, 'http://', '')
+)
+GLOBAL_IRI_PREFIX_BYTES = (DBP_GLOBAL_PREFIX + DBP_GLOBAL_MARKER).encode('utf8')
+NORMALIZE_CACHE_SIZE: int = env_int('SAME_THING_NORMALIZE_CACHE_SIZE', 2**16)
+
+# whether the URI is a global IRI, and the key to look it up with
+UriKey = Tuple[bool, bytes]
+
+wiki_article_re = re.compile(
+    r'https?://(?P<locale>[a-z-]{2,}\.)wikipedia.org/wiki/(?P<slug>.+)$'
+)
+dbpedia_resource_re = re.compile(
+    rb'http://(?P<locale>[a-z-]{2,}\.)?dbpedia.org/resource/(?P<slug>.+)$'
+)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_uri(uri: str) -> UriKey:
+    """
+    Rewrite a URI to the key under which it is stored.
+
+    :param uri: any global or local IRI
+    :return: whether the URI is a global IRI, and the key to look it up with
+    """
+    for global_prefix in GLOBAL_IRI_PREFIXES:
+        if uri.startswith(global_prefix):
+            return True, uri[len(global_prefix):].encode('utf8')
+
+    uri = unquote(uri).replace(' ', '_').replace('"', '%22')
+    if 'dbpedia.org' in uri:
+        uri = uri.replace('dbpedia.org/page/', 'dbpedia.org/resource/')
+    else:
+        wiki_match = wiki_article_re.match(uri)
+        if wiki_match:
+            locale = wiki_match.group('locale').replace('en.', '')
+            uri = f"http://{locale}dbpedia.org/resource/{wiki_match.group('slug')}"
+
+    return False, uri.encode('utf8')
+
+
+def get_alias_key(uri_key: UriKey) -> bytes:
+    """
+    :return: the key of the alias of a normalized URI, i.e. the local IRI or the full global IRI
+    """
+    is_global, key = uri_key
+    return GLOBAL_IRI_PREFIX_BYTES + key if is_global else key
+
+
+def get_aliases(local_iri: bytes, singleton_id: bytes, cluster_id: bytes) -> List[bytes]:
+    """
+    :return: the URIs that are normalized to the local IRI or to the IDs of a
+        snapshot line, other than the local IRI itself
+    """
+    aliases = [GLOBAL_IRI_PREFIX_BYTES + singleton_id]
+    if not singleton_id == cluster_id:
+        aliases.append(GLOBAL_IRI_PREFIX_BYTES + cluster_id)
+
+    resource_match = dbpedia_resource_re.match(local_iri)
+    if resource_match:
+        aliases.append(local_iri.replace(b'dbpedia.org/resource/', b'dbpedia.org/page/', 1))
+        locale = resource_match.group('locale') or b'en.'
+        article = locale + b'wikipedia.org/wiki/' + resource_match.group('slug')
+        aliases.extend((b'https://' + article, b'http://' + article))
+
+    return aliases
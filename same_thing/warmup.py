@@ -0,0 +1,232 @@
+"""
+Sampling of the URIs that are looked up most, and warming up newly opened
+snapshots with them, so that a worker does not serve its first lookups cold.
+
+Every worker counts a sample of the URIs it looks up, and periodically merges
+its counts into its own hot keys file, which it replaces atomically, so that
+the workers never write to the same file. When a worker exits, the gunicorn
+master merges its file into the archive. The hot keys are the sum of all
+files; older counts decay, so that they follow what is looked up recently.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from same_thing.config import env_int
+from same_thing.db import DB_ROOT_PATH
+from same_thing.source import print_with_timestamp
+
+# next to the DBs, so that the hot keys are kept when the containers are restarted
+HOT_KEYS_DIR = os.environ.get('SAME_THING_HOT_KEYS_DIR', os.path.join(DB_ROOT_PATH, 'hot_keys'))
+ARCHIVE_NAME = 'archive.json'
+# the number of hot keys that is kept, and replayed when a snapshot is opened
+HOT_KEY_COUNT = env_int('SAME_THING_HOT_KEYS', 10000)
+# count one in this many looked up URIs
+HOT_KEY_SAMPLE_EVERY = env_int('SAME_THING_HOT_KEY_SAMPLE_EVERY', 100)
+HOT_KEY_SAVE_SECONDS = env_int('SAME_THING_HOT_KEY_SAVE_SECONDS', 300)
+# the saved counts are halved after this many seconds
+HOT_KEY_HALF_LIFE_SECONDS = 24 * 3600
+WARM_UP_SECONDS = env_int('SAME_THING_WARM_UP_SECONDS', 60)
+WARM_UP_BATCH_SIZE = 1000
+
+
+class HotKeySampler:
+    """
+    Counts a systematic sample of the looked up URIs, in a single worker.
+    """
+
+    def __init__(self, sample_every=HOT_KEY_SAMPLE_EVERY, max_keys=HOT_KEY_COUNT):
+        self.sample_every = sample_every
+        self.max_keys = max_keys
+        self.counts: Dict[str, float] = {}
+        # the number of URIs to skip before the next sample
+        self.skip = 0
+        self.lock = threading.Lock()
+
+    def sample(self, uris: List[str]) -> None:
+        if self.sample_every <= 0:
+            return
+
+        with self.lock:
+            for uri in uris[self.skip::self.sample_every]:
+                self.counts[uri] = self.counts.get(uri, 0) + 1
+            self.skip = (self.skip - len(uris)) % self.sample_every
+            if len(self.counts) > 2 * self.max_keys:
+                self.counts = top_counts(self.counts, self.max_keys)
+
+    def take_counts(self) -> Dict[str, float]:
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def restore_counts(self, counts: Dict[str, float]) -> None:
+        """
+        Add counts that could not be saved back to the sample.
+        """
+        with self.lock:
+            add_counts(self.counts, counts)
+
+    def save(self, hot_keys_dir=HOT_KEYS_DIR) -> int:
+        """
+        Merge the sampled counts into the hot keys file of this worker.
+
+        If the file cannot be written, the counts are kept for the next attempt.
+
+        :return: the number of URIs that were sampled since the last save
+        """
+        counts = self.take_counts()
+        if not counts:
+            return 0
+
+        try:
+            hot_keys_path = get_hot_keys_path(os.getpid(), hot_keys_dir)
+            hot_keys = add_counts(decay_counts(*read_hot_keys(hot_keys_path)), counts)
+            write_hot_keys(hot_keys_path, top_counts(hot_keys, self.max_keys))
+        except Exception:
+            self.restore_counts(counts)
+            raise
+
+        return len(counts)
+
+    async def save_periodically(self, interval=HOT_KEY_SAVE_SECONDS):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.save)
+            except Exception as e:
+                print_with_timestamp(f'Could not save the hot keys: {e!r}')
+
+
+def top_counts(counts: Dict[str, float], max_keys: int) -> Dict[str, float]:
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)[:max_keys])
+
+
+def add_counts(counts: Dict[str, float], other_counts: Dict[str, float]) -> Dict[str, float]:
+    """
+    Add counts to other counts, in place.
+    """
+    for uri, count in other_counts.items():
+        counts[uri] = counts.get(uri, 0) + count
+    return counts
+
+
+def get_hot_keys_path(pid, hot_keys_dir=HOT_KEYS_DIR):
+    return os.path.join(hot_keys_dir, f'worker_{pid}.json')
+
+
+def read_hot_keys(hot_keys_path) -> Tuple[Dict[str, float], Optional[float]]:
+    """
+    :return: the counts of the hot keys in a file, and when they were saved
+    """
+    try:
+        with open(hot_keys_path) as hot_keys_file:
+            hot_keys = json.load(hot_keys_file)
+    except (OSError, ValueError):
+        return {}, None
+
+    return dict(hot_keys['counts']), hot_keys['saved_at']
+
+
+def write_hot_keys(hot_keys_path, counts: Dict[str, float]) -> None:
+    """
+    Replace a hot keys file atomically.
+    """
+    os.makedirs(os.path.dirname(hot_keys_path), exist_ok=True)
+    temp_path = f'{hot_keys_path}.tmp'
+    with open(temp_path, 'w') as hot_keys_file:
+        json.dump({
+            'saved_at': time.time(),
+            'counts': sorted(counts.items(), key=lambda item: item[1], reverse=True),
+        }, hot_keys_file)
+    os.replace(temp_path, hot_keys_path)
+
+
+def iter_hot_keys_paths(hot_keys_dir=HOT_KEYS_DIR):
+    """
+    :return: generator of the paths of the archive and of the files of the workers
+    """
+    if not os.path.isdir(hot_keys_dir):
+        return
+
+    for file_name in sorted(os.listdir(hot_keys_dir)):
+        if file_name.endswith('.json'):
+            yield os.path.join(hot_keys_dir, file_name)
+
+
+def archive_hot_keys(pid=None, max_keys=HOT_KEY_COUNT, hot_keys_dir=HOT_KEYS_DIR) -> None:
+    """
+    Merge the hot keys file of an exited worker into the archive, and remove it.
+    Only the gunicorn master calls this, so the archive has a single writer.
+
+    :param pid: the process ID of the worker, or None to merge the files of all
+        workers, e.g. those that were left when the containers were stopped
+    """
+    archive_path = os.path.join(hot_keys_dir, ARCHIVE_NAME)
+    if pid is None:
+        worker_paths = [path for path in iter_hot_keys_paths(hot_keys_dir) if path != archive_path]
+    else:
+        worker_paths = [get_hot_keys_path(pid, hot_keys_dir)]
+    worker_paths = [path for path in worker_paths if os.path.exists(path)]
+    if not worker_paths:
+        return
+
+    hot_keys = decay_counts(*read_hot_keys(archive_path))
+    for worker_path in worker_paths:
+        add_counts(hot_keys, decay_counts(*read_hot_keys(worker_path)))
+    write_hot_keys(archive_path, top_counts(hot_keys, max_keys))
+    for worker_path in worker_paths:
+        os.remove(worker_path)
+
+
+def decay_counts(counts: Dict[str, float], saved_at: Optional[float]) -> Dict[str, float]:
+    if saved_at is None:
+        return counts
+
+    factor = 0.5 ** (max(0.0, time.time() - saved_at) / HOT_KEY_HALF_LIFE_SECONDS)
+    return {uri: count * factor for uri, count in counts.items()}
+
+
+def get_hot_keys(max_keys=HOT_KEY_COUNT, hot_keys_dir=HOT_KEYS_DIR) -> List[str]:
+    """
+    :return: the hottest URIs in the archive and the files of the workers, from hottest to coldest
+    """
+    hot_keys: Dict[str, float] = {}
+    for hot_keys_path in iter_hot_keys_paths(hot_keys_dir):
+        add_counts(hot_keys, decay_counts(*read_hot_keys(hot_keys_path)))
+    return list(top_counts(hot_keys, max_keys))
+
+
+def warm_up(lookup, time_limit=WARM_UP_SECONDS) -> int:
+    """
+    Look up the hot keys in batches, to load their blocks into the block cache
+    (and their clusters into the cluster cache).
+
+    :param lookup: function that looks up a list of URIs
+    :param time_limit: stop after this many seconds, if the hot keys have not all been looked up
+    :return: the number of URIs that were looked up
+    """
+    started_at = time.monotonic()
+    warmed = 0
+    try:
+        hot_keys = get_hot_keys()
+        for start in range(0, len(hot_keys), WARM_UP_BATCH_SIZE):
+            if time.monotonic() - started_at > time_limit:
+                break
+            batch = hot_keys[start:start + WARM_UP_BATCH_SIZE]
+            lookup(batch)
+            warmed += len(batch)
+    except Exception as e:
+        # a cold snapshot can still be served
+        print_with_timestamp(f'Could not warm up with the hot keys: {e!r}')
+        return warmed
+
+    if hot_keys:
+        print_with_timestamp(
+            f'Warmed up with {warmed} of {len(hot_keys)} hot keys '
+            f'in {time.monotonic() - started_at:.1f} seconds'
+        )
+    return warmed